@@ -0,0 +1,366 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Benchmark each step of the pipeline against a synthetic MeerKAT-like MeasurementSet of configurable size, recording
+the wall time, CPU time and peak memory of each step, and the time and resources used by each CASA task it calls.
+"""
+
+import os
+import sys
+import json
+import math
+import glob
+import time
+import argparse
+import subprocess
+from datetime import datetime
+from shutil import copyfile,copytree,rmtree
+
+import processMeerKAT
+import config_parser
+import step_ledger
+import instrument
+import resources
+
+from casatools import simulator,measures,componentlist
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+sm = simulator()
+me = measures()
+cl = componentlist()
+
+#MeerKAT L-band, dish diameter (m) and correlations
+BAND_START_MHZ = 856.0
+BANDWIDTH_MHZ = 856.0
+DISH_DIAMETER = 13.5
+STOKES = 'XX XY YX YY'
+
+#Synthetic fields (name, direction, flux in Jy at 1.284 GHz and intent), with one scan of the first field followed by alternating scans of the other two
+FIELDS = [('J1939-6342', 'J2000 19h39m25.026s -63d42m45.63s', 15.0, 'CALIBRATE_FLUX#ON_SOURCE,CALIBRATE_BANDPASS#ON_SOURCE'),
+          ('J1830-3602', 'J2000 18h30m58.800s -36d02m30.10s', 5.0, 'CALIBRATE_PHASE#ON_SOURCE,CALIBRATE_AMPLI#ON_SOURCE'),
+          ('TARGET', 'J2000 18h00m00.000s -30d00m00.00s', 0.05, 'TARGET#ON_SOURCE')]
+REFERENCE_FREQ = '1.284GHz'
+SPECTRAL_INDEX = -0.7
+NOISE = '0.1Jy'
+START_TIME = '2022/01/01/00:00:00'
+
+#Steps only run for multiple SPWs, which the benchmark doesn't cover
+MULTI_SPW_SCRIPTS = ['concat.py','plotcal_spw.py']
+
+#Directory of synthetic MSs, which are copied before each benchmark since the pipeline modifies them
+SIM_DIR = 'benchmark_ms'
+CONFIG = 'benchmark_config.txt'
+RESULTS = 'benchmark.jsonl'
+
+def parse_args():
+
+    """Parse arguments into this script.
+
+    Returns:
+    --------
+    args : class ``argparse.ArgumentParser``
+        Known and validated arguments."""
+
+    parser = argparse.ArgumentParser(prog=sys.argv[0],description='Benchmark each step of the pipeline against a synthetic MeerKAT-like MeasurementSet.')
+    parser.add_argument("--nants", metavar="num", required=False, type=int, default=16, help="Number of antennas [default: 16].")
+    parser.add_argument("--maxbaseline", metavar="m", required=False, type=float, default=8000.0, help="Longest baseline in metres [default: 8000].")
+    parser.add_argument("--nchan", metavar="num", required=False, type=int, default=256, help="Number of channels across 856 MHz bandwidth [default: 256].")
+    parser.add_argument("--nscans", metavar="num", required=False, type=int, default=5, help="Number of target scans, each followed by a phase calibrator scan [default: 5].")
+    parser.add_argument("--scanlength", metavar="s", required=False, type=float, default=300.0, help="Length of each scan in seconds [default: 300].")
+    parser.add_argument("--inttime", metavar="s", required=False, type=float, default=8.0, help="Integration time in seconds [default: 8].")
+    parser.add_argument("--imsize", metavar="pixels", required=False, type=int, default=1024, help="Image size of selfcal and science imaging steps [default: 1024].")
+    parser.add_argument("--wprojplanes", metavar="num", required=False, type=int, default=32, help="W-projection planes of selfcal and science imaging steps [default: 32].")
+    parser.add_argument("-2","--do2GC", action="store_true", required=False, default=False, help="Also benchmark (2GC) self-calibration [default: False].")
+    parser.add_argument("-I","--science_image", action="store_true", required=False, default=False, help="Also benchmark science imaging [default: False].")
+    parser.add_argument("-S","--stages", nargs='*', metavar='script', required=False, default=[], help="Only benchmark these scripts, with the preceding steps still run (but not recorded) [default: all].")
+    parser.add_argument("-t","--ntasks", metavar="num", required=False, type=int, default=4, help="Number of MPI tasks for threadsafe scripts [default: 4].")
+    parser.add_argument("-w","--mpi_wrapper", metavar="cmd", required=False, type=str, default=processMeerKAT.LOCAL_MPI_WRAPPER,
+                        help="MPI wrapper for threadsafe scripts, formatted with the number of tasks [default: '{0}'].".format(processMeerKAT.LOCAL_MPI_WRAPPER))
+    parser.add_argument("-c","--container", metavar="path", required=False, type=str, default='', help="Run each script within this container, rather than with this python [default: ''].")
+    parser.add_argument("-o","--outdir", metavar="path", required=False, type=str, default='benchmark', help="Directory in which to run the pipeline [default: 'benchmark'].")
+    parser.add_argument("-r","--results", metavar="path", required=False, type=str, default=RESULTS, help="JSON lines file to which results are appended [default: '{0}'].".format(RESULTS))
+    parser.add_argument("--simulate", action="store_true", required=False, default=False, help="Only simulate the MS (if it doesn't exist) and quit [default: False].")
+
+    args = parser.parse_args()
+
+    if args.nants < 4:
+        parser.error('At least 4 antennas are needed for calibration (--nants).')
+    if args.nscans < 1:
+        parser.error('At least 1 target scan is needed (--nscans).')
+
+    return args
+
+def ms_name(args):
+
+    """Return the name of the synthetic MS with the shape given by the arguments, so an existing MS can be reused."""
+
+    return 'sim_{0}ant_{1}ch_{2}scan_{3:g}s_{4:g}s.ms'.format(args.nants,args.nchan,args.nscans,args.scanlength,args.inttime)
+
+def antenna_positions(nants, maxbaseline):
+
+    """Return local (east, north, up) positions in metres of antennas on a spiral, which are densest at the centre like MeerKAT's core.
+
+    Arguments:
+    ----------
+    nants : int
+        Number of antennas.
+    maxbaseline : float
+        Diameter of array in metres.
+
+    Returns:
+    --------
+    x, y, z : list
+        East, north and up positions of each antenna."""
+
+    golden_angle = math.pi * (3 - math.sqrt(5))
+    radii = [maxbaseline / 2.0 * ((i + 1) / float(nants))**2 for i in range(nants)]
+    x = [r * math.cos(i * golden_angle) for i,r in enumerate(radii)]
+    y = [r * math.sin(i * golden_angle) for i,r in enumerate(radii)]
+    return x, y, [0.0]*nants
+
+def simulate(MS, nants, maxbaseline, nchan, nscans, scanlength, inttime):
+
+    """Simulate a MeerKAT-like MS with a flux/bandpass calibrator scan, followed by alternating target and phase calibrator scans.
+    Each field has a point source at its centre, with thermal noise added to the visibilities.
+
+    Arguments:
+    ----------
+    MS : str
+        Output MeasurementSet.
+    nants : int
+        Number of antennas.
+    maxbaseline : float
+        Diameter of array in metres.
+    nchan : int
+        Number of channels across the band.
+    nscans : int
+        Number of target scans.
+    scanlength : float
+        Length of each scan in seconds.
+    inttime : float
+        Integration time in seconds."""
+
+    logger.info('Simulating {0} antennas, {1} channels and {2} target scans in "{3}".'.format(nants,nchan,nscans,MS))
+
+    x, y, z = antenna_positions(nants, maxbaseline)
+    names = ['m{0:03d}'.format(i) for i in range(nants)]
+    chanwidth = BANDWIDTH_MHZ / nchan
+
+    sm.open(MS)
+    sm.setconfig(telescopename='MeerKAT', x=x, y=y, z=z, dishdiameter=[DISH_DIAMETER]*nants, mount=['alt-az']*nants,
+                 antname=names, padname=names, coordsystem='local', referencelocation=me.observatory('MeerKAT'))
+    sm.setspwindow(spwname='LBand', freq='{0}MHz'.format(BAND_START_MHZ), deltafreq='{0}MHz'.format(chanwidth),
+                   freqresolution='{0}MHz'.format(chanwidth), nchannels=nchan, stokes=STOKES)
+    sm.setfeed(mode='perfect X Y', pol=[''])
+    sm.setlimits(shadowlimit=0.001, elevationlimit='8.0deg')
+    sm.setauto(autocorrwt=0.0)
+    for name,direction,flux,intent in FIELDS:
+        sm.setfield(sourcename=name, sourcedirection=me.direction(*direction.split()))
+    sm.settimes(integrationtime='{0}s'.format(inttime), usehourangle=True, referencetime=me.epoch('utc', START_TIME))
+
+    #One scan of the flux/bandpass calibrator, followed by target and phase calibrator scans, with the phase calibrator either side of the target
+    order = [FIELDS[0], FIELDS[1]] + [FIELDS[2], FIELDS[1]] * nscans
+    start = 0.0
+    for name,direction,flux,intent in order:
+        sm.observe(sourcename=name, spwname='LBand', starttime='{0}s'.format(start), stoptime='{0}s'.format(start + scanlength), state_obs_mode=intent)
+        start += scanlength
+
+    #Point source at the centre of each field, with a power-law spectrum
+    complist = '{0}.cl'.format(os.path.splitext(MS)[0])
+    if os.path.exists(complist):
+        rmtree(complist)
+    for name,direction,flux,intent in FIELDS:
+        cl.addcomponent(dir=direction, flux=flux, fluxunit='Jy', freq=REFERENCE_FREQ, shape='point', spectrumtype='spectral index', index=SPECTRAL_INDEX)
+    cl.rename(complist)
+    cl.close()
+
+    sm.predict(complist=complist)
+    sm.setnoise(mode='simplenoise', simplenoise=NOISE)
+    sm.corrupt()
+    sm.close()
+    rmtree(complist)
+
+def stages(config):
+
+    """Return the scripts (and whether each is threadsafe) run for one SPW, in the order the pipeline runs them.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+
+    Returns:
+    --------
+    scripts : list
+        Tuples of script and whether it's threadsafe."""
+
+    slurm = config_parser.parse_config(config)[0]['slurm']
+    scripts = [(script,threadsafe) for script,threadsafe,container in slurm['scripts']]
+
+    #As done by processMeerKAT.py when nspw=1, drop calc_refant.py from the precal scripts in preference for the one in scripts
+    precal = [(script,threadsafe) for script,threadsafe,container in slurm['precal_scripts'] if not (script == 'calc_refant.py' and ('calc_refant.py',False) in scripts)]
+    postcal = [(script,threadsafe) for script,threadsafe,container in slurm['postcal_scripts'] if script not in MULTI_SPW_SCRIPTS]
+    scripts = precal + scripts + postcal
+
+    #Repeat selfcal scripts for each loop, as done for sbatch files
+    names = ['{0}.sbatch'.format(os.path.splitext(script)[0]) for script,threadsafe in scripts]
+    threadsafe = dict(scripts)
+    return [('{0}.py'.format(os.path.splitext(name)[0]), threadsafe['{0}.py'.format(os.path.splitext(name)[0])]) for name in processMeerKAT.selfcal_scripts(config, names)]
+
+def command(script, threadsafe, config, args):
+
+    """Return the command that runs a script, as run locally by the pipeline."""
+
+    if args.container != '':
+        cmd = 'singularity exec {0} python'.format(args.container)
+    else:
+        cmd = sys.executable
+    cmd += ' {0} --config {1}'.format(processMeerKAT.check_path(script, update=True), config)
+    if threadsafe and args.mpi_wrapper != '':
+        cmd = '{0} {1}'.format(args.mpi_wrapper.format(args.ntasks), cmd)
+    return cmd
+
+def run(cmd, env):
+
+    """Run a command, returning its exit code, wall time, CPU time (of it and its children) and peak RSS in bytes (of its largest process)."""
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True, env=env)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return {'returncode' : proc.returncode, 'wall' : round(time.time() - start, 3),
+            'cpu' : round(rusage.ru_utime + rusage.ru_stime, 3), 'maxrss' : rusage.ru_maxrss * 1024}
+
+def calls(name, jobid):
+
+    """Return the records written by the instrumented CASA tasks of a step."""
+
+    records = []
+    for fname in glob.glob(os.path.join(instrument.LOG_DIR, '{0}-{1}*.{2}'.format(name,jobid,instrument.EXTN))):
+        with open(fname) as f:
+            records += [json.loads(line) for line in f if line.strip() != '']
+    return records
+
+def git_commit():
+
+    """Return the commit of the pipeline being benchmarked, or None if it isn't a git repository."""
+
+    try:
+        return subprocess.check_output(['git','-C',os.path.dirname(os.path.abspath(processMeerKAT.THIS_PROG)),'rev-parse','HEAD'],stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def build_config(MS, config, args):
+
+    """Write a config file for the synthetic MS, with its fields read from the MS, and one SPW covering the band.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet.
+    config : str
+        Path to config file.
+    args : class ``argparse.ArgumentParser``
+        Arguments passed into this script."""
+
+    build = '{0} {1} -B -l -x -M {2} -C {3} -t {4}'.format(sys.executable,processMeerKAT.THIS_PROG,MS,config,args.ntasks)
+    if args.do2GC:
+        build += ' -2'
+    if args.science_image:
+        build += ' -I'
+    subprocess.check_call(build, shell=True)
+
+    #Read fields from MS, and write its metadata snapshot, as done by processMeerKAT.py without [-x --nofields]
+    subprocess.check_call(command('read_ms.py', False, '{0} -B -M {1}'.format(config,MS), args), shell=True)
+
+    spw = "'*:{0:g}~{1:g}MHz'".format(BAND_START_MHZ, BAND_START_MHZ + BANDWIDTH_MHZ)
+    image = {'imsize' : [args.imsize, args.imsize], 'wprojplanes' : args.wprojplanes}
+    with config_parser.batch_update(config):
+        config_parser.overwrite_config(config, conf_dict={'spw' : spw, 'nspw' : 1, 'refant' : "'m000'", 'badfreqranges' : []}, conf_sec='crosscal')
+        config_parser.overwrite_config(config, conf_dict={'instrument' : True}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+        for section in ['selfcal','image']:
+            if config_parser.has_section(config, section):
+                config_parser.overwrite_config(config, conf_dict=image, conf_sec=section)
+
+def benchmark(args):
+
+    """Simulate an MS (or reuse an existing one), copy it to the output directory, and run each step of the pipeline against it,
+    appending the resources used by each step to the results file."""
+
+    MS = os.path.abspath(os.path.join(SIM_DIR, ms_name(args)))
+    if not os.path.exists(MS):
+        if not os.path.exists(SIM_DIR):
+            os.makedirs(SIM_DIR)
+        simulate(MS, args.nants, args.maxbaseline, args.nchan, args.nscans, args.scanlength, args.inttime)
+    if args.simulate:
+        return
+
+    #Run in a clean directory, without any completed steps from a previous benchmark
+    results = os.path.abspath(args.results)
+    if os.path.exists(args.outdir):
+        rmtree(args.outdir)
+    os.makedirs(os.path.join(args.outdir, instrument.LOG_DIR))
+    os.chdir(args.outdir)
+    vis = os.path.basename(MS)
+    copytree(MS, vis, symlinks=True)
+
+    build_config(vis, CONFIG, args)
+    params = {key : getattr(args, key) for key in ['nants','maxbaseline','nchan','nscans','scanlength','inttime','imsize','wprojplanes','ntasks']}
+    params['nvis'] = None
+    shape = resources.vis_shape(vis)
+    if shape is not None:
+        params['nvis'] = shape['nrows'] * shape['nchan'] * shape['ncorr']
+
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
+    commit = git_commit()
+    env = dict(os.environ)
+    env[step_ledger.RUN_ID] = timestamp
+    rows = []
+
+    for i,(script,threadsafe) in enumerate(stages(CONFIG)):
+        name = os.path.splitext(script)[0]
+        jobid = '{0}{1:03d}'.format(os.getpid(), i)
+        env.update({'SLURM_JOB_ID' : jobid, 'SLURM_JOB_NAME' : name, 'SLURM_NTASKS' : str(args.ntasks if threadsafe else 1), 'SLURM_CPUS_PER_TASK' : '1'})
+
+        #As done by each sbatch file, run from a copy of the config file
+        copyfile(CONFIG, processMeerKAT.TMP_CONFIG)
+        cmd = command(script, threadsafe, processMeerKAT.TMP_CONFIG, args)
+        logger.info('Running step {0} ({1}): {2}'.format(i, name, cmd))
+        result = run(cmd, env)
+        copyfile(processMeerKAT.TMP_CONFIG, CONFIG)
+
+        if len(args.stages) == 0 or script in args.stages or name in args.stages:
+            record = {'timestamp' : timestamp, 'commit' : commit, 'params' : params, 'step' : i, 'script' : name, 'threadsafe' : threadsafe}
+            record.update(result)
+            record['calls'] = calls(name, jobid)
+            with open(results, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            rows.append(record)
+
+        if result['returncode'] != 0:
+            logger.error("Step '{0}' failed with exit code {1}, so not running the steps that follow. See '{2}'.".format(name, result['returncode'], instrument.LOG_DIR))
+            break
+
+    logger.info('Results appended to "{0}".'.format(results))
+    print(format_table(rows))
+
+def format_table(rows):
+
+    """Return a table of the time and memory used by each step."""
+
+    lines = ['{0:<4} {1:<20} {2:>10} {3:>10} {4:>12} {5:>6} {6:>6}'.format('step','script','wall_s','cpu_s','maxrss_GB','calls','exit')]
+    for row in rows:
+        lines.append('{step:<4} {script:<20} {wall:>10.1f} {cpu:>10.1f} {0:>12.2f} {1:>6} {returncode:>6}'.format(row['maxrss'] / 1024.0**3, len(row['calls']), **row))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+
+    benchmark(parse_args())
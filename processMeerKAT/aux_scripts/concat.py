@@ -4,18 +4,19 @@
 import os
 import sys
 import glob
-from shutil import copytree
+import traceback
+from shutil import copytree,rmtree
+from multiprocessing import get_context
 
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import ms_metadata
 
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata,image
-msmd = msmetadata()
-ia = image()
+from casatools import image
 
 import logging
 from time import gmtime
@@ -23,18 +24,38 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
+#Products concatenated for each field
+PRODUCTS = ['contcube','ms','mms']
+
 def sortbySPW(visname):
     return float(visname.split('~')[0])
 
+def done_marker(out):
+    return '{0}.done'.format(out)
+
+def inprogress_marker(out):
+    return '{0}.inprogress'.format(out)
+
+def remove_marker(marker):
+    if os.path.exists(marker):
+        os.remove(marker)
+
 def check_output(fname,files,pattern,out,job='concat',filetype='image'):
 
-    if os.path.exists(out):
+    #Only remove outputs that a previous call started but didn't complete, since outputs written before markers were used have neither marker
+    if os.path.exists(out) and os.path.exists(inprogress_marker(out)):
+        logger.warning('Output file "{0}" was started but not completed. Removing and repeating {1}.'.format(out,job))
+        rmtree(out)
+    elif os.path.exists(out):
         logger.info('Output file "{0}" already exists. Skipping {1}.'.format(out,job))
         return None
-    elif len(files) == 0:
+
+    if len(files) == 0:
         logger.warning("Didn't find any {0}s with '{1}'".format(filetype,pattern))
         return None
-    elif len(files) == 1:
+
+    open(inprogress_marker(out),'w').close()
+    if len(files) == 1:
         logger.warning("Only found 1 {0} with '{1}'. Will copy to this directory.".format(filetype,pattern))
         copytree(files[0], out)
         return None
@@ -67,88 +88,133 @@ def get_infiles(dirs,suffix):
 
     return files,pattern
 
-def do_concat(visname, fields, dirs='*MHz'):
+def concat_product(fname, product, filebase, dirs):
+
+    """Concatenate one product of one field across all SPWs, writing a completion marker once the output is complete.
+
+    Arguments:
+    ----------
+    fname : str
+        Field name.
+    product : str
+        Product to concatenate - one of 'contcube' (images), 'ms' or 'mms'.
+    filebase : str
+        Base name of output.
+    dirs : str or list
+        SPW directories containing the input products.
+
+    Returns:
+    --------
+    out : str
+        Name of complete output, or None if no input products found."""
+
+    if product == 'contcube':
+        #Concat tt0 images (into continuum cube), otherwise images
+        out = '{0}.{1}.contcube'.format(filebase,fname)
+        job,filetype = 'imageconcat','image'
+        files,pattern = get_infiles(dirs,'images/*.{0}*image.tt0'.format(fname))
+        if len(files) == 0:
+            files,pattern = get_infiles(dirs,'images/*.{0}*image'.format(fname))
+    elif product == 'ms':
+        out = '{0}.{1}.ms'.format(filebase,fname)
+        job,filetype = 'concat','MS'
+        files,pattern = get_infiles(dirs,'*.{0}*.ms'.format(fname))
+    else:
+        out = '{0}.{1}.mms'.format(filebase,fname)
+        job,filetype = 'virtualconcat','MMS'
+        files,pattern = get_infiles(dirs,'*.{0}*.mms'.format(fname))
+
+    if os.path.exists(done_marker(out)):
+        logger.info('Output file "{0}" already exists. Skipping {1}.'.format(out,job))
+        return out
+
+    files = check_output(fname,files,pattern,out,job=job,filetype=filetype)
+    if files is not None:
+        files.sort(key=sortbySPW)
+        if product == 'contcube':
+            logger.info('Creating continuum cube with following command:')
+            logger.info('ia.imageconcat(infiles={0}, outfile={1}, axis=-1, relax=True)'.format(files,out))
+            ia = image()
+            ia.imageconcat(infiles=files, outfile=out, axis=-1, relax=True).done()
+            ia.done()
+        elif product == 'ms':
+            logger.info('Concatenating MSs with following command:')
+            logger.info('concat(vis={0}, concatvis={1})'.format(files,out))
+            concat(vis=files, concatvis=out)
+        else:
+            logger.info('Concatenating MMSs with following command:')
+            logger.info('virtualconcat(vis={0}, concatvis={1})'.format(files,out))
+            virtualconcat(vis=files, concatvis=out)
+
+    if not os.path.exists(out):
+        remove_marker(inprogress_marker(out))
+        if files is not None:
+            raise IOError("Output {0} '{1}' attempted to write but was not written.".format(filetype,out))
+        return None
+
+    if product == 'contcube':
+        if os.path.exists(out+'.fits'):
+            os.remove(out+'.fits')
+        exportfits(imagename=out, fitsimage=out+'.fits')
 
-    msmd.open(visname)
+    open(done_marker(out),'w').close()
+    remove_marker(inprogress_marker(out))
+    return out
+
+def run_product(task):
+
+    """Run concat_product() for one (field, product), catching any exception so that remaining products are still concatenated."""
+
+    try:
+        return concat_product(*task), None
+    except Exception as err:
+        logger.error('Exception found while concatenating {0} for field "{1}" of type {2}: {3}'.format(task[1],task[0],type(err),err))
+        logger.error(traceback.format_exc())
+        return None, str(err)
+
+def do_concat(visname, fields, dirs='*MHz', nprocs=1):
+
+    msmd = ms_metadata.get(visname)
 
     newvis = visname
     logger.info('Beginning {0}.'.format(sys.argv[0]))
     basename, ext = os.path.splitext(visname)
     filebase = os.path.split(basename)[1]
+    target = fields.targetfield.split(',')[0]
+    if target.isdigit():
+        target = msmd.namesforfields(int(target))[0]
 
+    #Each field / product is independent, so concatenate each in a separate process
+    fnames = []
     for field in [fields.targetfield,fields.gainfields,fields.extrafields]:
         if field != '':
             for fname in field.split(','):
                 if fname.isdigit():
                     fname = msmd.namesforfields(int(fname))[0]
+                if fname not in fnames:
+                    fnames.append(fname)
+
+    tasks = [(fname, product, filebase, dirs) for fname in fnames for product in PRODUCTS]
+    nprocs = max(1, min(nprocs, len(tasks)))
+    logger.info('Concatenating {0} products for {1} fields using {2} processes.'.format(len(tasks),len(fnames),nprocs))
+
+    #Spawn fresh processes, rather than forking this process after CASA is imported
+    if nprocs > 1:
+        with get_context('spawn').Pool(nprocs) as pool:
+            results = pool.map(run_product, tasks, chunksize=1)
+    else:
+        results = [run_product(task) for task in tasks]
+
+    failed = []
+    for task,(out,err) in zip(tasks,results):
+        if err is not None:
+            failed.append('{0} ({1})'.format(task[0],task[1]))
+        elif out is not None and task[0] == target and task[1] in ['ms','mms']:
+            newvis = out
+
+    if len(failed) > 0:
+        raise RuntimeError('Failed to concatenate {0}. Run {1} again to concatenate only the incomplete products.'.format(', '.join(failed),sys.argv[0]))
 
-                #Concat tt0 images (into continuum cube)
-                suffix = 'images/*.{0}*image.tt0'.format(fname)
-                files,pattern = get_infiles(dirs,suffix)
-                out = '{0}.{1}.contcube'.format(filebase,fname)
-                images = check_output(fname,files,pattern,out,job='imageconcat',filetype='image')
-                if images is not None:
-                    images.sort(key=sortbySPW)
-                    logger.info('Creating continuum cube with following command:')
-                    logger.info('ia.imageconcat(infiles={0}, outfile={1}, axis=-1, relax=True)'.format(images,out))
-                    ia.imageconcat(infiles=images, outfile=out, axis=-1, relax=True)
-
-                    if os.path.exists(out):
-                        if not os.path.exists(out+'.fits'):
-                            exportfits(imagename=out, fitsimage=out+'.fits')
-                    else:
-                        logger.error("Output image '{0}' attempted to write but was not written.".format(out))
-
-                #Concat images (into continuum cube)
-                suffix = 'images/*.{0}*image'.format(fname)
-                files,pattern = get_infiles(dirs,suffix)
-                out = '{0}.{1}.contcube'.format(filebase,fname)
-                images = check_output(fname,files,pattern,out,job='imageconcat',filetype='image')
-                if images is not None:
-                    images.sort(key=sortbySPW)
-                    logger.info('Creating continuum cube with following command:')
-                    logger.info('ia.imageconcat(infiles={0}, outfile={1}, axis=-1, relax=True)'.format(images,out))
-                    ia.imageconcat(infiles=images, outfile=out, axis=-1, relax=True)
-
-                    if os.path.exists(out):
-                        if not os.path.exists(out+'.fits'):
-                            exportfits(imagename=out, fitsimage=out+'.fits')
-                    else:
-                        logger.error("Output image '{0}' attempted to write but was not written.".format(out))
-
-                #Concat MSs
-                suffix = '*.{0}*.ms'.format(fname)
-                files,pattern = get_infiles(dirs,suffix)
-                out = '{0}.{1}.ms'.format(filebase,fname)
-                MSs = check_output(fname,files,pattern,out,job='concat',filetype='MS')
-                if MSs is not None:
-                    MSs.sort(key=sortbySPW)
-                    logger.info('Concatenating MSs with following command:')
-                    logger.info('concat(vis={0}, concatvis={1})'.format(MSs,out))
-                    concat(vis=MSs, concatvis=out)
-                    if fname == fields.targetfield.split(',')[0]:
-                        newvis = out
-
-                    if not os.path.exists(out):
-                        logger.error("Output MS '{0}' attempted to write but was not written.".format(out))
-
-                #Concat MMSs
-                suffix = '*.{0}*.mms'.format(fname)
-                files,pattern = get_infiles(dirs,suffix)
-                out = '{0}.{1}.mms'.format(filebase,fname)
-                MMSs = check_output(fname,files,pattern,out,job='virtualconcat',filetype='MMS')
-                if MMSs is not None:
-                    MMSs.sort(key=sortbySPW)
-                    logger.info('Concatenating MMSs with following command:')
-                    logger.info('virtualconcat(vis={0}, concatvis={1})'.format(MMSs,out))
-                    virtualconcat(vis=MMSs, concatvis=out)
-                    if fname == fields.targetfield.split(',')[0]:
-                        newvis = out
-
-                    if not os.path.exists(out):
-                        logger.error("Output MMS '{0}' attempted to write but was not written.".format(out))
-
-    msmd.done()
     logger.info('Completed {0}.'.format(sys.argv[0]))
 
     return newvis
@@ -160,11 +226,15 @@ def main(args,taskvals):
     nspw = va(taskvals, 'crosscal', 'nspw', int, default='')
     fields = bookkeeping.get_field_ids(taskvals['fields'])
     dirs = config_parser.parse_spw(args['config'])[3]
+    nprocs = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
 
     if ',' in spw:
-        newvis = do_concat(visname, fields, dirs)
-        config_parser.overwrite_config(args['config'], conf_dict={'vis' : "'{0}'".format(newvis)}, conf_sec='data')
-        config_parser.overwrite_config(args['config'], conf_dict={'crosscal_vis': "'{0}'".format(visname)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+        newvis = do_concat(visname, fields, dirs, nprocs)
+        if newvis != visname:
+            ms_metadata.write(newvis)
+        with config_parser.batch_update(args['config']):
+            config_parser.overwrite_config(args['config'], conf_dict={'vis' : "'{0}'".format(newvis)}, conf_sec='data')
+            config_parser.overwrite_config(args['config'], conf_dict={'crosscal_vis': "'{0}'".format(visname)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
     else:
         logger.error("Only found one SPW in '{0}', so will skip concat.".format(args['config']))
 
@@ -4,6 +4,7 @@ import argparse
 from matplotlib import use
 use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import numpy as np
 import os,sys,time
 
@@ -20,6 +21,9 @@ logging.Formatter.converter = time.gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
+#Number of rows to read at once when streaming
+CHUNKSIZE = 10000
+
 def get_axis(axis,data,flags,times,spw,startchan,freq_unit='MHz'):
 
     """Plot data from a measurement set or calibration table.
@@ -75,7 +79,307 @@ def get_axis(axis,data,flags,times,spw,startchan,freq_unit='MHz'):
 
     return data
 
-def fastplot(MS, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', freq_unit='MHz', fname='plot.png', logy=False, markersize=1, extent=0.1):
+DATA_AXES = ['Amplitude','Amp','Phase','Imag','Imaginary','Real']
+
+def get_query(spw,nspw,field='',antenna=''):
+
+    """Build TaQL query selecting a spectral window, field and antenna.
+
+    Arguments:
+    ----------
+    spw : int
+        The spectral window (only selected if nspw > 1).
+    nspw : int
+        The number of spectral windows.
+    field : str, optional
+        Select this field.
+    antenna : str, optional
+        Select this antenna (as ANTENNA1).
+
+    Returns:
+    --------
+    query : str
+        TaQL query."""
+
+    if nspw > 1:
+        query = 'DATA_DESC_ID=={0}'.format(spw)
+    else:
+        query = ''
+    if field != '':
+        if query != '':
+            query += ' AND '
+        query += 'FIELD_ID == {0}'.format(field)
+    if antenna != '':
+        if query != '':
+            query += ' AND '
+        query += 'ANTENNA1 == {0}'.format(antenna)
+
+    return query
+
+def get_axis_chunk(axis,data,times,freqs,startchan):
+
+    """Extract axis from a chunk of data, broadcasting channel and time axes to the shape of the data (without copying them).
+
+    Arguments:
+    ----------
+    axis : str
+        Axis to extract ['Freq','Chan','Time','Amp','Phase','Real','Imag'].
+    data : Numpy array
+        Chunk of data with shape (corrs,chans,rows).
+    times : Numpy array
+        The timestamps associated with this chunk.
+    freqs : Numpy array
+        The channel frequencies of this spectral window, for extracting axis 'Freq'.
+    startchan : int
+        The starting channel, for extracting axis 'Chan'.
+
+    Returns:
+    --------
+    data : Numpy array
+        Axis values with the same shape as the data."""
+
+    if axis in ['Amplitude','Amp']:
+        return np.absolute(data)
+    elif axis == 'Phase':
+        return np.angle(data,deg=True)
+    elif axis in ['Imag','Imaginary']:
+        return np.imag(data)
+    elif axis == 'Real':
+        return np.real(data)
+    elif axis in ['Chan','Channel']:
+        vals = np.arange(startchan,startchan+data.shape[1])[None,:,None]
+    elif axis in ['Freq','Frequency']:
+        vals = freqs[None,:,None]
+    elif axis == 'Time':
+        vals = times[None,None,:]
+    else:
+        logger.error("Unknown axis - '{0}'".format(axis))
+        logger.error('Use one of the following: {0}'.format(['Freq','Chan','Time','Amp','Phase','Real','Imag']))
+        sys.exit(1)
+
+    return np.broadcast_to(vals,data.shape)
+
+def iter_chunks(sel,col,chunksize,readdata=True):
+
+    """Iterate over a table (selection) in chunks of rows, yielding data, flags and times.
+
+    Arguments:
+    ----------
+    sel : class ``table``
+        Table or selection (e.g. from tb.query).
+    col : str
+        Column of data to read.
+    chunksize : int
+        Number of rows to read at once.
+    readdata : bool, optional
+        Read the data column? Otherwise only the flags and times are read (data is returned as the flags).
+
+    Returns:
+    --------
+    chunk : tuple
+        Data, flags and times for this chunk of rows."""
+
+    nrows = sel.nrows()
+    for startrow in range(0,nrows,chunksize):
+        nrow = min(chunksize,nrows-startrow)
+        flags = sel.getcol('FLAG',startrow=startrow,nrow=nrow)
+        times = sel.getcol('TIME',startrow=startrow,nrow=nrow)
+        data = sel.getcol(col,startrow=startrow,nrow=nrow) if readdata else flags
+        yield data,flags,times
+
+def metadata_range(axis,nspw,field='',antenna='',freq_unit='MHz'):
+
+    """Return the range of a channel, frequency or time axis from the metadata (i.e. without reading the data), or None for a data axis.
+    Requires the table to be open (and msmd, for axis 'Freq').
+
+    Arguments:
+    ----------
+    axis : str
+        Axis to find the range of ['Freq','Chan','Time','Amp','Phase','Real','Imag'].
+    nspw : int
+        Number of spectral windows.
+    field : str, optional
+        Select this field.
+    antenna : str, optional
+        Select this antenna.
+    freq_unit : str, optional
+        The frequency unit, for axis 'Freq'.
+
+    Returns:
+    --------
+    range : tuple
+        Minimum and maximum of axis, or None."""
+
+    if axis in ['Chan','Channel']:
+        nchans = 0
+        for spw in range(nspw):
+            sel = tb.query(get_query(spw,nspw,field,antenna), columns='FLAG')
+            if sel.nrows() > 0:
+                nchans += sel.getcol('FLAG',startrow=0,nrow=1).shape[1]
+            sel.close()
+        return (0,nchans-1) if nchans > 0 else None
+    elif axis in ['Freq','Frequency']:
+        try:
+            freqs = np.concatenate([msmd.chanfreqs(spw,unit=freq_unit) for spw in range(nspw)])
+        except RuntimeError:
+            logger.error("Can't use 'Freq' for caltables. Use 'Chan'.")
+            sys.exit(1)
+        return np.min(freqs),np.max(freqs)
+    elif axis == 'Time':
+        sel = tb.query(get_query(0,1,field,antenna), columns='TIME')
+        times = sel.getcol('TIME') if sel.nrows() > 0 else np.array([])
+        sel.close()
+        return (np.min(times),np.max(times)) if times.size > 0 else None
+    return None
+
+def pad_range(low,high,log=False):
+
+    """Return a range padded to non-zero width (e.g. for a single channel or timestamp), so that it has distinct histogram edges."""
+
+    if low < high:
+        return low,high
+    if log:
+        return low/2,high*2
+    pad = 0.5 if low == 0 else abs(low)*1e-6
+    return low-pad,high+pad
+
+def density_plot(MS, nspw, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', freq_unit='MHz', fname='plot.png', logy=False, chunksize=CHUNKSIZE, bins=1000):
+
+    """Plot the density of data from a measurement set or calibration table, reading the data in chunks of rows
+    and accumulating a 2D histogram, so that memory use is bounded regardless of the size of the data. The range of
+    channel, frequency and time axes is taken from the metadata. If a data axis (e.g. 'Amp') is plotted, the data
+    are read twice, firstly to find its range.
+
+    Arguments:
+    ----------
+    MS : str
+        Path to measurement set or calibration table.
+    nspw : int
+        Number of spectral windows.
+    col : str, optional
+        Plot data of this column. Use 'DATA' for MS and 'CPARAM' for calibration table.
+    field : str, optional
+        Plot data for this field.
+    antenna : str, optional
+        Plot data for this antenna.
+    xaxis : str, optional
+        X-axis to plot ['Chan','Time','Amp','Phase','Real','Imag'].
+    yaxis : str, optional
+        Y-axis to plot ['Chan','Time','Amp','Phase','Real','Imag'].
+    fname : str, optional
+        Write plot with this filename.
+    logy : bool, optional
+        Log the y axis.
+    chunksize : int, optional
+        Number of rows to read at once.
+    bins : int, optional
+        Number of histogram bins along each axis."""
+
+    start = time.process_time()
+    readdata = xaxis in DATA_AXES or yaxis in DATA_AXES
+    tb.open(MS)
+
+    def chunks():
+
+        startchan = 0
+        for spw in range(nspw):
+            freqs = None
+            if 'Freq' in [xaxis,yaxis]:
+                try:
+                    freqs = msmd.chanfreqs(spw,unit=freq_unit)
+                except RuntimeError:
+                    logger.error("Can't use 'Freq' for caltables. Use 'Chan'.")
+                    sys.exit(1)
+            try:
+                sel = tb.query(get_query(spw,nspw,field,antenna), columns='{0},FLAG,TIME'.format(col))
+            except RuntimeError as e:
+                logger.info("Column '{0}' may not exist. Use 'CPARAM' for calibration tables and 'DATA' for MSs.".format(col))
+                logger.info(e)
+                sys.exit()
+            nchans = 0
+            for data,flags,times in iter_chunks(sel,col,chunksize,readdata):
+                nchans = data.shape[1]
+                x = get_axis_chunk(xaxis,data,times,freqs,startchan)
+                y = get_axis_chunk(yaxis,data,times,freqs,startchan)
+                yield x[~flags],y[~flags]
+            sel.close()
+            startchan += nchans
+
+    #Find range of each axis, from the metadata where possible, otherwise from a first pass over the data
+    xrange = metadata_range(xaxis,nspw,field,antenna,freq_unit)
+    yrange = metadata_range(yaxis,nspw,field,antenna,freq_unit)
+    if logy and yrange is not None and yrange[0] <= 0:
+        yrange = None
+
+    if xrange is not None and yrange is not None:
+        xmin,xmax = xrange
+        ymin,ymax = yrange
+    else:
+        xmin,xmax,ymin,ymax = np.inf,-np.inf,np.inf,-np.inf
+        for x,y in chunks():
+            if x.size > 0:
+                xmin,xmax = min(xmin,np.min(x)),max(xmax,np.max(x))
+                if logy:
+                    y = y[y > 0]
+                if y.size > 0:
+                    ymin,ymax = min(ymin,np.min(y)),max(ymax,np.max(y))
+        if xrange is not None:
+            xmin,xmax = xrange
+        if yrange is not None:
+            ymin,ymax = yrange
+
+    if not np.isfinite([xmin,xmax,ymin,ymax]).all():
+        logger.error("No unflagged data found to plot in '{0}'.".format(MS))
+        tb.close()
+        sys.exit(1)
+
+    xmin,xmax = pad_range(xmin,xmax)
+    ymin,ymax = pad_range(ymin,ymax,log=logy)
+
+    rangetime = time.process_time()
+    logger.info('Found x-axis range [{0}, {1}] and y-axis range [{2}, {3}] in {4:.0f} seconds.'.format(xmin,xmax,ymin,ymax,rangetime-start))
+
+    xedges = np.linspace(xmin,xmax,bins+1)
+    if logy:
+        yedges = np.geomspace(ymin,ymax,bins+1)
+    else:
+        yedges = np.linspace(ymin,ymax,bins+1)
+
+    #Accumulate 2D histogram over all chunks
+    density = np.zeros((bins,bins))
+    npoints = 0
+    for x,y in chunks():
+        density += np.histogram2d(x,y,bins=[xedges,yedges])[0]
+        npoints += x.size
+
+    tb.close()
+    if npoints == 0:
+        logger.error("No unflagged data found to plot in '{0}'.".format(MS))
+        sys.exit(1)
+
+    plottime = time.process_time()
+    logger.info('Binned {0} points in {1:.0f} seconds.'.format(npoints,plottime-rangetime))
+
+    fig = plt.figure(figsize=(15,12))
+    density = np.ma.masked_equal(density,0)
+    plt.pcolormesh(xedges,yedges,density.T,norm=LogNorm(),cmap='viridis')
+    plt.colorbar(label='Number of points')
+
+    if 'Freq' in xaxis:
+        xaxis += ' ({0})'.format(freq_unit)
+    if 'Amp' in yaxis:
+        yaxis += ' (Jy)'
+    plt.xlabel(xaxis)
+    plt.ylabel(yaxis)
+    if logy:
+        plt.yscale('log')
+
+    plt.savefig(fname)
+    savetime = time.process_time()
+    logger.info("Wrote figure '{0}' in {1:.0f} seconds.".format(fname,savetime - plottime))
+    plt.close()
+
+def fastplot(MS, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', freq_unit='MHz', fname='plot.png', logy=False, markersize=1, extent=0.1, stream=False, chunksize=CHUNKSIZE, bins=1000):
 
     """Plot data from a measurement set or calibration table.
 
@@ -100,7 +404,13 @@ def fastplot(MS, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', fr
     markersize : int, optional
         Use markers of this size.
     extent : float, optional
-        Scale the limits of the x-axis by this fraction its maximum value."""
+        Scale the limits of the x-axis by this fraction its maximum value.
+    stream : bool, optional
+        Read data in chunks and plot as a density (2D histogram), with bounded memory use.
+    chunksize : int, optional
+        Number of rows to read at once (for stream=True).
+    bins : int, optional
+        Number of histogram bins along each axis (for stream=True)."""
 
     ext = os.path.splitext(fname)[1]
     if ext in ['pdf','eps','ps']:
@@ -114,9 +424,14 @@ def fastplot(MS, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', fr
         nspw = 1
         col = 'CPARAM'
 
-    start = time.process_time()
     xaxis = xaxis.title()
     yaxis = yaxis.title()
+
+    if stream:
+        density_plot(MS, nspw, col=col, field=field, antenna=antenna, xaxis=xaxis, yaxis=yaxis, freq_unit=freq_unit, fname=fname, logy=logy, chunksize=chunksize, bins=bins)
+        return
+
+    start = time.process_time()
     startchan = 0
 
     fig = plt.figure(figsize=(15,12))
@@ -126,18 +441,7 @@ def fastplot(MS, col='DATA', field='', antenna='', xaxis='Chan', yaxis='Amp', fr
         spwstart = time.process_time()
 
         try:
-            if nspw > 1:
-                query = 'DATA_DESC_ID=={0}'.format(spw)
-            else:
-                query = ''
-            if field != '':
-                if query != '':
-                    query += ' AND '
-                query += 'FIELD_ID == {0}'.format(field)
-            if antenna != '':
-                if query != '':
-                    query += ' AND '
-                query += 'ANTENNA1 == {0}'.format(antenna)
+            query = get_query(spw,nspw,field,antenna)
             dat = tb.query(query, columns='{0},FLAG,TIME'.format(col))
             data = dat.getcol(col)
             nchans = data.shape[1]
@@ -223,6 +527,9 @@ def parse_args():
     parser.add_argument("-l","--logy", action="store_true", required=False, default=False, help="Log the y-axis? Default: False")
     parser.add_argument("-m","--markersize",metavar="size", required=False, default=1, type=int, help="Plot marker size. Default: 1")
     parser.add_argument("-e","--extent",metavar="extend", required=False, type=float, default=0.0, help="Scale the limits of the x-axis by this fraction its maximum value. Default: 0.0")
+    parser.add_argument("-s","--stream", action="store_true", required=False, default=False, help="Read data in chunks and plot density (2D histogram), using bounded memory. Default: False")
+    parser.add_argument("-n","--chunksize",metavar="rows", required=False, type=int, default=CHUNKSIZE, help="Number of rows to read at once when streaming. Default: {0}".format(CHUNKSIZE))
+    parser.add_argument("-b","--bins",metavar="bins", required=False, type=int, default=1000, help="Number of histogram bins along each axis when streaming. Default: 1000")
 
     args, unknown = parser.parse_known_args()
 
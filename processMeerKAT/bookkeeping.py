@@ -7,6 +7,9 @@ import sys
 import traceback
 
 import config_parser
+import ms_metadata
+import step_ledger
+import instrument
 from collections import namedtuple
 import os
 import glob
@@ -71,13 +74,10 @@ def get_field_ids(fields):
     return FieldIDs(targetfield, fluxfield, bpassfield, secondaryfield,
             kcorrfield, xdelfield, dpolfield, xpolfield, gainfields, extrafields)
 
-def polfield_name(visname):
+def polfield_name(visname, fieldnames=None):
 
-    from casatools import msmetadata
-    msmd = msmetadata()
-    msmd.open(visname)
-    fieldnames = msmd.fieldnames()
-    msmd.done()
+    if fieldnames is None:
+        fieldnames = ms_metadata.get(visname).fieldnames()
 
     polfield = ''
     if any([ff in ["3C286", "1328+307", "1331+305", "J1331+3030"] for ff in fieldnames]):
@@ -182,18 +182,11 @@ def get_selfcal_params():
 
 def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,outlier_threshold,outlier_radius,threshold,step):
 
-    from casatools import msmetadata,quanta
+    from casatools import quanta
     from read_ms import check_spw
-    msmd = msmetadata()
+    msmd = ms_metadata.get(vis)
     qa = quanta()
 
-    if os.path.exists('{0}/SUBMSS'.format(vis)):
-        tmpvis = glob.glob('{0}/SUBMSS/*'.format(vis))[0]
-    else:
-        tmpvis = vis
-
-    msmd.open(tmpvis)
-
     visbase = os.path.split(vis.rstrip('/ '))[1] # Get only vis name, not entire path
     visbase = re.sub('\.\d+\.*\d*\~\d+\.*\d*[a-z,A-Z]?[Hz,hz,hZ,HZ]*\.','.',visbase) # Strip any SPWs from basename (when running outlier imaging separately per SPW)
     targetfields = config_parser.get_key(config_parser.parse_args()['config'], 'fields', 'targetfields')
@@ -272,8 +265,6 @@ def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,o
         outlierfile = ''
         sky_model_radius = 0.0
 
-    msmd.done()
-
     if not (type(threshold[loop]) is str and 'Jy' in threshold[loop]) and threshold[loop] > 1:
         if step in ['tclean','predict']:
             if os.path.exists(rmsfile):
@@ -324,6 +315,42 @@ def get_imaging_params():
 
     return args,params
 
+def script_name(func):
+
+    """Return the name of the step run by func (i.e. its script without extension)."""
+
+    return os.path.splitext(os.path.basename(sys.modules[func.__module__].__file__))[0]
+
+def ledger_step(config, func):
+
+    """Return the step_ledger.Step of the script run by func, or None if the ledger can't be used (e.g. an unreadable config or data)."""
+
+    return ledger_call(step_ledger.Step, config, script_name(func))
+
+def ledger_call(method, *args, default=None):
+
+    """Call a step ledger method, logging a warning and returning None if it fails, so that the ledger never fails a step.
+
+    Arguments:
+    ----------
+    method : function
+        Step ledger method or class.
+    args : list
+        Arguments passed to method.
+    default : object, optional
+        Value returned if method raises an exception.
+
+    Returns:
+    --------
+    result : object
+        Return value of method, or default if it raised an exception."""
+
+    try:
+        return method(*args)
+    except Exception as err:
+        logger.warning("Couldn't use step ledger '{0}' ({1}: {2}). Running this step without skipping or recording it.".format(step_ledger.LEDGER,type(err).__name__,err))
+        return default
+
 def run_script(func,logfile=''):
 
     # Get the name of the config file
@@ -335,10 +362,24 @@ def run_script(func,logfile=''):
     continue_run = config_parser.validate_args(taskvals, 'run', 'continue', bool, default=True)
     spw = config_parser.validate_args(taskvals, 'crosscal', 'spw', str)
     nspw = config_parser.validate_args(taskvals, 'crosscal', 'nspw', int)
+    instrumented = config_parser.validate_args(taskvals, 'run', 'instrument', bool, default=False)
+    skip_completed = config_parser.validate_args(taskvals, 'run', 'skipcompleted', bool, default=True)
 
     if continue_run:
         try:
-            func(args,taskvals)
+            step = ledger_step(args['config'], func) if skip_completed else None
+            entry = None if step is None else ledger_call(step.completed)
+            #Skip this step if it already completed with the same config and data, restoring the config changes it made
+            if entry is not None and ledger_call(step.restore, entry, default=False) is not False:
+                logger.info("Step '{0}' already completed with the same config and data (according to '{1}'), so skipped it. Remove '{1}' or set 'skipcompleted = False' in [run] section of config to run all steps again.".format(step.name,step_ledger.LEDGER))
+            else:
+                #Optionally record the time and resources used by each CASA task called by this script
+                if instrumented:
+                    instrument.enable(sys.modules[func.__module__])
+                with instrument.section(script_name(func)):
+                    func(args,taskvals)
+                if step is not None:
+                    ledger_call(step.record)
             rename_logs(logfile)
         except Exception as err:
             logger.error('Exception found in the pipeline of type {0}: {1}'.format(type(err),err))
@@ -0,0 +1,281 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+import fcntl
+import hashlib
+import tempfile
+import shutil
+import numpy as np
+from astropy.io import fits
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Files written within index directory
+KEY_FILE = 'key.json'
+DEC_FILE = 'dec.npy'
+XYZ_FILE = 'xyz.npy'
+ROWS_FILE = 'rows.npy'
+
+#Directory of indexes of catalogues whose own directory isn't writable (e.g. within the pipeline installation)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'processMeerKAT')
+
+def parse_args():
+
+    """Parse arguments into this script.
+
+    Returns:
+    --------
+    args : class ``argparse.ArgumentParser``
+        Known and validated arguments."""
+
+    parser = argparse.ArgumentParser(prog=sys.argv[0],description='Build spatial index of a FITS source catalogue (e.g. RACS), for fast cone searches.')
+    parser.add_argument("catalog", help="Input FITS catalogue (may be gzipped).")
+    parser.add_argument("-r","--ra", default='ra', help="Name of RA column, in degrees [default: 'ra'].")
+    parser.add_argument("-d","--dec", default='dec', help="Name of Dec column, in degrees [default: 'dec'].")
+    parser.add_argument("-i","--index", default='', help="Output index directory [default: catalogue name with '.index' extension].")
+
+    args, unknown = parser.parse_known_args()
+
+    if len(unknown) > 0:
+        parser.error('Unknown input argument(s) present - {0}'.format(unknown))
+
+    return args
+
+def index_paths(catalog):
+
+    """Return the candidate paths of the index of a catalogue, in the order they are searched - next to the catalogue
+    (e.g. built by an administrator), then in the user's cache directory, named after the absolute path of the catalogue."""
+
+    base = catalog
+    for ext in ['.gz', '.fits']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    digest = hashlib.sha1(os.path.abspath(catalog).encode()).hexdigest()[:12]
+    return [base + '.index', os.path.join(CACHE_DIR, '{0}-{1}.index'.format(os.path.basename(base),digest))]
+
+def index_path(catalog):
+
+    """Return the default path of the index of a catalogue, which is stored next to the catalogue if its directory is writable, otherwise in the cache directory."""
+
+    paths = index_paths(catalog)
+    return paths[0] if os.access(os.path.dirname(os.path.abspath(catalog)), os.W_OK) else paths[1]
+
+def is_current(indexdir, catalog, racol='ra', deccol='dec'):
+
+    """Return whether an index exists and was built from the current version of a catalogue."""
+
+    keyfile = os.path.join(indexdir,KEY_FILE)
+    if not os.path.exists(keyfile):
+        return False
+    with open(keyfile) as f:
+        key = json.load(f)
+    current = catalog_key(catalog, racol, deccol)
+    return all([key.get(k) == current[k] for k in ['size', 'mtime', 'ra', 'dec']])
+
+def publish(tmpdir, indexdir):
+
+    """Atomically replace an index with a newly written directory, by swapping a symlink to it, so readers see either the old or new index."""
+
+    link = '{0}.link'.format(tmpdir)
+    os.symlink(os.path.basename(tmpdir), link)
+    old = os.path.realpath(indexdir) if os.path.islink(indexdir) else None
+    if os.path.isdir(indexdir) and not os.path.islink(indexdir): #Written by earlier versions
+        shutil.rmtree(indexdir)
+    os.replace(link, indexdir)
+    if old is not None and old != os.path.realpath(indexdir):
+        shutil.rmtree(old, ignore_errors=True)
+
+def catalog_key(catalog, racol, deccol):
+
+    """Return the key identifying the catalogue an index was built from."""
+
+    st = os.stat(catalog)
+    return {'catalog' : os.path.abspath(catalog), 'size' : st.st_size, 'mtime' : st.st_mtime_ns, 'ra' : racol, 'dec' : deccol}
+
+def unit_vectors(ra, dec):
+
+    """Return unit vectors (N x 3) for RA and Dec in degrees."""
+
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+def build_index(catalog, indexdir='', racol='ra', deccol='dec'):
+
+    """Build a spatial index of a FITS catalogue, as a directory of numpy arrays (which are memory-mapped when searched).
+    Rows are sorted by declination, so a cone search only reads the band of declination that overlaps the cone,
+    within which the angular separation is tested exactly using unit vectors.
+
+    Arguments:
+    ----------
+    catalog : str
+        Path to FITS catalogue (may be gzipped), with the table in the first extension.
+    indexdir : str, optional
+        Path to output index directory. Default is catalogue name with '.index' extension, next to the catalogue or in the cache directory.
+    racol : str, optional
+        Name of RA column (degrees).
+    deccol : str, optional
+        Name of Dec column (degrees).
+
+    Returns:
+    --------
+    indexdir : str
+        Path to index directory."""
+
+    if indexdir == '':
+        indexdir = index_path(catalog)
+
+    parent = os.path.dirname(os.path.abspath(indexdir))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    #Lock against concurrent builds, one of which may have completed while waiting for the lock
+    with open('{0}.lock'.format(indexdir), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if is_current(indexdir, catalog, racol, deccol):
+                logger.info("Spatial index '{0}' was built by another job.".format(indexdir))
+                return indexdir
+
+            logger.info("Building spatial index '{0}' of catalogue '{1}'.".format(indexdir,catalog))
+
+            with fits.open(catalog) as hdul:
+                rows = np.array(hdul[1].data)
+
+            order = np.argsort(rows[deccol], kind='stable')
+            rows = rows[order]
+
+            #Write to temporary directory and publish, so a partially written index is never used
+            tmpdir = tempfile.mkdtemp(prefix='.{0}.'.format(os.path.basename(indexdir)), dir=parent)
+            try:
+                np.save(os.path.join(tmpdir,DEC_FILE), rows[deccol].astype(float))
+                np.save(os.path.join(tmpdir,XYZ_FILE), unit_vectors(rows[racol], rows[deccol]))
+                np.save(os.path.join(tmpdir,ROWS_FILE), rows)
+                with open(os.path.join(tmpdir,KEY_FILE),'w') as f:
+                    json.dump(catalog_key(catalog, racol, deccol), f)
+                os.chmod(tmpdir, 0o775)
+                publish(tmpdir, indexdir)
+            except:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    logger.info("Indexed {0} sources.".format(rows.size))
+    return indexdir
+
+def get_index(catalog, racol='ra', deccol='dec'):
+
+    """Return the path of an up-to-date index of a catalogue, building it if it doesn't exist or is out of date.
+
+    Arguments:
+    ----------
+    catalog : str
+        Path to FITS catalogue.
+    racol : str, optional
+        Name of RA column (degrees).
+    deccol : str, optional
+        Name of Dec column (degrees).
+
+    Returns:
+    --------
+    indexdir : str
+        Path to index directory, or None if no index is up to date and one can't be written."""
+
+    for indexdir in index_paths(catalog):
+        if is_current(indexdir, catalog, racol, deccol):
+            return indexdir
+
+    indexdir = index_path(catalog)
+    try:
+        return build_index(catalog, indexdir, racol, deccol)
+    except (IOError, OSError) as err:
+        logger.warning("Can't write spatial index '{0}' ({1}). Build it with 'python {2} {3}'.".format(indexdir,err,__file__,catalog))
+        return None
+
+def cone_search(indexdir, ra, dec, radius):
+
+    """Return the catalogue rows within a radius of a position, using a spatial index.
+
+    Arguments:
+    ----------
+    indexdir : str
+        Path to index directory.
+    ra : float
+        RA of cone centre (degrees).
+    dec : float
+        Dec of cone centre (degrees).
+    radius : float
+        Radius of cone (degrees).
+
+    Returns:
+    --------
+    rows : class ``numpy.ndarray``
+        Structured array of catalogue rows within cone, in order of increasing declination."""
+
+    decs = np.load(os.path.join(indexdir,DEC_FILE), mmap_mode='r')
+    low = np.searchsorted(decs, dec - radius, side='left')
+    high = np.searchsorted(decs, dec + radius, side='right')
+
+    xyz = np.load(os.path.join(indexdir,XYZ_FILE), mmap_mode='r')[low:high]
+    centre = unit_vectors(ra, dec)
+    inside = np.flatnonzero(xyz.dot(centre) >= np.cos(np.deg2rad(radius)))
+
+    rows = np.load(os.path.join(indexdir,ROWS_FILE), mmap_mode='r')
+    return np.array(rows[low + inside])
+
+def write_cone(catalog, outfile, ra, dec, radius, racol='ra', deccol='dec'):
+
+    """Write the sources from a FITS catalogue within a radius of a position to a new FITS catalogue, using a spatial
+    index of the catalogue where possible, otherwise reading the entire catalogue.
+
+    Arguments:
+    ----------
+    catalog : str
+        Path to FITS catalogue.
+    outfile : str
+        Path to output FITS catalogue.
+    ra : float
+        RA of cone centre (degrees).
+    dec : float
+        Dec of cone centre (degrees).
+    radius : float
+        Radius of cone (degrees).
+    racol : str, optional
+        Name of RA column (degrees).
+    deccol : str, optional
+        Name of Dec column (degrees).
+
+    Returns:
+    --------
+    nsources : int
+        Number of sources written."""
+
+    indexdir = get_index(catalog, racol, deccol)
+
+    with fits.open(catalog) as hdul:
+        if indexdir is not None:
+            rows = cone_search(indexdir, ra, dec, radius)
+            hdu = fits.BinTableHDU(data=rows, header=hdul[1].header)
+        else:
+            data = hdul[1].data
+            inside = unit_vectors(data[racol], data[deccol]).dot(unit_vectors(ra, dec)) >= np.cos(np.deg2rad(radius))
+            hdu = fits.BinTableHDU(data=data[inside], header=hdul[1].header)
+        fits.HDUList([fits.PrimaryHDU(header=hdul[0].header), hdu]).writeto(outfile, overwrite=True)
+
+    return hdu.data.size
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    build_index(args.catalog, args.index, args.ra, args.dec)
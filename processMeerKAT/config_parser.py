@@ -6,7 +6,15 @@
 import argparse
 import configparser
 import ast
+import os
+import tempfile
+from copy import deepcopy
+from contextlib import contextmanager
 import processMeerKAT
+import freq_ranges
+
+#Cache of parsed config files, keyed by absolute path
+_CONFIGS = {}
 
 def parse_args():
     """
@@ -20,62 +28,260 @@ def parse_args():
     return vars(args)
 
 
-def parse_config(filename):
+def _evaluate(config, filename, sections=None):
     """
-    Given an input config file, parses it to extract key-value pairs that
-    should represent task parameters and values respectively.
+    Evaluate the options within each section of a ConfigParser object
+    to the right type(), returning a nested dictionary with tasknames
+    at the top level and parameter values one level down.
     """
 
-    config = configparser.SafeConfigParser(allow_no_value=True)
-    config.read(filename)
-
-    # Build a nested dictionary with tasknames at the top level
-    # and parameter values one level down.
     taskvals = dict()
-    for section in config.sections():
+    if sections is None:
+        sections = config.sections()
+
+    for section in sections:
 
         if section not in taskvals:
             taskvals[section] = dict()
 
         for option in config.options(section):
+            value = config.get(section, option)
+
+            # Section comments are stored without a value and are dropped when re-read from disk
+            if value is None and option[0] in '#;':
+                continue
+
             # Evaluate to the right type()
             try:
-                taskvals[section][option] = ast.literal_eval(config.get(section, option))
+                taskvals[section][option] = ast.literal_eval(value)
             except (ValueError,SyntaxError):
                 err = "Cannot format field '{0}' in config file '{1}'".format(option,filename)
-                err += ", which is currently set to {0}. Ensure strings are in 'quotes'.".format(config.get(section, option))
+                err += ", which is currently set to {0}. Ensure strings are in 'quotes'.".format(value)
                 raise ValueError(err)
 
-    return taskvals, config
+    return taskvals
+
+
+class PipelineConfig(object):
+
+    """In-memory copy of a config file, which is only parsed again when the file changes on disk (i.e. its inode, size
+    or modification time changes). Updates are written atomically (via a temporary file and rename), and are deferred
+    until the end of the outermost batch_update() context, so that many updates result in a single write.
+
+    Arguments:
+    ----------
+    filename : str
+        Path to config file."""
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.taskvals = {}
+        self.config = None
+        self.stat = None
+        self.depth = 0
+        self.dirty = False
+
+    def _stat(self):
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self):
+
+        """Parse the config file, if it has changed on disk since it was last parsed. Pending (unwritten) updates take precedence over the file on disk."""
+
+        if self.dirty:
+            return
+
+        stat = self._stat()
+        if self.config is None or stat != self.stat:
+            config = configparser.SafeConfigParser(allow_no_value=True)
+            config.read(self.filename)
+            self.taskvals = _evaluate(config, self.filename)
+            self.config = config
+            self.stat = stat
+
+    def update(self, section):
+
+        """Re-evaluate a section after it has been updated in memory, and write the config file unless within a batch.
+
+        Arguments:
+        ----------
+        section : str
+            Section of config that was updated."""
+
+        if self.config.has_section(section):
+            try:
+                self.taskvals.update(_evaluate(self.config, self.filename, sections=[section]))
+            except ValueError:
+                self.discard()
+                raise
+        else:
+            self.taskvals.pop(section, None)
+
+        self.dirty = True
+        if self.depth == 0:
+            self.write()
+
+    def discard(self):
+
+        """Discard any pending updates, forcing the config file to be parsed again on next access."""
+
+        self.dirty = False
+        self.config = None
+        self.stat = None
+
+    def write(self):
+
+        """Atomically write the config file from memory, by writing to a temporary file in the same directory and renaming it."""
+
+        path = os.path.abspath(self.filename)
+        if os.path.exists(path):
+            mode = os.stat(path).st_mode & 0o777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+
+        fd, tmp = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(path)), dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as config_file:
+                self.config.write(config_file)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+        self.dirty = False
+        self.stat = self._stat()
+
+def get_config(filename):
+
+    """Return the cached PipelineConfig object for a config file, parsing the file if it has changed since last accessed.
+
+    Arguments:
+    ----------
+    filename : str
+        Path to config file.
+
+    Returns:
+    --------
+    conf : class ``PipelineConfig``
+        In-memory config object."""
+
+    #Store absolute path, so the cached config remains valid if the working directory changes
+    key = os.path.abspath(filename)
+    if key not in _CONFIGS:
+        _CONFIGS[key] = PipelineConfig(key)
+
+    conf = _CONFIGS[key]
+    conf.load()
+    return conf
+
+@contextmanager
+def batch_update(filename):
+
+    """Context within which any updates to a config file (e.g. via overwrite_config) are made in memory,
+    and written with a single atomic write upon leaving the (outermost) context. If an exception is
+    raised within the context, the pending updates are discarded.
+
+    Arguments:
+    ----------
+    filename : str
+        Path to config file.
+
+    Returns:
+    --------
+    conf : class ``PipelineConfig``
+        In-memory config object."""
+
+    conf = get_config(filename)
+    conf.depth += 1
+    try:
+        yield conf
+    except:
+        conf.depth -= 1
+        conf.discard()
+        raise
+    else:
+        conf.depth -= 1
+        if conf.depth == 0 and conf.dirty:
+            conf.write()
+
+def flush(filename):
+
+    """Write any pending updates to a config file, e.g. before it is read by another process within a batch_update() context.
+
+    Arguments:
+    ----------
+    filename : str
+        Path to config file."""
+
+    conf = get_config(filename)
+    if conf.dirty:
+        conf.write()
+
+def parse_config(filename):
+    """
+    Given an input config file, parses it to extract key-value pairs that
+    should represent task parameters and values respectively.
+    """
+
+    # Return copies, since callers are free to modify these (e.g. validate_args pops keys)
+    conf = get_config(filename)
+    return deepcopy(conf.taskvals), deepcopy(conf.config)
+
+def copy_config(filename, newfilename):
+
+    """Copy a config file to a new path, using the in-memory copy of the config file rather than parsing it again.
+    Written immediately, unless within a batch_update() context for the new path.
+
+    Arguments:
+    ----------
+    filename : str
+        Path to config file to copy.
+    newfilename : str
+        Path to new config file."""
+
+    conf = get_config(filename)
+    newconf = get_config(newfilename)
+    newconf.config = deepcopy(conf.config)
+    newconf.taskvals = deepcopy(conf.taskvals)
+    newconf.dirty = True
+    if newconf.depth == 0:
+        newconf.write()
 
 def has_key(filename, section, key):
-    config_dict,config = parse_config(filename)
-    if has_section(filename, section) and key in config_dict[section]:
+    config_dict = get_config(filename).taskvals
+    if section in config_dict and key in config_dict[section]:
         return True
     return False
 
 def has_section(filename, section):
 
-    config_dict,config = parse_config(filename)
-    return section in config_dict
+    return section in get_config(filename).taskvals
 
 def get_key(filename, section, key):
-    config_dict,config = parse_config(filename)
-    if has_key(filename, section, key):
-        return config_dict[section][key]
+    config_dict = get_config(filename).taskvals
+    if section in config_dict and key in config_dict[section]:
+        return deepcopy(config_dict[section][key])
     return ''
 
 def remove_section(filename, section):
 
-    config_dict,config = parse_config(filename)
-    config.remove_section(section)
-    config_file = open(filename, 'w')
-    config.write(config_file)
-    config_file.close()
+    conf = get_config(filename)
+    conf.config.remove_section(section)
+    conf.update(section)
 
 def overwrite_config(filename, conf_dict={}, conf_sec='', sec_comment=''):
 
-    config_dict,config = parse_config(filename)
+    conf = get_config(filename)
+    config = conf.config
 
     if conf_sec not in config.sections():
         processMeerKAT.logger.debug('Writing [{0}] section in config file "{1}" with:\n{2}.'.format(conf_sec,filename,conf_dict))
@@ -89,13 +295,11 @@ def overwrite_config(filename, conf_dict={}, conf_sec='', sec_comment=''):
     for key in conf_dict.keys():
         config.set(conf_sec, key, str(conf_dict[key]))
 
-    config_file = open(filename, 'w')
-    config.write(config_file)
-    config_file.close()
+    conf.update(conf_sec)
 
 def parse_spw(filename):
 
-    config_dict,config = parse_config(filename)
+    config_dict = get_config(filename).taskvals
     spw = config_dict['crosscal']['spw']
     nspw = config_dict['crosscal']['nspw']
 
@@ -103,7 +307,7 @@ def parse_spw(filename):
         SPWs = spw.split(',')
         low,high,unit,dirs = [0]*len(SPWs),[0]*len(SPWs),['']*len(SPWs),['']*len(SPWs)
         for i,SPW in enumerate(SPWs):
-            low[i],high[i],unit[i],func = processMeerKAT.get_spw_bounds(SPW)
+            low[i],high[i],unit[i],func = freq_ranges.get_spw_bounds(SPW)
             dirs[i] = '{0}~{1}{2}'.format(low[i],high[i],unit[i])
 
         lowest = min(low)
@@ -115,7 +319,7 @@ def parse_spw(filename):
         #     dirs = '*{0}'.format(unit)
 
     else:
-        low,high,unit,func = processMeerKAT.get_spw_bounds(spw)
+        low,high,unit,func = freq_ranges.get_spw_bounds(spw)
         dirs = []
 
     return low,high,unit,dirs
@@ -7,6 +7,8 @@ Calculates the reference antenna
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import ms_metadata
+import instrument
 
 import os
 import numpy as np
@@ -14,8 +16,7 @@ import numpy as np
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata,table
-msmd = msmetadata()
+from casatools import table
 tb = table()
 
 import logging
@@ -24,42 +25,107 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
-def get_ref_ant(visname, fluxfield):
+#Number of rows to read at once when accumulating flag statistics
+CHUNKSIZE = 100000
+
+def get_flag_stats(visname, field, nants, chunksize=CHUNKSIZE, rowincr=1, chanincr=1):
+
+    """Count the flagged and total number of visibilities per antenna for a given field, in a single chunked
+    pass over the ANTENNA1, ANTENNA2 and FLAG columns of each data description. Both ends of each baseline are counted.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    field : int
+        Field ID.
+    nants : int
+        Number of antennas (i.e. length of the output arrays).
+    chunksize : int, optional
+        Maximum number of rows to read at once.
+    rowincr : int, optional
+        Only read every nth row (subsample in time/baseline).
+    chanincr : int, optional
+        Only read every nth channel (subsample in frequency).
+
+    Returns:
+    --------
+    flagged : array
+        Number of flagged visibilities per antenna.
+    total : array
+        Total number of visibilities per antenna."""
+
+    flagged = np.zeros(nants)
+    total = np.zeros(nants)
+
+    #Each data description (e.g. each good channel range partitioned) may have a different number of channels, so read each separately
+    tb.open(os.path.join(visname, 'DATA_DESCRIPTION'))
+    nddids = tb.nrows()
+    tb.close()
+
+    tb.open(visname)
+    for ddid in range(nddids):
+        sel = tb.query('FIELD_ID=={0} && DATA_DESC_ID=={1}'.format(field,ddid), columns='ANTENNA1,ANTENNA2,FLAG')
+        nrows = sel.nrows()
+
+        #Each chunk reads up to chunksize rows, spanning chunksize*rowincr rows of the selection
+        for startrow in range(0, nrows, chunksize*rowincr):
+            nrow = min(chunksize, (nrows - startrow - 1)//rowincr + 1)
+            ant1 = sel.getcol('ANTENNA1', startrow=startrow, nrow=nrow, rowincr=rowincr)
+            ant2 = sel.getcol('ANTENNA2', startrow=startrow, nrow=nrow, rowincr=rowincr)
+            flags = sel.getcolslice('FLAG', blc=[0,0], trc=[-1,-1], incr=[1,chanincr], startrow=startrow, nrow=nrow, rowincr=rowincr)
+
+            #Flags have shape (corrs, chans, rows)
+            nflagged = np.count_nonzero(flags, axis=(0,1))
+            nvis = np.full(nflagged.shape, flags.shape[0]*flags.shape[1])
+
+            #Don't count autocorrelations twice
+            cross = ant1 != ant2
+            flagged += np.bincount(ant1, weights=nflagged, minlength=nants)[:nants]
+            flagged += np.bincount(ant2[cross], weights=nflagged[cross], minlength=nants)[:nants]
+            total += np.bincount(ant1, weights=nvis, minlength=nants)[:nants]
+            total += np.bincount(ant2[cross], weights=nvis[cross], minlength=nants)[:nants]
+
+        sel.close()
+    tb.close()
+
+    return flagged, total
 
-    msmd.open(visname)
+def get_ref_ant(visname, fluxfield, chunksize=CHUNKSIZE, rowincr=1, chanincr=1):
+
+    msmd = ms_metadata.get(visname)
     if type(fluxfield) is str:
         fluxfield = msmd.fieldsforname(fluxfield)[0]
     fluxscans = msmd.scansforfield(int(fluxfield))
     logger.info("Flux field scan no: %d" % fluxscans[0])
     antennas = msmd.antennasforscan(fluxscans[0])
+    nants = msmd.nantennas()
 
     header = '{0: <3} {1: <4}'.format('ant', 'flags')
     logger.info("Antenna statistics on total flux calibrator")
     logger.info(header)
 
-    tb.open(visname)
+    with instrument.section('get_flag_stats', vis=visname, field=int(fluxfield), chunksize=chunksize, rowincr=rowincr, chanincr=chanincr):
+        flagged, total = get_flag_stats(visname, int(fluxfield), nants, chunksize=chunksize, rowincr=rowincr, chanincr=chanincr)
 
     fptr = open('ant_stats.txt', 'w')
     fptr.write(header + '\n')
 
     antflags = []
     for ant in antennas:
-        antdat = tb.query('ANTENNA1==%d AND FIELD_ID==%d' % (ant, int(fluxfield))).getcol('FLAG')
-
-        if antdat.size == 0:
+        if total[ant] == 0:
             flags = 1
             fptr.write('{0: <3} {1:.4f}\n'.format(ant, np.nan))
             logger.info('{0: <3} {1:.4f}'.format(ant, np.nan))
             antflags.append(flags)
             continue
 
-        flags = np.count_nonzero(antdat)/float(antdat.size)
+        flags = flagged[ant]/total[ant]
 
         fptr.write('{0: <3} {1:.4f}\n'.format(ant, flags))
         logger.info('{0: <3} {1:.4f}'.format(ant, flags))
         antflags.append(flags)
 
-    tb.close()
     tb.done()
     fptr.close()
 
@@ -75,7 +141,6 @@ def get_ref_ant(visname, fluxfield):
     logger.info("setting reference antenna to: %s" % referenceant)
 
     logger.info("Bad antennas: {0}".format(badants))
-    msmd.done()
 
     return referenceant, badants
 
@@ -86,6 +151,8 @@ def main(args,taskvals):
     calcrefant = va(taskvals, 'crosscal', 'calcrefant', bool)
     spw = va(taskvals, 'crosscal', 'spw', str)
     nspw = va(taskvals, 'crosscal', 'nspw', int)
+    rowincr = va(taskvals, 'crosscal', 'rowincr', int, default=1)
+    chanincr = va(taskvals, 'crosscal', 'chanincr', int, default=1)
 
     # Calculate reference antenna
     if calcrefant:
@@ -94,19 +161,16 @@ def main(args,taskvals):
         else:
             field = fields.fluxfield
 
-        refant, badants = get_ref_ant(visname, field)
+        refant, badants = get_ref_ant(visname, field, rowincr=max(rowincr,1), chanincr=max(chanincr,1))
         # Overwrite config file with new refant
-        config_parser.overwrite_config(args['config'], conf_sec='crosscal', conf_dict={'refant' : "'{0}'".format(refant)})
-        config_parser.overwrite_config(args['config'], conf_sec='crosscal', conf_dict={'badants' : badants})
+        config_parser.overwrite_config(args['config'], conf_sec='crosscal', conf_dict={'refant' : "'{0}'".format(refant), 'badants' : badants})
 
         #Replace reference antenna in each SPW config
         if nspw > 1:
             for SPW in spw.split(','):
                 spw_config = '{0}/{1}'.format(SPW.replace('*:',''),args['config'])
                 # Overwrite config file with new refant
-                config_parser.overwrite_config(spw_config, conf_sec='crosscal', conf_dict={'refant' : "'{0}'".format(refant)})
-                config_parser.overwrite_config(spw_config, conf_sec='crosscal', conf_dict={'badants' : badants})
-                config_parser.overwrite_config(spw_config, conf_sec='crosscal', conf_dict={'calcrefant' : False})
+                config_parser.overwrite_config(spw_config, conf_sec='crosscal', conf_dict={'refant' : "'{0}'".format(refant), 'badants' : badants, 'calcrefant' : False})
     else:
         logger.info("Skipping calculation of reference antenna, as 'calcrefant=False' in '{0}'.".format(args['config']))
 
@@ -7,56 +7,40 @@ import os
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import flag_strategy
+import ms_metadata
+import freq_ranges
 
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
 import casampi
 
-def do_pre_flag(visname, fields, badfreqranges, badants):
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
-    clip = [0., 50.]
+def do_pre_flag(visname, fields, badfreqranges, badants, strategy):
 
-    if len(badfreqranges):
-        badspw = '*:' + ',*:'.join(badfreqranges)
-        flagdata(vis=visname, mode='manual', spw=badspw)
+    #Bad frequency ranges are excised at partition, so only flag those that still overlap channels in this MS (comparing both in MHz)
+    msmd = ms_metadata.get(visname)
+    freqs = [freq for spw in range(msmd.nspw()) for freq in msmd.chanfreqs(spw, 'MHz')]
+    overlapping = []
+    for freqrange in badfreqranges:
+        bounds = freq_ranges.range_mhz(freqrange)
+        if bounds is None or any([bounds[0] <= freq <= bounds[1] for freq in freqs]):
+            overlapping.append(freqrange)
+    badfreqranges = overlapping
 
-    if len(badants):
-        badants = ",".join([str(bb) for bb in badants])
-        flagdata(vis=visname, mode='manual', antenna=badants)
+    #Compile all flagging into one list, applied in a single pass over the data, with a single flag backup
+    commands = flag_strategy.manual_commands(badfreqranges, badants)
+    commands += flag_strategy.compile_commands(strategy, fields)
 
-    flagdata(vis=visname, mode='manual', autocorr=True, action='apply',
-            flagbackup=True, savepars=False, writeflags=True)
-
-    #Manually clip all fields in config
-    allfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.targetfield] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
-
-    flagdata(vis=visname, mode="clip", field=allfields,
-            clipminmax=clip, datacolumn="DATA",clipoutside=True,
-            clipzeros=True, extendpols=True, action="apply",flagbackup=True,
-            savepars=False, overwrite=True, writeflags=True)
-
-    #tfcrop calfields and targetfield with different cutoffs / fits
-    calfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
-
-    flagdata(vis=visname, mode='tfcrop', field=calfields,
-            ntime='scan', timecutoff=5.0, freqcutoff=5.0, timefit='line',
-            freqfit='line', extendflags=False, timedevscale=5., freqdevscale=5.,
-            extendpols=True, growaround=False, action='apply', flagbackup=True,
-            overwrite=True, writeflags=True, datacolumn='DATA')
-
-    flagdata(vis=visname, mode='tfcrop', field=fields.targetfield,
-            ntime='scan', timecutoff=6.0, freqcutoff=6.0, timefit='poly',
-            freqfit='poly', extendflags=False, timedevscale=5., freqdevscale=5.,
-            extendpols=True, growaround=False, action='apply', flagbackup=True,
-            overwrite=True, writeflags=True, datacolumn='DATA')
-
-    # Conservatively extend flags for all fields in config
-    flagdata(vis=visname, mode='extend', field=allfields,
-            datacolumn='data', clipzeros=True, ntime='scan', extendflags=False,
-            extendpols=True, growtime=80., growfreq=80., growaround=False,
-            flagneartime=False, flagnearfreq=False, action='apply',
-            flagbackup=True, overwrite=True, writeflags=True)
+    logger.info('Applying {0} flagging commands in a single pass:\n\t{1}'.format(len(commands),'\n\t'.join(commands)))
+    flagdata(vis=visname, mode='list', inpfile=commands, action='apply', flagbackup=True,
+            savepars=False, writeflags=True)
 
     flagdata(vis=visname, mode='summary', datacolumn='DATA',
             name=visname+'.flag.summary')
@@ -70,8 +54,9 @@ def main(args,taskvals):
 
     calfiles, caldir = bookkeeping.bookkeeping(visname)
     fields = bookkeeping.get_field_ids(taskvals['fields'])
+    strategy = flag_strategy.get_strategy(taskvals, 'round_1')
 
-    do_pre_flag(visname, fields, badfreqranges, badants)
+    do_pre_flag(visname, fields, badfreqranges, badants, strategy)
 
 if __name__ == '__main__':
 
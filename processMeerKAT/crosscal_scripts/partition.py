@@ -11,27 +11,72 @@ import config_parser
 from config_parser import validate_args as va
 import read_ms
 import processMeerKAT
+import freq_ranges
 import bookkeeping
+import ms_metadata
+import resources
 
 from casatasks import *
 logfile=casalog.logfile()
-from casatools import msmetadata
 import casampi
-msmd = msmetadata()
 
-def do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname):
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+def mms_layout(visname, spw, preavg, nworkers, createmms):
+
+    """Return the separation axis and number of sub-MSs of the output MMS, planned from the scans of the input MS and the number
+    of MPI processes of the jobs that read it (or a single sub-MS if not creating an MMS). The MMS is separated by scan, unless
+    it has too few or too uneven scans for the processes, in which case it's separated by baseline into evenly sized sub-MSs.
+
+    Arguments:
+    ----------
+    visname : str
+        Input MeasurementSet.
+    spw : str
+        SPW(s) partitioned.
+    preavg : int
+        Number of channels averaged.
+    nworkers : int
+        Number of MPI processes that work on sub-MSs.
+    createmms : bool
+        Create MMS (True) or MS (False)?
+
+    Returns:
+    --------
+    separationaxis : str
+        Axis by which the MMS is separated.
+    numsubms : int
+        Number of sub-MSs."""
+
+    if not createmms:
+        return 'scan', 1
+
+    shape = resources.vis_shape(visname, spw)
+    nchan = None if shape is None else shape['nchan'] * len(spw.split(',')) // preavg
+    layout = resources.mms_layout(shape, nworkers, nchan)
+    if layout is None:
+        return 'scan', ms_metadata.get(visname).nscans()
+
+    logger.info("Separating MMS by {separationaxis} into {numsubms} sub-MSs, with a parallel efficiency of {efficiency:.0%} over {0} MPI processes.".format(nworkers,**layout))
+    return layout['separationaxis'], layout['numsubms']
+
+def do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname, nworkers=1):
     # Get the .ms bit of the filename, case independent
     basename, ext = os.path.splitext(visname)
     filebase = os.path.split(basename)[1]
     extn = 'mms' if createmms else 'ms'
 
     mvis = '{0}.{1}.{2}'.format(filebase,spwname,extn)
-    nscan = 1 if not createmms else msmd.nscans()
+    separationaxis, numsubms = mms_layout(visname, spw, preavg, nworkers, createmms)
     chanaverage = True if preavg > 1 else False
     correlation = '' if include_crosshand else 'XX,YY'
 
     mstransform(vis=visname, outputvis=mvis, spw=spw, createmms=createmms, datacolumn='DATA', chanaverage=chanaverage, chanbin=preavg,
-                numsubms=nscan, separationaxis='scan', keepflags=True, usewtspectrum=True, nthreads=CPUs, antenna='*&', correlation=correlation)
+                numsubms=numsubms, separationaxis=separationaxis, keepflags=True, usewtspectrum=True, nthreads=CPUs, antenna='*&', correlation=correlation)
 
     return mvis
 
@@ -42,10 +87,12 @@ def main(args,taskvals):
     refant = va(taskvals, 'crosscal', 'refant', str, default='m005')
     spw = va(taskvals, 'crosscal', 'spw', str, default='')
     nspw = va(taskvals, 'crosscal', 'nspw', int, default='')
+    nodes = va(taskvals, 'slurm', 'nodes', int)
     tasks = va(taskvals, 'slurm', 'ntasks_per_node', int)
     preavg = va(taskvals, 'crosscal', 'chanbin', int, default=1)
     include_crosshand = va(taskvals, 'run', 'dopol', bool, default=False)
     createmms = va(taskvals, 'crosscal', 'createmms', bool, default=True)
+    badfreqranges = taskvals['crosscal'].get('badfreqranges', [])
 
     if nspw > 1:
         casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_ARRAY_JOB_ID}_{SLURM_ARRAY_TASK_ID}.casa'.format(**os.environ))
@@ -59,20 +106,22 @@ def main(args,taskvals):
     else:
         spwname = spw.replace('*:','')
 
-    msmd.open(visname)
-    npol = msmd.ncorrforpol()[0]
+    npol = ms_metadata.get(visname).ncorrforpol()[0]
 
     if not include_crosshand and npol == 4:
         npol = 2
     CPUs = npol if tasks*npol <= processMeerKAT.CPUS_PER_NODE_LIMIT else 1 #hard-code for number of polarisations
+    nworkers = nodes*tasks - 1 #MPI processes other than the client, for the jobs that read the MMS
 
-    mvis = do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname)
+    #Only partition the good channel ranges, so bad frequency ranges are never read or written by later steps
+    mvis = do_partition(visname, freq_ranges.excise_spw(spw, badfreqranges), preavg, CPUs, include_crosshand, createmms, spwname, nworkers)
+    ms_metadata.write(mvis)
     mvis = "'{0}'".format(mvis)
     vis = "'{0}'".format(visname)
 
-    config_parser.overwrite_config(args['config'], conf_sec='data', conf_dict={'vis':mvis})
-    config_parser.overwrite_config(args['config'], conf_sec='run', sec_comment='# Internal variables for pipeline execution', conf_dict={'orig_vis':vis})
-    msmd.done()
+    with config_parser.batch_update(args['config']):
+        config_parser.overwrite_config(args['config'], conf_sec='data', conf_dict={'vis':mvis})
+        config_parser.overwrite_config(args['config'], conf_sec='run', sec_comment='# Internal variables for pipeline execution', conf_dict={'orig_vis':vis})
 
 if __name__ == '__main__':
 
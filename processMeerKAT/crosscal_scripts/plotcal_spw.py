@@ -16,14 +16,14 @@ import numpy as np
 
 from config_parser import validate_args as va
 import bookkeeping
+import instrument
 import glob
 PLOT_DIR = 'plots'
 EXTN = 'png'
 
 from casatasks import *
-from casatools import table,msmetadata
+from casatools import table
 tb = table()
-msmd = msmetadata()
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
 
@@ -33,207 +33,273 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
-def avg_ants(arrlist):
-    return [np.mean(arr, axis=-1) for arr in arrlist]
+#Caltables read in this process, keyed by path
+_CALTABLES = {}
+#Data of each SPW of a caltable cached alongside it
+CACHED_KEYS = ['nant','field','time','chanfreq','param']
 
+def find_caltables(dirs, caldir, table_ext):
 
-def lengthen(edat, inpdat):
-    """
-    Tries to extend, if that fails it appends
-    """
-
-    try:
-        edat.extend(inpdat)
-    except TypeError:
-        edat.append(inpdat)
-
-    return edat
-
+    """Find caltables with a given extension within each SPW directory.
 
+    Arguments:
+    ----------
+    dirs : list
+        SPW directories.
+    caldir : str
+        Directory containing caltables within each SPW directory.
+    table_ext : str
+        Caltable extension (e.g. 'bcal').
 
-def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=None, ylim=None):
-    # Check plotstr and ant
-    if not any([plotstr in ss for ss in ['amp,time', 'phase,time', 'amp,freq', 'phase,freq', 'delay,freq', 'imag,real']]):
-        raise ValueError("Invalid plotstr.")
-
+    Returns:
+    --------
+    tables : list
+        Paths to caltables."""
 
     tables = []
-    cwd = os.getcwd()
     for dd in dirs:
         tmpdir = os.path.join(dd, caldir)
         if not os.path.exists(tmpdir):
             logger.warning("Path {} not found. Skipping.".format(tmpdir))
+            continue
 
-        os.chdir(tmpdir)
-        tmp = glob.glob("*.{}".format(table_ext))
-        tables.extend([os.path.join(tmpdir, tt) for tt in tmp if os.path.exists(tt)])
-        os.chdir(cwd)
+        tables.extend(glob.glob(os.path.join(tmpdir, "*.{}".format(table_ext))))
 
-    if len(tables) == 0:
-        logger.warning("No valid caltables with extention {} found.".format(table_ext))
-        logger.warning("Skipping.")
-        return
-
-    xdat = []
-    xdaty = [] # Only used when plotting real
-    ydatx = []
-    ydaty = []
-    fields = []
+    return tables
 
-    xstr = plotstr.split(',')[1]
-    ystr = plotstr.split(',')[0]
-    do_field_sel = False
-    field = 0
+def caltable_fieldnames(dirs, caldir):
 
+    """Return the field names of the MS that caltables were solved from, read from the FIELD subtable of the first caltable found,
+    so that plots don't depend on the top-level config being updated (e.g. by concat, which runs at the same time).
 
-    for tt in tables:
-        tb.open(tt+'/ANTENNA')
-        ant_name = tb.getcol('NAME')
-        tb.close()
+    Arguments:
+    ----------
+    dirs : list
+        SPW directories.
+    caldir : str
+        Directory containing caltables within each SPW directory.
 
-        nant = ant_name.size
+    Returns:
+    --------
+    fieldnames : list
+        Field names, indexed by field ID."""
 
-        tb.open(tt)
-        field = tb.getcol('FIELD_ID')
-        if np.unique(field).size == 1:
-            do_field_sel = False
+    tables = [tt for tt in find_caltables(dirs, caldir, '*') if os.path.isdir(tt)]
+    if len(tables) == 0:
+        raise IOError("No caltables found in '{0}' within SPW directories {1}.".format(caldir,dirs))
+
+    tb.open(tables[0]+'/FIELD')
+    fieldnames = list(tb.getcol('NAME'))
+    tb.close()
+    return fieldnames
+
+def caltable_mtime(caltable):
+
+    """Return the latest modification time (ns) of the files in a caltable."""
+
+    return max([entry.stat().st_mtime_ns for entry in os.scandir(caltable)])
+
+def read_caltable(caltable):
+
+    """Read the columns of a caltable needed for plotting, separately for each SPW (e.g. each good channel range partitioned).
+
+    Arguments:
+    ----------
+    caltable : str
+        Path to caltable.
+
+    Returns:
+    --------
+    data : list
+        Dictionary for each SPW with solutions, containing
+        nant : Number of antennas.
+        field : Field ID of each row.
+        time : Time of each row.
+        chanfreq : Channel frequencies (MHz).
+        param : CPARAM (or FPARAM) column, with shape (npol, nchan, nrows)."""
+
+    tb.open(caltable+'/ANTENNA')
+    nant = tb.nrows()
+    tb.close()
+
+    #SPWs may have different numbers of channels, so read the frequencies of each separately
+    tb.open(caltable+'/SPECTRAL_WINDOW')
+    chanfreqs = [tb.getcell('CHAN_FREQ', spw).reshape(-1)/1E6 for spw in range(tb.nrows())]
+    tb.close()
+
+    data = []
+    tb.open(caltable)
+    column = 'CPARAM' if 'CPARAM' in tb.colnames() else 'FPARAM'
+    for spw,chanfreq in enumerate(chanfreqs):
+        sub = tb.query('SPECTRAL_WINDOW_ID=={0}'.format(spw))
+        if sub.nrows() > 0:
+            data.append({'nant' : nant, 'field' : sub.getcol('FIELD_ID'), 'time' : sub.getcol('TIME'), 'chanfreq' : chanfreq, 'param' : sub.getcol(column)})
+        sub.close()
+    tb.close()
+
+    return data
+
+def load_caltable(caltable):
+
+    """Return the data of a caltable needed for plotting, from a cache (npz file alongside the caltable) if it's up to date,
+    otherwise reading the caltable and writing the cache.
+
+    Arguments:
+    ----------
+    caltable : str
+        Path to caltable.
+
+    Returns:
+    --------
+    data : list
+        Data of each SPW returned by read_caltable()."""
+
+    mtime = caltable_mtime(caltable)
+    if caltable in _CALTABLES and _CALTABLES[caltable][0] == mtime:
+        return _CALTABLES[caltable][1]
+
+    #Each array of each SPW is stored as '{key}_{spw}', with the number of SPWs ('nspw'), which caches written by earlier versions don't have
+    cache = '{0}.npz'.format(caltable)
+    data = None
+    if os.path.exists(cache):
+        with np.load(cache) as npz:
+            if int(npz['mtime']) == mtime and 'nspw' in npz.files:
+                data = [{key : npz['{0}_{1}'.format(key,spw)] for key in CACHED_KEYS} for spw in range(int(npz['nspw']))]
+
+    if data is None:
+        data = read_caltable(caltable)
+        try:
+            np.savez(cache, mtime=mtime, nspw=len(data), **{'{0}_{1}'.format(key,spw) : spwdata[key] for spw,spwdata in enumerate(data) for key in CACHED_KEYS})
+        except OSError as err:
+            logger.warning("Couldn't write cache '{0}' of caltable '{1}': {2}".format(cache,caltable,err))
+
+    _CALTABLES[caltable] = (mtime, data)
+    return data
+
+def get_plot_data(plotstr, field_id, caltables):
+
+    """Aggregate the antenna-averaged solutions of all caltables for a plot, into preallocated arrays.
+
+    Arguments:
+    ----------
+    plotstr : str
+        Y and X axis to plot (e.g. 'amp,time').
+    field_id : int
+        Field ID to select (within each caltable with more than one field).
+    caltables : list
+        List of caltable data of each SPW, as returned by load_caltable().
+
+    Returns:
+    --------
+    xdat, xdaty, ydatx, ydaty : class ``numpy.ndarray``
+        X data (X and Y pol for 'real') and Y data (X and Y pol).
+    npol : int
+        Number of polarisations.
+    field_id : int
+        Field ID plotted."""
+
+    xstr = plotstr.split(',')[1].lower()
+    ystr = plotstr.split(',')[0].lower()
+
+    #Select rows of the field within each caltable that has more than one field, and polarisations
+    selected = []
+    nselected = 0
+    for data in caltables:
+        param = data['param']
+        rows = slice(None)
+        if np.unique(data['field']).size > 1:
+            rows = np.flatnonzero(data['field'] == field_id)
+            param = param[:, :, rows]
+            nselected += 1
+        npol = param.shape[0]
+        datx = param[0]
+        daty = param[-1] if npol > 1 else np.zeros_like(datx)
+        selected.append((data, datx, daty, data['time'][rows]))
+
+    if nselected == 0:
+        logger.warning("No field selection performed. Only one field present in each caltable")
+        field_id = np.unique(caltables[-1]['field'])[0]
+
+    if 'amp' in ystr:
+        yfunc = np.abs
+    elif 'phase' in ystr:
+        yfunc = lambda dat: np.rad2deg(np.angle(dat))
+    elif 'imag' in ystr:
+        yfunc = np.imag
+    elif 'delay' in ystr:
+        yfunc = lambda dat: dat
+    else:
+        raise ValueError("Unknown option {}".format(ystr))
+
+    if 'freq' in xstr:
+        #One point per channel, averaged over antennas
+        sizes = [datx.shape[0] for data,datx,daty,time in selected]
+    elif 'time' in xstr or 'real' in xstr:
+        #One point per time, averaged over antennas
+        sizes = [datx.shape[-1] // data['nant'] for data,datx,daty,time in selected]
+    else:
+        # This should never happen
+        raise ValueError("Unknown option {}.".format(xstr))
+
+    npts = sum(sizes)
+    xdat = np.empty(npts)
+    xdaty = np.empty(npts) # Only used when plotting real
+    ydatx = np.empty(npts)
+    ydaty = np.empty(npts)
+
+    start = 0
+    for (data,datx,daty,time),size in zip(selected,sizes):
+        end = start + size
+
+        if 'freq' in xstr:
+            xdat[start:end] = data['chanfreq']
+            ydatx[start:end] = np.mean(yfunc(datx), axis=-1)
+            ydaty[start:end] = np.mean(yfunc(daty), axis=-1)
         else:
-            do_field_sel = True
-            fields.append(field)
-
-        tb.close()
-
-        if 'freq' in xstr.lower():
-            tb.open(tt+'/SPECTRAL_WINDOW')
-            chanfreq = np.squeeze(tb.getcol('CHAN_FREQ'))/1E6
-            tb.close()
-            xlabel = 'Frequency (MHz)'
-
-            if 'delay' in ystr.lower():
-                xdat.append(chanfreq)
+            #Solutions have a single channel, with rows ordered by time and then antenna
+            nrows = size * data['nant']
+            shape = (size, data['nant'])
+            if 'time' in xstr:
+                xdat[start:end] = np.mean(time[:nrows].reshape(shape), axis=-1)
             else:
-                xdat.extend(chanfreq)
-
-        elif 'time' in xstr.lower():
-            tb.open(tt)
-            time = np.squeeze(tb.getcol('TIME'))
-            xdat = lengthen(xdat, time)
-
-            xlabel = 'Time'
-
-        elif 'real' in xstr.lower():
-            tb.open(tt)
-            real = np.squeeze(tb.getcol('CPARAM')).real
-            xdat = lengthen(xdat, real[0])
-            xdaty = lengthen(xdaty, real[1])
-            #xdat.extend(real[0])
-            #xdaty.extend(real[1])
-            xlabel = 'Real'
-        else:
-            # This should never happen
-            raise ValueError("Unknown option {}.".format(xstr.lower()))
-
-        tb.open(tt)
-        if 'delay' in ystr.lower():
-            dat = np.squeeze(tb.getcol('FPARAM'))
-        else:
-            dat = np.squeeze(tb.getcol('CPARAM'))
-
-        if len(dat.shape) == 1:
-            npol = 1
-        else:
-            npol = dat.shape[0]
-
-        if npol == 1:
-            datx = dat
-            daty = np.zeros_like(dat)
-        else:
-            datx = dat[0]
-            daty = dat[-1]
-
-        tb.close()
-
+                xdat[start:end] = np.mean(datx[0,:nrows].real.reshape(shape), axis=-1)
+                xdaty[start:end] = np.mean(daty[0,:nrows].real.reshape(shape), axis=-1)
+            ydatx[start:end] = np.mean(yfunc(datx[0,:nrows]).reshape(shape), axis=-1)
+            ydaty[start:end] = np.mean(yfunc(daty[0,:nrows]).reshape(shape), axis=-1)
 
-        if 'amp' in ystr.lower():
-            ydatx = lengthen(ydatx, np.abs(datx))
-            ydaty = lengthen(ydaty, np.abs(daty))
+        start = end
 
-            ylabel = 'Amplitude'
+    return xdat, xdaty, ydatx, ydaty, npol, field_id
 
-        elif 'phase' in ystr.lower():
-            ydatx = lengthen(ydatx, np.rad2deg(np.angle(datx)))
-            ydaty = lengthen(ydaty, np.rad2deg(np.angle(daty)))
-            #ydatx.extend(np.rad2deg(np.angle(datx)))
-            #ydaty.extend(np.rad2deg(np.angle(daty)))
-
-            ylabel = 'Phase (deg)'
-
-        elif 'imag' in ystr.lower():
-            ydatx = lengthen(ydatx, datx.imag)
-            ydaty = lengthen(ydaty, daty.imag)
-
-            ylabel = 'Imag'
-
-        elif 'delay' in ystr.lower():
-            ydatx = lengthen(ydatx, datx)
-            ydaty = lengthen(ydaty, daty)
-
-            ylabel = 'Delay'
-        else:
-            raise ValueError("Unknown option {}".format(ystr.lower()))
-
-    fields = np.asarray(fields)
-
-    xdat = np.asarray(xdat)
-    if 'real' in xstr.lower():
-        xdaty = np.asarray(xdaty)
-
-    ydatx = np.asarray(ydatx)
-    ydaty = np.asarray(ydaty)
-
-
-    if do_field_sel:
-        xdat = xdat.reshape(fields.shape)
-        ydatx = ydatx.reshape(fields.shape)
-        ydaty = ydaty.reshape(fields.shape)
-
-        idx = np.where(fields == field_id)
-        xdat = xdat[idx]
-        ydatx = ydatx[idx]
-        ydaty = ydaty[idx]
-
-
-        if 'real' in xstr.lower():
-            xdaty = xdaty.reshape(fields.shape)
-            xdaty = xdaty[idx]
-    else:
-        logger.warning("No field selection performed. Only one field present in the caltable")
-        field_id = np.unique(field)[0]
-
-    if 'freq' in xstr.lower():
-        ydatx, ydaty = avg_ants([ydatx, ydaty])
+def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=None, ylim=None):
+    # Check plotstr and ant
+    if not any([plotstr in ss for ss in ['amp,time', 'phase,time', 'amp,freq', 'phase,freq', 'delay,freq', 'imag,real']]):
+        raise ValueError("Invalid plotstr.")
 
-    if 'time' in xstr.lower() or 'real' in xstr.lower():
-        ydatx = np.asarray(ydatx).reshape(xdat.shape)
-        ydaty = np.asarray(ydaty).reshape(xdat.shape)
+    tables = find_caltables(dirs, caldir, table_ext)
 
-        npt = xdat.shape[0]//nant
-        xdat = xdat.reshape(npt, nant)
-        ydatx = ydatx.reshape(npt, nant)
-        ydaty = ydaty.reshape(npt, nant)
+    if len(tables) == 0:
+        logger.warning("No valid caltables with extention {} found.".format(table_ext))
+        logger.warning("Skipping.")
+        return
 
-        if 'real' in xstr.lower():
-            xdaty = xdaty.reshape(npt, nant)
+    #Each caltable is read once, and cached for all other plots
+    caltables = [data for tt in tables for data in load_caltable(tt)]
+    if len(caltables) == 0:
+        logger.warning("No solutions found in caltables with extention {}. Skipping.".format(table_ext))
+        return
+    with instrument.section('get_plot_data', plotstr=plotstr, ncaltables=len(caltables)):
+        xdat, xdaty, ydatx, ydaty, npol, field_id = get_plot_data(plotstr, field_id, caltables)
 
-        if 'real' in xstr.lower():
-            ydatx, ydaty, xdat, xdaty = avg_ants([ydatx, ydaty, xdat, xdaty])
-        else:
-            ydatx, ydaty, xdat = avg_ants([ydatx, ydaty, xdat])
+    xstr = plotstr.split(',')[1].lower()
+    ystr = plotstr.split(',')[0].lower()
+    xlabel = {'freq' : 'Frequency (MHz)', 'time' : 'Time', 'real' : 'Real'}[xstr]
+    ylabel = {'amp' : 'Amplitude', 'phase' : 'Phase (deg)', 'imag' : 'Imag', 'delay' : 'Delay'}[ystr]
 
     plt.ioff()
     fig, ax = plt.subplots()
 
-    if 'real' in xstr.lower():
+    if 'real' in xstr:
         if npol == 1:
             ax.scatter(xdat, ydatx, label='Pol Avg', facecolor='blue', edgecolor='none')
         else:
@@ -258,6 +324,7 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
     plt.tight_layout()
 
     plt.savefig('{0}.{1}'.format(outname,EXTN), bbox_inches='tight')
+    plt.close(fig)
 
 
 def main(args,taskvals):
@@ -267,10 +334,6 @@ def main(args,taskvals):
             os.makedirs(PLOT_DIR)
 
         fields = bookkeeping.get_field_ids(taskvals['fields'])
-        visname = va(taskvals, 'run', 'crosscal_vis', str)
-        polfield = bookkeeping.polfield_name(visname)
-
-        msmd.open(visname)
 
         caldir = 'caltables'
         spwdir = config_parser.parse_spw(args['config'])[3]
@@ -278,74 +341,74 @@ def main(args,taskvals):
         if type(spwdir) is str:
             spwdir = glob.glob(spwdir)
 
+        fieldnames = caltable_fieldnames(spwdir, caldir)
+        polfield = bookkeeping.polfield_name(None, fieldnames)
+
         for ff in fields.gainfields.split(','):
             plotstr='phase,time'
             table_ext = 'gcal'
             title='Gain Phase'
             outname = '{}/field_{}_gain_phase'.format(PLOT_DIR,ff)
-            plotcal(plotstr, int(msmd.fieldsforname(ff)[0]), spwdir, caldir, table_ext, title, outname)
+            plotcal(plotstr, fieldnames.index(ff), spwdir, caldir, table_ext, title, outname)
 
             plotstr='amp,time'
             table_ext = 'gcal'
             title='Gain Amp'
             outname = '{}/field_{}_gain_amp'.format(PLOT_DIR,ff)
-            plotcal(plotstr, int(msmd.fieldsforname(ff)[0]), spwdir, caldir, table_ext, title, outname)
+            plotcal(plotstr, fieldnames.index(ff), spwdir, caldir, table_ext, title, outname)
 
         #print("k")
         #plotstr='delay,freq'
         #table_ext = 'kcal'
         #title='Delay'
         #outname = '{}/field_{}_delay'.format(PLOT_DIR,fields.fluxfield)
-        #plotcal(plotstr, int(msmd.fieldsforname(fields.fluxfield)[0]), spwdir, caldir, table_ext, title, outname)
+        #plotcal(plotstr, fieldnames.index(fields.fluxfield), spwdir, caldir, table_ext, title, outname)
 
         #print("kcross")
         #plotstr='delay,freq'
         #table_ext = 'xdel'
         #title='Crosshand Delay'
         #outname = '{}/field_{}_crosshanddelay'.format(PLOT_DIR,fields.fluxfield)
-        #plotcal(plotstr, int(msmd.fieldsforname(fields.fluxfield)[0]), spwdir, caldir, table_ext, title, outname)
+        #plotcal(plotstr, fieldnames.index(fields.fluxfield), spwdir, caldir, table_ext, title, outname)
 
         plotstr='amp,freq'
         table_ext = 'bcal'
         title='Bandpass Amp'
         outname = '{}/field_{}_bandpass_amp'.format(PLOT_DIR,fields.fluxfield)
-        plotcal(plotstr, int(msmd.fieldsforname(fields.fluxfield)[0]), spwdir, caldir, table_ext, title, outname)
+        plotcal(plotstr, fieldnames.index(fields.fluxfield), spwdir, caldir, table_ext, title, outname)
 
         plotstr='phase,freq'
         table_ext = 'bcal'
         title='Bandpass Phase'
         outname = '{}/field_{}_bandpass_phase'.format(PLOT_DIR,fields.fluxfield)
-        plotcal(plotstr, int(msmd.fieldsforname(fields.fluxfield)[0]), spwdir, caldir, table_ext, title, outname)
+        plotcal(plotstr, fieldnames.index(fields.fluxfield), spwdir, caldir, table_ext, title, outname)
 
         plotstr='amp,freq'
         table_ext = 'pcal'
         title='Leakage Amp'
         outname = '{}/field_{}_leakage_amp'.format(PLOT_DIR,fields.bpassfield)
-        plotcal(plotstr, int(msmd.fieldsforname(fields.dpolfield)[0]), spwdir, caldir, table_ext, title, outname, None, [0, 0.1])
+        plotcal(plotstr, fieldnames.index(fields.dpolfield), spwdir, caldir, table_ext, title, outname, None, [0, 0.1])
         plotstr='phase,freq'
         table_ext = 'pcal'
         title='Leakage Phase'
         outname = '{}/field_{}_leakage_phase'.format(PLOT_DIR,fields.bpassfield)
-        plotcal(plotstr, int(msmd.fieldsforname(fields.dpolfield)[0]), spwdir, caldir, table_ext, title, outname)
+        plotcal(plotstr, fieldnames.index(fields.dpolfield), spwdir, caldir, table_ext, title, outname)
 
         plotstr='phase,freq'
         table_ext = 'xyambcal'
         title='XY Phase'
         outname = '{}/field_{}_xyamb_phase'.format(PLOT_DIR,polfield)
-        plotcal(plotstr, int(msmd.fieldsforname(polfield)[0]), spwdir, caldir, table_ext, title, outname)
+        plotcal(plotstr, fieldnames.index(polfield), spwdir, caldir, table_ext, title, outname)
 
         plotstr='phase,freq'
         table_ext = 'xycal'
         title='XY Phase (amb resolved)'
         outname = '{}/field_{}_xy_phase'.format(PLOT_DIR,polfield)
-        plotcal(plotstr, int(msmd.fieldsforname(polfield)[0]), spwdir, caldir, table_ext, title, outname)
-
-        msmd.done()
+        plotcal(plotstr, fieldnames.index(polfield), spwdir, caldir, table_ext, title, outname)
 
     except Exception as err:
         logger.error('Exception found in the pipeline of type {0}: {1}'.format(type(err),err))
         logger.error(traceback.format_exc())
-        msmd.done()
 
 if __name__ == "__main__":
 
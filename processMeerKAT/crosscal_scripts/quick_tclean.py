@@ -7,14 +7,13 @@ import os
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import ms_metadata
 import glob
 
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata
 import casampi
-msmd = msmetadata()
 
 def run_tclean(visname, fields, keepmms):
     """
@@ -24,7 +23,7 @@ def run_tclean(visname, fields, keepmms):
     """
 
     #Store bandwidth in MHz
-    msmd.open(visname)
+    msmd = ms_metadata.get(visname)
     BW = msmd.bandwidths(-1).sum()/1e6
 
     if keepmms == True:
@@ -97,8 +96,6 @@ def run_tclean(visname, fields, keepmms):
 
                 exportfits(imagename=secimname+'.image'+suffix, fitsimage=secimname+'.fits')
 
-    msmd.done()
-
 
 def main(args,taskvals):
 
@@ -4,6 +4,7 @@
 import os, sys, shutil
 
 import bookkeeping
+import ms_metadata
 from config_parser import validate_args as va
 import numpy as np
 import logging
@@ -13,9 +14,7 @@ logging.Formatter.converter = gmtime
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata
 import casampi
-msmd = msmetadata()
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
@@ -36,7 +35,7 @@ def do_setjy(visname, spw, fields, standard, dopol=False, createmms=True):
     fluxlist = ["J0408-6545", "0408-6545", ""]
     ismms = createmms
 
-    msmd.open(visname)
+    msmd = ms_metadata.get(visname)
     fnames = fields.fluxfield.split(",")
     for fname in fnames:
         if fname.isdigit():
@@ -83,8 +82,8 @@ def do_setjy(visname, spw, fields, standard, dopol=False, createmms=True):
             logger.info("Detected calibrator name(s):  %s" % calibrator_3C286)
             logger.info("Flux and spectral index taken/calculated from:  https://science.nrao.edu/facilities/vla/docs/manuals/oss/performance/fdscale")
             logger.info("Estimating polarization index and position angle of polarized emission from linear fit based on: Perley & Butler 2013 (https://ui.adsabs.harvard.edu/abs/2013ApJS..204...19P/abstract)")
-            # central freq of spw
-            spwMeanFreq = msmd.meanfreq(0, unit='GHz')
+            # central freq of all channels (of all spws)
+            spwMeanFreq = msmd.meanchanfreq(unit='GHz')
             freqList = np.array([1.05, 1.45, 1.64, 1.95])
             # fractional linear polarisation
             fracPolList = [0.086, 0.095, 0.099, 0.101]
@@ -124,8 +123,8 @@ def do_setjy(visname, spw, fields, standard, dopol=False, createmms=True):
             logger.info("Detected calibrator name(s):  %s" % calibrator_3C138)
             logger.info("Flux and spectral index taken/calculated from:  https://science.nrao.edu/facilities/vla/docs/manuals/oss/performance/fdscale")
             logger.info("Estimating polarization index and position angle of polarized emission from linear fit based on: Perley & Butler 2013 (https://ui.adsabs.harvard.edu/abs/2013ApJS..204...19P/abstract)")
-            # central freq of spw
-            spwMeanFreq = msmd.meanfreq(0, unit='GHz')
+            # central freq of all channels (of all spws)
+            spwMeanFreq = msmd.meanchanfreq(unit='GHz')
             freqList = np.array([1.05, 1.45, 1.64, 1.95])
             # fractional linear polarisation
             fracPolList = [0.056, 0.075, 0.084, 0.09]
@@ -149,8 +148,6 @@ def do_setjy(visname, spw, fields, standard, dopol=False, createmms=True):
                 polangle=[polangle],
                 rotmeas=0,ismms=ismms)
 
-    msmd.done()
-
 
 def main(args,taskvals):
 
@@ -3,24 +3,92 @@
 
 import sys
 import os
+import math
+import numpy as np
 
 import config_parser
 import bookkeeping
+import ms_metadata
+import freq_ranges
 from config_parser import validate_args as va
 
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata
+from casatools import table
 import casampi
-msmd = msmetadata()
 
-def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants):
+tb = table()
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Angular velocity of the Earth's rotation (rad/s) and speed of light (m/s)
+EARTH_ROTATION = 7.2921e-5
+SPEED_OF_LIGHT = 299792458.0
+
+def baseline_lengths(visname):
+
+    """Return the length (m) of each baseline of an MS, from the positions of its antennas."""
+
+    tb.open(os.path.join(visname, 'ANTENNA'))
+    positions = tb.getcol('POSITION').T
+    tb.close()
+    return [np.linalg.norm(positions[i] - positions[j]) for i in range(len(positions)) for j in range(i+1, len(positions))]
+
+def bda_params(visname, tolerance, fov, specavg):
+
+    """Return the parameters of baseline-dependent averaging, which averages each baseline as much as possible while keeping the
+    amplitude loss from time and bandwidth smearing within a tolerance at the edge of the field of view. Averaging a fringe over
+    x cycles reduces its amplitude by 1 - sinc(x) ~ (pi x)^2 / 6, so a fringe may move by up to sqrt(6 tolerance) / pi cycles
+    within each average. In time, each baseline is averaged until its uvw coordinates move by the distance over which a source
+    at the edge of the field moves by this many cycles, which is the same for every baseline, so short baselines are averaged
+    for longer, up to the time bin of the shortest baseline. In frequency, all baselines are averaged by the channel width
+    allowed by the longest baseline, or by the input width if larger.
+
+    Arguments:
+    ----------
+    visname : str
+        Input MeasurementSet.
+    tolerance : float
+        Fractional amplitude loss tolerated at the edge of the field of view (e.g. 0.01).
+    fov : float
+        Radius of the field of view in degrees.
+    specavg : int
+        Minimum number of channels to average.
+
+    Returns:
+    --------
+    params : dict
+        Time bin ('timebin'), maximum uvw distance in metres ('maxuvwdistance') and number of channels ('width') to average."""
+
+    msmd = ms_metadata.get(visname)
+    freqs = np.concatenate([msmd.chanfreqs(spw) for spw in range(msmd.nspw())])
+    chanwidth = min([np.min(np.abs(np.diff(msmd.chanfreqs(spw)))) for spw in range(msmd.nspw()) if len(msmd.chanfreqs(spw)) > 1] or [np.inf])
+    wavelength = SPEED_OF_LIGHT / np.max(freqs)
+
+    lengths = [length for length in baseline_lengths(visname) if length > 0]
+    cycles = math.sqrt(6 * tolerance) / math.pi
+    radius = math.radians(fov)
+
+    maxuvwdistance = cycles * wavelength / radius
+    timebin = maxuvwdistance / (EARTH_ROTATION * min(lengths))
+    width = max(specavg, int(cycles * SPEED_OF_LIGHT / (radius * max(lengths)) // chanwidth))
+
+    params = {'timebin' : '{0:.0f}s'.format(timebin), 'maxuvwdistance' : maxuvwdistance, 'width' : width}
+    logger.info("Baseline-dependent averaging for {0:.1%} smearing at {1} deg: averaging up to {timebin} (until baselines move by {maxuvwdistance:.1f} m) and {width} channels.".format(tolerance,fov,**params))
+    return params
+
+def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants, bda=None):
 
     outputbase = os.path.splitext(os.path.split(visname)[1])[0]
     extn = 'mms' if keepmms else 'ms'
     newvis = visname
     antenna = '!{0}'.format(','.join(map(str,badants))) if len(badants) > 0 else ''
+    msmd = ms_metadata.get(visname)
 
     for field in fields:
         if field != '':
@@ -31,9 +99,15 @@ def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants):
                 outname = '%s.%s.%s' % (outputbase, fname, extn)
                 if not os.path.exists(outname):
 
-                    split(vis=visname, outputvis=outname, datacolumn='corrected',
-                                field=fname, spw=spw, keepflags=True, keepmms=keepmms,
-                                width=specavg, timebin=timeavg, antenna=antenna)
+                    #Average target fields by baseline, which is only supported by mstransform (output is MMS if keepmms, as with split)
+                    if bda is not None and fname in fields.targetfield.split(','):
+                        mstransform(vis=visname, outputvis=outname, createmms=keepmms, datacolumn='corrected', field=fname, spw=spw, keepflags=True,
+                                    antenna=antenna, chanaverage=(bda['width'] > 1), chanbin=bda['width'], timeaverage=True,
+                                    timebin=bda['timebin'], maxuvwdistance=bda['maxuvwdistance'])
+                    else:
+                        split(vis=visname, outputvis=outname, datacolumn='corrected',
+                                    field=fname, spw=spw, keepflags=True, keepmms=keepmms,
+                                    width=specavg, timebin=timeavg, antenna=antenna)
 
                 if fname == fields.targetfield.split(',')[0]:
                     newvis = outname
@@ -49,17 +123,24 @@ def main(args,taskvals):
 
     spw = va(taskvals, 'crosscal', 'spw', str, default='')
     badants = taskvals['crosscal'].pop('badants')
+    badfreqranges = taskvals['crosscal'].get('badfreqranges', [])
 
     specavg = va(taskvals, 'crosscal', 'width', int, default=1)
     timeavg = va(taskvals, 'crosscal', 'timeavg', str, default='8s')
     keepmms = va(taskvals, 'crosscal', 'keepmms', bool)
+    bdatolerance = va(taskvals, 'crosscal', 'bdatolerance', float, default=0.0)
+    bdafov = va(taskvals, 'crosscal', 'bdafov', float, default=1.0)
+
+    bda = bda_params(visname, bdatolerance, bdafov, specavg) if bdatolerance > 0 else None
+    newvis = split_vis(visname, freq_ranges.excise_spw(spw, badfreqranges), fields, specavg, timeavg, keepmms, badants, bda)
 
-    msmd.open(visname)
-    newvis = split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants)
+    #Write metadata snapshot of target MS/MMS, which is read by the imaging steps
+    if newvis != visname:
+        ms_metadata.write(newvis)
 
-    config_parser.overwrite_config(args['config'], conf_dict={'vis' : "'{0}'".format(newvis)}, conf_sec='data')
-    config_parser.overwrite_config(args['config'], conf_dict={'crosscal_vis': "'{0}'".format(visname)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-    msmd.done()
+    with config_parser.batch_update(args['config']):
+        config_parser.overwrite_config(args['config'], conf_dict={'vis' : "'{0}'".format(newvis)}, conf_sec='data')
+        config_parser.overwrite_config(args['config'], conf_dict={'crosscal_vis': "'{0}'".format(visname)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
 
 if __name__ == '__main__':
 
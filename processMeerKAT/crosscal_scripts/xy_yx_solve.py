@@ -7,6 +7,7 @@ import shutil
 
 import config_parser
 import bookkeeping
+import ms_metadata
 from config_parser import validate_args as va
 from casarecipes.almapolhelpers import xyamb
 import numpy as np
@@ -14,8 +15,6 @@ import numpy as np
 from casatasks import *
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-from casatools import msmetadata
-msmd = msmetadata()
 
 import logging
 from time import gmtime
@@ -29,9 +28,7 @@ def qu_polfield(polfield, visname):
     calculated from Perley & Butler 2013
     """
 
-    msmd.open(visname)
-    meanfreq = msmd.meanfreq(0, unit='MHz')
-    msmd.done()
+    meanfreq = ms_metadata.get(visname).meanchanfreq(unit='MHz')
 
     if polfield in ["3C286", "1328+307", "1331+305", "J1331+3030"]:
         #f_coeff=[1.2515,-0.4605,-0.1715,0.0336]    # coefficients for model Stokes I spectrum from Perley and Butler 2013
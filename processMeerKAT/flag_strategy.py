@@ -0,0 +1,129 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import config_parser
+
+import logging
+logger = logging.getLogger(__name__)
+
+#Config file whose [flagging] section holds the default strategies, used when a config file has no [flagging] section. Each is a list of
+#flagdata commands, which are applied in order within a single pass over the data. Field selections may use '{allfields}', '{calfields}' or '{targetfield}'.
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default_config.txt')
+
+#Parameters of the flagdata task itself, which apply to the whole list and so are ignored within individual commands
+TASK_KEYS = ['vis', 'inpfile', 'action', 'flagbackup', 'savepars', 'overwrite', 'writeflags', 'display']
+
+def get_strategy(taskvals, name):
+
+    """Return a flagging strategy from the [flagging] section of the config, or the default strategy if not present.
+
+    Arguments:
+    ----------
+    taskvals : dict
+        Dictionary of parsed config file.
+    name : str
+        Name of strategy (e.g. 'round_1').
+
+    Returns:
+    --------
+    strategy : list
+        List of dictionaries of flagdata parameters."""
+
+    if 'flagging' in taskvals and name in taskvals['flagging']:
+        strategy = taskvals['flagging'][name]
+        if type(strategy) is not list or not all([type(command) is dict for command in strategy]):
+            raise ValueError("Flagging strategy '{0}' in [flagging] section of config must be a list of dictionaries.".format(name))
+        return strategy
+
+    return config_parser.get_key(DEFAULT_CONFIG, 'flagging', name)
+
+def get_field_selections(fields):
+
+    """Return the field selections that may be used within a flagging strategy.
+
+    Arguments:
+    ----------
+    fields : namedtuple
+        Field IDs, as returned by bookkeeping.get_field_ids().
+
+    Returns:
+    --------
+    selections : dict
+        allfields, calfields and targetfield selections, with duplicate and empty fields removed."""
+
+    #remove duplicate and empty fields
+    allfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.targetfield] + [fields.extrafields]).split(',')) if i]))
+    calfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.extrafields]).split(',')) if i]))
+
+    return {'allfields' : allfields, 'calfields' : calfields, 'targetfield' : fields.targetfield}
+
+def format_value(value):
+
+    """Format a parameter value for a flagdata command string."""
+
+    if type(value) in [list, tuple]:
+        return '[{0}]'.format(','.join([format_value(val) for val in value]))
+    return repr(value)
+
+def compile_commands(strategy, fields):
+
+    """Compile a flagging strategy into a list of command strings, for a single call of flagdata(mode='list').
+
+    Arguments:
+    ----------
+    strategy : list
+        List of dictionaries of flagdata parameters.
+    fields : namedtuple
+        Field IDs, as returned by bookkeeping.get_field_ids().
+
+    Returns:
+    --------
+    commands : list
+        List of flagdata command strings."""
+
+    selections = get_field_selections(fields)
+    commands = []
+
+    for command in strategy:
+        params = []
+        for key,value in command.items():
+            if key in TASK_KEYS:
+                logger.debug("Ignoring '{0}' in flagging command {1}, since this applies to all commands.".format(key,command))
+                continue
+            if key == 'field':
+                try:
+                    value = value.format(**selections)
+                except KeyError as err:
+                    raise ValueError("Unknown field selection {0} in flagging command {1}. Use one of {2}.".format(err,command,list(selections.keys())))
+            params.append('{0}={1}'.format(key,format_value(value)))
+        commands.append(' '.join(params))
+
+    return commands
+
+def manual_commands(badfreqranges=[], badants=[]):
+
+    """Return flagdata command strings to manually flag bad frequency ranges and antennas.
+
+    Arguments:
+    ----------
+    badfreqranges : list, optional
+        List of bad frequency ranges (e.g. '933~960MHz').
+    badants : list, optional
+        List of bad antennas.
+
+    Returns:
+    --------
+    commands : list
+        List of flagdata command strings."""
+
+    commands = []
+
+    if len(badfreqranges):
+        commands.append("mode='manual' spw='*:{0}'".format(',*:'.join(badfreqranges)))
+    if len(badants):
+        commands.append("mode='manual' antenna='{0}'".format(','.join([str(bb) for bb in badants])))
+
+    return commands
@@ -0,0 +1,126 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Frequency ranges of SPWs and bad frequency ranges, shared by the master script and the pipeline scripts, which import this rather than processMeerKAT
+"""
+
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+#Prefix of each SPW, selecting a frequency range from all SPWs of the MS
+SPW_PREFIX = '*:'
+
+#Factor to convert each unit of frequency to MHz
+MHZ_PER_UNIT = {'Hz' : 1e-6, 'kHz' : 1e-3, 'MHz' : 1.0, 'GHz' : 1e3}
+
+def get_spw_bounds(spw, warn=True):
+
+    """Get upper and lower bounds of spw.
+
+    Arguments:
+    ----------
+    spw : str
+        CASA spectral window in MHz.
+    warn : bool, optional
+        Warn if the unit isn't MHz?
+
+    Returns:
+    --------
+    low : float
+        Lower bound of spw.
+    high : float
+        Higher bound of spw.
+    unit : str
+        Unit of spw.
+    func : function
+        Function to apply to spectral window (i.e. int for SPW channel range, otherwise float)."""
+
+    bounds = spw.split(':')[-1].split('~')
+    if ',' not in spw and ':' in spw and '~' in spw and len(bounds) == 2 and bounds[1] != '':
+        high,unit=re.search(r'(\d+\.*\d*)(\w*)',bounds[1]).groups()
+        func = int if unit == '' or '.' not in bounds[0] else float
+        low = func(bounds[0])
+        func = int if unit == '' or '.' not in high else float
+        high = func(high)
+
+        if unit != 'MHz' and warn:
+            logger.warning('Please use SPW unit "MHz", to ensure the best performance (e.g. not processing entirely flagged frequency ranges).')
+
+    else:
+        return None
+
+    return low,high,unit,func
+
+def range_mhz(freqrange):
+
+    """Return the bounds in MHz of a frequency range (e.g. '935~947MHz' or '1.16~1.31GHz').
+
+    Arguments:
+    ----------
+    freqrange : str
+        Frequency range, without SPW prefix.
+
+    Returns:
+    --------
+    low : float
+        Lower bound in MHz.
+    high : float
+        Upper bound in MHz, or None for both if the range has no frequency unit."""
+
+    bounds = get_spw_bounds('{0}{1}'.format(SPW_PREFIX,freqrange), warn=False)
+    if bounds is None or bounds[2] not in MHZ_PER_UNIT:
+        return None
+    return bounds[0]*MHZ_PER_UNIT[bounds[2]], bounds[1]*MHZ_PER_UNIT[bounds[2]]
+
+def excise_spw(spw,badfreqranges):
+
+    """Remove bad frequency ranges from each SPW with a frequency unit, so only the good channel ranges of each SPW are selected,
+    separated by ';' (e.g. '*:880~1010MHz' becomes '*:880~933MHz;960~1010MHz' with bad frequency range '933~960MHz').
+
+    Arguments:
+    ----------
+    spw : str
+        Comma-separated list of SPWs.
+    badfreqranges : list
+        List of bad frequency ranges (e.g. '933~960MHz'), in any frequency unit.
+
+    Returns:
+    --------
+    spw : str
+        Comma-separated list of SPWs, each with its good channel ranges in its own unit. SPWs without a frequency unit,
+        or entirely within a bad frequency range, are unchanged."""
+
+    bad = [bounds for bounds in [range_mhz(freq) for freq in badfreqranges] if bounds is not None]
+    excised = []
+    for SPW in spw.split(','):
+        bounds = get_spw_bounds(SPW)
+        if bounds is None or bounds[2] not in MHZ_PER_UNIT:
+            excised.append(SPW)
+            continue
+
+        #Excise in MHz, then write the good ranges in the unit of the SPW
+        scale = MHZ_PER_UNIT[bounds[2]]
+        ranges = [(bounds[0]*scale, bounds[1]*scale)]
+        for bad_low,bad_high in bad:
+            good = []
+            for low,high in ranges:
+                if bad_high <= low or bad_low >= high:
+                    good.append((low,high))
+                else:
+                    if bad_low > low:
+                        good.append((low,bad_low))
+                    if bad_high < high:
+                        good.append((bad_high,high))
+            ranges = good
+
+        if len(ranges) == 0:
+            excised.append(SPW)
+        else:
+            excised.append('{0}:{1}'.format(SPW.split(':')[0], ';'.join(['{0:.10g}~{1:.10g}{2}'.format(low/scale,high/scale,bounds[2]) for low,high in ranges])))
+
+    return ','.join(excised)
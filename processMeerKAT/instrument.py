@@ -0,0 +1,165 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Opt-in instrumentation of pipeline scripts, enabled with 'instrument = True' in the [run] section of the config file.
+Only the process that runs the script is measured (i.e. the MPI client for threadsafe scripts), so the CPU time, memory and I/O
+of the MPI servers, which do most of the work of tasks run in parallel over an MMS, are not included.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+#CASA tasks whose calls are timed, when called from a pipeline script
+TASKS = ['flagdata','gaincal','bandpass','applycal','tclean','mstransform','split','setjy','fluxscale','polcal','concat','virtualconcat','exportfits','flagmanager']
+
+#Log directory and file extension of the JSON lines written by each job
+LOG_DIR = 'logs'
+EXTN = 'calls.jsonl'
+
+#File to which records are written, once enabled
+_RECORDS = None
+
+def logfile():
+
+    """Return the path of the JSON lines file of this job, named like its CASA log (e.g. 'logs/flag_round_2-1234.calls.jsonl')."""
+
+    job = os.environ.get('SLURM_JOB_ID', str(os.getpid()))
+    if os.environ.get('SLURM_ARRAY_TASK_ID', '') != '':
+        job = '{0}_{1}'.format(os.environ.get('SLURM_ARRAY_JOB_ID', job),os.environ['SLURM_ARRAY_TASK_ID'])
+    name = os.environ.get('SLURM_JOB_NAME', os.path.splitext(os.path.basename(sys.argv[0]))[0])
+    return os.path.join(LOG_DIR, '{0}-{1}.{2}'.format(name,job,EXTN))
+
+def io_counters():
+
+    """Return the bytes read and written by this process (from storage, and in total) from /proc/self/io, or {} if unavailable."""
+
+    try:
+        with open('/proc/self/io') as f:
+            return {key : int(value) for key,value in [line.split(':') for line in f.read().splitlines()]}
+    except (IOError, OSError, ValueError):
+        return {}
+
+def usage():
+
+    """Return the current wall time, CPU time, peak RSS (since the process started) and I/O counters of this process."""
+
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'wall' : time.time(), 'cpu' : rusage.ru_utime + rusage.ru_stime, 'maxrss' : rusage.ru_maxrss * 1024, 'io' : io_counters()}
+
+def jsonable(value):
+
+    """Return a value that can be written to JSON, falling back to its string representation."""
+
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+def write(record):
+
+    """Write one record to the JSON lines file of this job."""
+
+    if _RECORDS is None:
+        return
+    with open(_RECORDS, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def section(name, **kwargs):
+
+    """Context within which the time and resources used are recorded, under a name and with any keyword arguments
+    (e.g. for a major NumPy section of a script). Does nothing unless instrumentation is enabled.
+
+    Arguments:
+    ----------
+    name : str
+        Name of section.
+    kwargs : dict, optional
+        Arguments recorded with this section."""
+
+    if _RECORDS is None:
+        yield
+        return
+
+    start = usage()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        end = usage()
+        record = {'time' : datetime.utcfromtimestamp(start['wall']).isoformat(),
+                  'job' : os.environ.get('SLURM_JOB_ID'),
+                  'scope' : 'client',
+                  'call' : name,
+                  'ok' : ok,
+                  'wall' : round(end['wall'] - start['wall'], 3),
+                  'cpu' : round(end['cpu'] - start['cpu'], 3),
+                  'maxrss' : end['maxrss'],
+                  'maxrss_increase' : end['maxrss'] - start['maxrss']}
+        for key in ['read_bytes','write_bytes','rchar','wchar']:
+            if key in start['io'] and key in end['io']:
+                record[key] = end['io'][key] - start['io'][key]
+        record['args'] = {key : jsonable(value) for key,value in kwargs.items()}
+        write(record)
+
+def wrap(name, task):
+
+    """Return a CASA task wrapped so that each call is recorded as a section, with its arguments."""
+
+    @functools.wraps(task)
+    def wrapped(*args, **kwargs):
+        recorded = dict(kwargs)
+        if len(args) > 0:
+            recorded['*args'] = list(args)
+        with section(name, **recorded):
+            return task(*args, **kwargs)
+
+    wrapped.instrumented = True
+    return wrapped
+
+def enable(module):
+
+    """Record each call to the CASA tasks imported into a module (i.e. a pipeline script), and each section, in JSON lines in the log directory.
+    Each record has the wall and CPU time, peak RSS (bytes), bytes read and written, and arguments of the call, all measured in this process only
+    (marked by 'scope' : 'client'). Since peak RSS is a high-water mark over the lifetime of the process, 'maxrss_increase' is how much the call
+    raised it, which is zero for any call that used less memory than an earlier one, rather than the memory the call used.
+
+    Arguments:
+    ----------
+    module : module
+        Module (i.e. pipeline script) whose CASA tasks are wrapped.
+
+    Returns:
+    --------
+    logfile : str
+        Path of JSON lines file."""
+
+    global _RECORDS
+    _RECORDS = logfile()
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    #Wrap tasks imported into the script (e.g. 'from casatasks import *'), and in casatasks itself for other modules
+    modules = [module] + ([sys.modules['casatasks']] if 'casatasks' in sys.modules else [])
+    for mod in modules:
+        for name in TASKS:
+            task = getattr(mod, name, None)
+            if task is not None and not getattr(task, 'instrumented', False):
+                setattr(mod, name, wrap(name, task))
+
+    logger.info("Recording time and resources used by each CASA task in '{0}'.".format(_RECORDS))
+    return _RECORDS
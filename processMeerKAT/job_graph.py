@@ -0,0 +1,540 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import step_ledger
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Match '#SBATCH --key=value' lines of sbatch file
+SBATCH_DIRECTIVE = re.compile(r'^#SBATCH\s+--([\w-]+)=(\S+)', re.M)
+#Match the pipeline script and config file called by each step of an sbatch file (e.g. '/path/to/setjy.py --config .config.tmp')
+STEP_COMMAND = re.compile(r'(\S+)\.py\s+--config\s+(\S+)')
+
+class Job(object):
+
+    """A node of the job graph - one sbatch file submitted from a given directory, which depends on other jobs.
+
+    Arguments:
+    ----------
+    sbatch : str
+        Path to sbatch file (relative to dir).
+    dir : str, optional
+        Directory from which to submit job.
+    idvar : str, optional
+        Name of bash variable to which the ID of this job is appended after submission.
+    array : bool, optional
+        Is this job a job array (so that other jobs can depend on its individual tasks)?"""
+
+    def __init__(self, sbatch, dir='.', idvar='IDs', array=False):
+
+        self.sbatch = sbatch
+        self.dir = dir
+        self.idvar = idvar
+        self.array = array
+        self.deps = [] #List of (index of job, dependency type, array task ID or None)
+        self.external = [] #List of job IDs submitted outside this graph, which this job must run after (afterok)
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.sbatch))[0]
+
+    def to_dict(self):
+        return {'sbatch' : self.sbatch, 'dir' : self.dir, 'idvar' : self.idvar, 'array' : self.array, 'deps' : self.deps, 'external' : self.external}
+
+    @classmethod
+    def from_dict(cls, dic):
+        job = cls(dic['sbatch'], dic['dir'], dic['idvar'], dic['array'])
+        job.deps = [tuple(dep) for dep in dic['deps']]
+        job.external = list(dic['external'])
+        return job
+
+class JobGraph(object):
+
+    """Directed acyclic graph of jobs, where each job is only submitted once all the jobs it depends on are submitted,
+    and depends on only the jobs whose outputs it consumes. Jobs are stored in the order they're added, so a job can
+    only depend on jobs added before it, which is a valid order for submission."""
+
+    def __init__(self):
+        self.jobs = []
+        self.IDs = [] #Job ID of each job, once submitted
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, sbatch, after=[], dep_type='afterok', task=None, **kwargs):
+
+        """Add job to graph.
+
+        Arguments:
+        ----------
+        sbatch : str
+            Path to sbatch file (relative to dir).
+        after : list, optional
+            Indices of jobs this job depends on.
+        dep_type : str, optional
+            SLURM dependency type - e.g. 'afterok' or 'afterany'.
+        task : int, optional
+            Depend only on this task of job arrays in after.
+        kwargs : dict, optional
+            Keyword arguments passed into Job().
+
+        Returns:
+        --------
+        index : int
+            Index of job in graph."""
+
+        job = Job(sbatch, **kwargs)
+        self.jobs.append(job)
+        index = len(self.jobs) - 1
+        self.depend(index, after, dep_type, task)
+        return index
+
+    def depend(self, index, after, dep_type='afterok', task=None):
+
+        """Make job depend on other jobs, which must be added to the graph before it.
+
+        Arguments:
+        ----------
+        index : int
+            Index of job.
+        after : list
+            Indices of jobs this job depends on.
+        dep_type : str, optional
+            SLURM dependency type - e.g. 'afterok' or 'afterany'.
+        task : int, optional
+            Depend only on this task of job arrays in after."""
+
+        for i in after:
+            if i >= index:
+                raise ValueError("Job '{0}' can only depend on jobs added before it, not on '{1}'.".format(self.jobs[index].name,self.jobs[i].name))
+            dep = (i, dep_type, task if self.jobs[i].array else None)
+            if dep not in self.jobs[index].deps:
+                self.jobs[index].deps.append(dep)
+
+    def roots(self):
+
+        """Return the indices of jobs that don't depend on any other job in the graph."""
+
+        return [i for i,job in enumerate(self.jobs) if len(job.deps) == 0]
+
+    def leaves(self):
+
+        """Return the indices of jobs that no other job in the graph depends on."""
+
+        depended = set([dep[0] for job in self.jobs for dep in job.deps])
+        return [i for i in range(len(self.jobs)) if i not in depended]
+
+    def find(self, name):
+
+        """Return the indices of jobs with this name (i.e. sbatch file without extension)."""
+
+        return [i for i,job in enumerate(self.jobs) if job.name == name]
+
+    def merge(self, other, dir='.', idvar=None):
+
+        """Add all jobs from another graph into this graph, with their dependencies.
+
+        Arguments:
+        ----------
+        other : class ``JobGraph``
+            Graph to add.
+        dir : str, optional
+            Directory (relative to the directory of this graph) in which the other graph's jobs are submitted.
+        idvar : str, optional
+            Overwrite bash variable of other graph's jobs with this name.
+
+        Returns:
+        --------
+        indices : list
+            Indices of other graph's jobs within this graph."""
+
+        offset = len(self.jobs)
+        for job in other.jobs:
+            new = Job.from_dict(job.to_dict())
+            new.dir = os.path.normpath(os.path.join(dir, job.dir))
+            if idvar is not None:
+                new.idvar = idvar
+            new.deps = [(i + offset, dep_type, task) for i,dep_type,task in job.deps]
+            self.jobs.append(new)
+        return list(range(offset, len(self.jobs)))
+
+    def steps(self, index):
+
+        """Return the config file and the name of each step (i.e. script without extension) run by a job, or ('', []) if it doesn't run pipeline scripts."""
+
+        with open(os.path.join(self.jobs[index].dir, self.jobs[index].sbatch)) as f:
+            commands = STEP_COMMAND.findall(f.read())
+        if len(commands) == 0 or len(set([config for script,config in commands])) > 1:
+            return '', []
+        return commands[0][1], [os.path.basename(script) for script,config in commands]
+
+    def remove(self, indices):
+
+        """Remove jobs from the graph, along with the dependencies of other jobs on them. Jobs that depended on a removed job
+        instead depend on the jobs outside the graph that it depended on."""
+
+        external = {}
+        for i,job in enumerate(self.jobs):
+            inherited = [ID for j,dep_type,task in job.deps if j in indices for ID in external[j]]
+            job.external = job.external + [ID for ID in inherited if ID not in job.external]
+            if i in indices:
+                external[i] = job.external
+
+        keep = [i for i in range(len(self.jobs)) if i not in indices]
+        new = {old : i for i,old in enumerate(keep)}
+        for i in keep:
+            self.jobs[i].deps = [(new[j], dep_type, task) for j,dep_type,task in self.jobs[i].deps if j in new]
+        self.jobs = [self.jobs[i] for i in keep]
+
+    def skip_completed(self):
+
+        """Remove the jobs whose steps all completed in a previous run with the same config and data (according to the step ledger
+        of their directory), and whose dependencies were all removed, so that completed steps aren't queued again. The config changes
+        made by these steps are applied, as when they're skipped within a job.
+
+        Returns:
+        --------
+        skipped : list
+            Names (with directory) of jobs removed."""
+
+        skipped = []
+        for i,job in enumerate(self.jobs):
+            if job.array or any([j not in skipped for j,dep_type,task in job.deps]):
+                continue
+
+            cwd = os.getcwd()
+            try:
+                config,steps = self.steps(i)
+                os.chdir(job.dir)
+                if step_ledger.skip(config, steps):
+                    skipped.append(i)
+            except Exception as err:
+                logger.warning("Couldn't check step ledger of '{0}' in '{1}' ({2}: {3}), so submitting it.".format(job.sbatch,job.dir,type(err).__name__,err))
+            finally:
+                os.chdir(cwd)
+
+        names = [os.path.normpath(os.path.join(self.jobs[i].dir, self.jobs[i].name)) for i in skipped]
+        self.remove(skipped)
+        return names
+
+    def write(self, filename):
+
+        """Write graph to JSON file."""
+
+        if os.path.dirname(filename) != '' and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            json.dump({'jobs' : [job.to_dict() for job in self.jobs], 'IDs' : self.IDs}, f, indent=1)
+
+    @classmethod
+    def read(cls, filename):
+
+        """Read graph from JSON file."""
+
+        graph = cls()
+        with open(filename) as f:
+            dic = json.load(f)
+        graph.jobs = [Job.from_dict(job) for job in dic['jobs']]
+        graph.IDs = dic.get('IDs', [])
+        return graph
+
+    def dependency(self, index, IDs):
+
+        """Return the SLURM dependency string of a job, given the IDs of the jobs already submitted.
+
+        Arguments:
+        ----------
+        index : int
+            Index of job.
+        IDs : list
+            Job IDs of all jobs submitted so far, in the order of the graph.
+
+        Returns:
+        --------
+        dependency : str
+            Dependency string passed into 'sbatch -d' (e.g. 'afterok:1:2_0,afterany:3'), or '' for no dependencies."""
+
+        job = self.jobs[index]
+        types = {}
+        for i,dep_type,task in job.deps:
+            ID = IDs[i] if task is None else '{0}_{1}'.format(IDs[i],task)
+            types.setdefault(dep_type, []).append(ID)
+        if len(job.external) > 0:
+            types.setdefault('afterok', []).extend(job.external)
+
+        return ','.join(['{0}:{1}'.format(dep_type,':'.join(types[dep_type])) for dep_type in types])
+
+    def command(self, index, IDs):
+
+        """Return the sbatch command (as a list) to submit a job, given the IDs of the jobs already submitted."""
+
+        cmd = ['sbatch', '--parsable']
+        dependency = self.dependency(index, IDs)
+        if dependency != '':
+            cmd += ['-d', dependency]
+            if 'afterok' in dependency:
+                cmd += ['--kill-on-invalid-dep=yes']
+        cmd.append(self.jobs[index].sbatch)
+        return cmd
+
+    def submit(self):
+
+        """Submit all jobs with sbatch, in order, with their dependencies, from this one process. If any submission fails,
+        all jobs submitted so far are cancelled.
+
+        Returns:
+        --------
+        IDs : list
+            Job ID of each job in the graph."""
+
+        IDs = []
+        for i,job in enumerate(self.jobs):
+            cmd = self.command(i, IDs)
+            logger.debug("Submitting '{0}' from '{1}' with following command: {2}".format(job.sbatch,job.dir,' '.join(cmd)))
+            try:
+                out = subprocess.run(cmd, cwd=job.dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+            except (OSError, subprocess.CalledProcessError) as err:
+                stderr = getattr(err, 'stderr', '')
+                logger.error("Failed to submit '{0}' from '{1}': {2} {3}".format(job.sbatch,job.dir,err,stderr))
+                if len(IDs) > 0:
+                    logger.error('Cancelling the {0} jobs already submitted: {1}'.format(len(IDs),','.join(IDs)))
+                    subprocess.run(['scancel'] + IDs)
+                raise
+
+            #Output is 'jobid' or 'jobid;cluster'
+            IDs.append(out.stdout.strip().split(';')[0])
+
+        return IDs
+
+    def idvars(self, IDs):
+
+        """Return the bash variables and the comma-separated list of job IDs assigned to each, in order of first appearance."""
+
+        idvars = {}
+        for job,ID in zip(self.jobs,IDs):
+            idvars.setdefault(job.idvar, []).append(ID)
+        return [(var, ','.join(idvars[var])) for var in idvars]
+
+def sbatch_directives(sbatch):
+
+    """Return the '#SBATCH --key=value' directives of an sbatch file as a dictionary."""
+
+    with open(sbatch) as f:
+        return dict(SBATCH_DIRECTIVE.findall(f.read()))
+
+class LocalExecutor(object):
+
+    """Run a job graph on this machine without SLURM, running each sbatch file with bash, and running up to a number of jobs
+    (or job array tasks) at once in a pool of worker processes. As with SLURM, a job only starts once the jobs it depends on finish,
+    and is cancelled if any 'afterok' dependency fails. Each job sees the same SLURM environment variables and writes the same
+    log files as it would under SLURM, with its job ID taken from the time the graph is run.
+
+    Arguments:
+    ----------
+    graph : class ``JobGraph``
+        Job graph to run.
+    jobs : int, optional
+        Maximum number of jobs (or job array tasks) run at once."""
+
+    def __init__(self, graph, jobs=1):
+
+        self.graph = graph
+        self.jobs = max(1, jobs)
+        base = int(time.time()) * 1000
+        self.IDs = [str(base + i) for i in range(len(graph))]
+        self.directives = [sbatch_directives(os.path.join(job.dir, job.sbatch)) for job in graph.jobs]
+
+        #Each unit is a job, or a task of a job array, identified by (index of job, task ID or None)
+        self.units = []
+        for i,directives in enumerate(self.directives):
+            if 'array' in directives:
+                first,last = directives['array'].split('%')[0].split('-')
+                self.units.extend([(i, task) for task in range(int(first), int(last)+1)])
+            else:
+                self.units.append((i, None))
+
+        self.state = {} #State of each unit that is finished - 'ok', 'failed' or 'cancelled'
+
+    def dependencies(self, unit):
+
+        """Return the list of (dependency type, unit) that a unit depends on."""
+
+        deps = []
+        for j,dep_type,task in self.graph.jobs[unit[0]].deps:
+            deps.extend([(dep_type, dep) for dep in self.units if dep[0] == j and (task is None or dep[1] == task)])
+        return deps
+
+    def ready(self, unit):
+
+        """Return whether a unit can be run (True), must be cancelled (None), or must wait (False)."""
+
+        deps = self.dependencies(unit)
+        if any([dep not in self.state for dep_type,dep in deps]):
+            return False
+        if any([dep_type == 'afterok' and self.state[dep] != 'ok' for dep_type,dep in deps]):
+            return None
+        return True
+
+    def environ(self, unit):
+
+        """Return the environment (including SLURM variables) that a unit is run in."""
+
+        i,task = unit
+        directives = self.directives[i]
+        env = os.environ.copy()
+        env['SLURM_JOB_ID'] = self.IDs[i]
+        env['SLURM_JOB_NAME'] = directives.get('job-name', self.graph.jobs[i].name)
+        env['SLURM_CPUS_PER_TASK'] = directives.get('cpus-per-task', '1')
+        env['SLURM_NTASKS'] = str(int(directives.get('nodes', 1)) * int(directives.get('ntasks-per-node', 1)))
+        if task is not None:
+            env['SLURM_ARRAY_JOB_ID'] = self.IDs[i]
+            env['SLURM_ARRAY_TASK_ID'] = str(task)
+        return env
+
+    def log(self, unit, key, env):
+
+        """Return the path of the output or error log of a unit, replacing the SLURM filename patterns."""
+
+        i,task = unit
+        fname = self.directives[i].get(key, '{0}-%j.{1}'.format(self.graph.jobs[i].name, 'out' if key == 'output' else 'err'))
+        for pattern,value in [('%x',env['SLURM_JOB_NAME']), ('%j',self.IDs[i]), ('%A',self.IDs[i]), ('%a',str(task))]:
+            fname = fname.replace(pattern, value)
+        return os.path.join(self.graph.jobs[i].dir, fname)
+
+    def run_unit(self, unit):
+
+        """Run a unit with bash, from its directory, and return whether it succeeded."""
+
+        job = self.graph.jobs[unit[0]]
+        env = self.environ(unit)
+        out,err = self.log(unit, 'output', env),self.log(unit, 'error', env)
+        for log in [out,err]:
+            if not os.path.exists(os.path.dirname(log)):
+                os.makedirs(os.path.dirname(log))
+
+        with open(out, 'w') as stdout, open(err, 'w') as stderr:
+            proc = subprocess.run(['bash', job.sbatch], cwd=job.dir, env=env, stdout=stdout, stderr=stderr)
+        return proc.returncode == 0
+
+    def run(self):
+
+        """Run all jobs, and return the job ID of each job in the graph.
+
+        Returns:
+        --------
+        IDs : list
+            Job ID of each job in the graph.
+        failed : list
+            Names (with directory) of jobs that failed or were cancelled."""
+
+        if any([len(job.external) > 0 for job in self.graph.jobs]):
+            logger.warning('Ignoring dependencies on jobs outside this pipeline run, which are not known when running locally.')
+
+        pending = list(self.units)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while len(pending) > 0 or len(running) > 0:
+                for unit in pending[:]:
+                    ready = self.ready(unit)
+                    if ready is None:
+                        self.state[unit] = 'cancelled'
+                        pending.remove(unit)
+                    elif ready and len(running) < self.jobs:
+                        job = self.graph.jobs[unit[0]]
+                        logger.info("Running '{0}'{1} in '{2}' with job ID {3}.".format(job.sbatch,'' if unit[1] is None else ' (task {0})'.format(unit[1]),job.dir,self.IDs[unit[0]]))
+                        running[pool.submit(self.run_unit, unit)] = unit
+                        pending.remove(unit)
+
+                #Cancelling a unit may make others ready (to cancel), so check again before waiting
+                if len(running) == 0:
+                    if len(pending) > 0 and all([self.ready(unit) is False for unit in pending]):
+                        raise RuntimeError('Jobs {0} can never run.'.format(pending))
+                    continue
+
+                done,__ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    unit = running.pop(future)
+                    try:
+                        self.state[unit] = 'ok' if future.result() else 'failed'
+                    except Exception as err:
+                        logger.error('Exception found while running {0}: {1}'.format(unit,err))
+                        self.state[unit] = 'failed'
+                    if self.state[unit] == 'failed':
+                        logger.error("'{0}' failed in '{1}'. See '{2}'.".format(self.graph.jobs[unit[0]].sbatch,self.graph.jobs[unit[0]].dir,self.log(unit, 'error', self.environ(unit))))
+
+        failed = []
+        for unit in self.units:
+            name = os.path.join(self.graph.jobs[unit[0]].dir, self.graph.jobs[unit[0]].name)
+            if self.state[unit] != 'ok' and name not in failed:
+                failed.append(name)
+
+        return self.IDs, failed
+
+def parse_args():
+
+    """Parse arguments into this script.
+
+    Returns:
+    --------
+    args : class ``argparse.ArgumentParser``
+        Known and validated arguments."""
+
+    parser = argparse.ArgumentParser(prog=sys.argv[0],description='Submit a pipeline job graph to SLURM (or run it locally), and output the bash variables assigned the job IDs.')
+    parser.add_argument("graph", help="Job graph (JSON file) written by processMeerKAT.py.")
+    parser.add_argument("-l","--local", action="store_true", required=False, default=False, help="Run jobs on this machine without SLURM, waiting until they finish [default: False].")
+    parser.add_argument("-j","--jobs", metavar="num", required=False, type=int, default=1, help="Maximum number of jobs run at once with [-l --local] [default: 1].")
+    parser.add_argument("-v","--verbose", action="store_true", required=False, default=False, help="Verbose output? [default: False].")
+
+    args, unknown = parser.parse_known_args()
+
+    if len(unknown) > 0:
+        parser.error('Unknown input argument(s) present - {0}'.format(unknown))
+
+    return args
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    #Log to stderr, and only write bash variables to stdout, to be evaluated by master script
+    graph = JobGraph.read(args.graph)
+    skipped = graph.skip_completed()
+    if len(skipped) > 0:
+        logger.info('Skipping the following jobs, whose steps already completed with the same config and data: {0}'.format(', '.join(skipped)))
+
+    failed = []
+    if args.local:
+        IDs,failed = LocalExecutor(graph, args.jobs).run()
+    else:
+        try:
+            IDs = graph.submit()
+        except Exception:
+            sys.exit(1)
+
+    #Record job IDs in graph, so the jobs of this run can be found later (e.g. by telemetry.py)
+    graph.IDs = IDs
+    graph.write(args.graph)
+
+    for var,IDs in graph.idvars(IDs):
+        print('{0}={1}'.format(var,IDs))
+
+    if len(failed) > 0:
+        logger.error('The following jobs failed or were cancelled: {0}'.format(', '.join(failed)))
+        sys.exit(1)
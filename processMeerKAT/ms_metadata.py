@@ -0,0 +1,413 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import tempfile
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+#Snapshots already read in this process, keyed by absolute path of MS
+_SNAPSHOTS = {}
+
+#Version of the snapshot contents, included in its key so that snapshots written by older versions (e.g. missing fields) are rebuilt.
+#Increment whenever build() or write() change what the snapshot contains.
+SNAPSHOT_VERSION = 3
+
+FREQ_UNITS = {'Hz' : 1.0, 'kHz' : 1e3, 'MHz' : 1e6, 'GHz' : 1e9}
+
+#Blocks of rows read from the FLAG column, spread evenly through each SPW, to sample the unflagged fraction of each channel (only when
+#requested, e.g. by read_ms.py to plan the bounds of several SPWs)
+FLAG_SAMPLE_BLOCKS = 16
+FLAG_SAMPLE_ROWS = 256
+
+def sidecar_paths(MS):
+
+    """Return the candidate paths of the metadata snapshot of an MS, in the order they are searched. The snapshot is written
+    alongside the MS where possible, otherwise in the current directory. The parent directory is also searched, for SPW directories
+    that read an MS whose snapshot was written in the top-level directory.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+
+    Returns:
+    --------
+    paths : list
+        List of candidate paths."""
+
+    MS = os.path.abspath(MS)
+    fname = '{0}.metadata.json'.format(os.path.basename(MS))
+    paths = [os.path.join(os.path.dirname(MS), fname), os.path.join(os.getcwd(), fname), os.path.join(os.path.dirname(os.getcwd()), fname)]
+
+    #Remove duplicates, preserving order
+    return [path for i,path in enumerate(paths) if path not in paths[:i]]
+
+def ms_key(MS):
+
+    """Return the key that identifies the current state of an MS, which is its absolute path and modification time,
+    and the version of the snapshot contents.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+
+    Returns:
+    --------
+    key : dict
+        Absolute path and modification time (ns) of MS, and snapshot version."""
+
+    return {'path' : os.path.abspath(MS), 'mtime' : os.stat(MS).st_mtime_ns, 'version' : SNAPSHOT_VERSION}
+
+def flags_mtime(MS):
+
+    """Return the latest modification time (ns) of the files of the main table of an MS (and of each sub-MS of an MMS), which change
+    whenever its rows are rewritten (e.g. the FLAG column by flagdata), unlike the modification time of the MS directory itself.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+
+    Returns:
+    --------
+    mtime : int
+        Modification time (ns), or None if the MS has no files."""
+
+    tables = [MS] + sorted(glob.glob(os.path.join(MS, 'SUBMSS', '*')))
+    paths = [os.path.join(table,fname) for table in tables for fname in os.listdir(table) if fname != 'table.lock']
+    mtimes = [os.stat(path).st_mtime_ns for path in paths if os.path.isfile(path)]
+    return max(mtimes) if len(mtimes) > 0 else None
+
+def _tolist(obj):
+
+    """Convert numpy types to native types for JSON serialisation."""
+
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('Object of type {0} is not JSON serializable'.format(type(obj).__name__))
+
+def build(msmd):
+
+    """Build a metadata snapshot from an open msmetadata tool.
+
+    Arguments:
+    ----------
+    msmd : class ``casatools.msmetadata``
+        msmetadata tool, opened on the MS.
+
+    Returns:
+    --------
+    meta : dict
+        Dictionary of metadata."""
+
+    intents = list(msmd.intents())
+    spws = range(msmd.nspw())
+
+    meta = {'fieldnames' : list(msmd.fieldnames()),
+            'intents' : intents,
+            'fieldsforintent' : {intent : msmd.fieldsforintent(intent) for intent in intents},
+            'scansforfield' : {str(field) : msmd.scansforfield(field) for field in range(msmd.nfields())},
+            'antennasforscan' : {str(scan) : msmd.antennasforscan(scan) for scan in msmd.scannumbers()},
+            'ntimesforscan' : {str(scan) : len(msmd.timesforscan(scan)) for scan in msmd.scannumbers()},
+            'exposuretime' : msmd.exposuretime(scan=int(msmd.scannumbers()[0]))['value'] if msmd.nscans() > 0 else None,
+            'nscans' : msmd.nscans(),
+            'nrows' : msmd.nrows(),
+            'chanfreqs' : [msmd.chanfreqs(spw) for spw in spws],
+            'bandwidths' : msmd.bandwidths(-1),
+            'ncorrforpol' : msmd.ncorrforpol(),
+            'antennanames' : list(msmd.antennanames()),
+            'antennaids' : msmd.antennaids(),
+            'antennastations' : list(msmd.antennastations()),
+            'antennadiameter' : msmd.antennadiameter(),
+            'sourcedirs' : msmd.sourcedirs()}
+
+    #Round-trip through JSON so the snapshot is identical whether just built or read from disk
+    return json.loads(json.dumps(meta, default=_tolist))
+
+def sample_unflagged(MS, msmd):
+
+    """Return the unflagged fraction of each channel of each SPW of an MS, sampled from blocks of rows of the FLAG column.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    msmd : class ``casatools.msmetadata``
+        msmetadata tool, opened on the MS.
+
+    Returns:
+    --------
+    sample : dict
+        Unflagged fraction of each channel, for each SPW ('fractions'), and modification time of the main table when sampled ('mtime')."""
+
+    from casatools import table
+    mtime = flags_mtime(MS)
+    tb = table()
+    tb.open(MS)
+    unflagged = []
+    try:
+        for spw in range(msmd.nspw()):
+            ddids = list(msmd.datadescids(spw=spw))
+            sub = tb if msmd.nspw() == 1 else tb.query('DATA_DESC_ID IN {0}'.format(ddids))
+            nrows = sub.nrows()
+            nblock = min(FLAG_SAMPLE_ROWS, nrows)
+            counts = np.zeros(len(msmd.chanfreqs(spw)))
+            nsampled = 0
+            if nblock > 0:
+                for start in sorted(set(np.linspace(0, nrows - nblock, FLAG_SAMPLE_BLOCKS, dtype=int))):
+                    flags = sub.getcol('FLAG', int(start), nblock) #shape (ncorr, nchan, nrows)
+                    counts += np.sum(~flags, axis=(0,2))
+                    nsampled += flags.shape[0] * flags.shape[2]
+            if sub is not tb:
+                sub.close()
+            unflagged.append(counts / nsampled if nsampled > 0 else counts)
+    finally:
+        tb.close()
+    return {'fractions' : [fraction.tolist() for fraction in unflagged], 'mtime' : mtime}
+
+def previous_sample(MS):
+
+    """Return the unflagged fractions sampled in an existing snapshot of an MS, if the main table hasn't changed since, otherwise None."""
+
+    mtime = flags_mtime(MS)
+    for path in sidecar_paths(MS):
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    sample = json.load(f)['metadata'].get('unflagged')
+            except (ValueError, KeyError):
+                continue
+            if isinstance(sample, dict) and sample.get('mtime') == mtime:
+                return sample
+    return None
+
+def write(MS, msmd=None, flags=False):
+
+    """Write a metadata snapshot for an MS, alongside the MS if possible, otherwise in the current directory.
+    The snapshot is written atomically, so that concurrent jobs never read a partially written file. The unflagged
+    fraction of each channel is only sampled from the FLAG column if requested, otherwise it's kept from an existing
+    snapshot if the main table hasn't changed since.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    msmd : class ``casatools.msmetadata``, optional
+        msmetadata tool already opened on the MS. If None, one is opened and closed here.
+    flags : bool, optional
+        Sample the unflagged fraction of each channel (e.g. to plan the bounds of several SPWs)?
+
+    Returns:
+    --------
+    metadata : class ``MSMetadata``
+        Accessor for the metadata snapshot."""
+
+    key = ms_key(MS)
+    if msmd is None:
+        from casatools import msmetadata
+        tool = msmetadata()
+        tool.open(MS)
+        try:
+            meta = build(tool)
+            meta['unflagged'] = sample_unflagged(MS, tool) if flags else previous_sample(MS)
+        finally:
+            tool.done()
+    else:
+        meta = build(msmd)
+        meta['unflagged'] = sample_unflagged(MS, msmd) if flags else previous_sample(MS)
+
+    snapshot = {'key' : key, 'metadata' : meta}
+
+    for path in sidecar_paths(MS)[:2]:
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(path)), dir=os.path.dirname(path))
+        except OSError:
+            continue
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.chmod(tmp, 0o664)
+            os.replace(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        logger.debug('Wrote metadata snapshot of "{0}" to "{1}".'.format(MS,path))
+        break
+    else:
+        logger.warning('Could not write metadata snapshot of "{0}".'.format(MS))
+
+    metadata = MSMetadata(MS, meta)
+    _SNAPSHOTS[key['path']] = (key, metadata)
+    return metadata
+
+def read(MS):
+
+    """Read the metadata snapshot of an MS, if one exists that matches the current path and modification time of the MS.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+
+    Returns:
+    --------
+    metadata : class ``MSMetadata``
+        Accessor for the metadata snapshot, or None if no valid snapshot exists."""
+
+    key = ms_key(MS)
+    if key['path'] in _SNAPSHOTS and _SNAPSHOTS[key['path']][0] == key:
+        return _SNAPSHOTS[key['path']][1]
+
+    for path in sidecar_paths(MS):
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except ValueError:
+                logger.warning('Ignoring corrupt metadata snapshot "{0}".'.format(path))
+                continue
+            if snapshot.get('key') == key:
+                metadata = MSMetadata(MS, snapshot['metadata'])
+                _SNAPSHOTS[key['path']] = (key, metadata)
+                return metadata
+
+    return None
+
+def get(MS):
+
+    """Return the metadata of an MS, reading its snapshot if it is up to date, otherwise (re-)building and writing it.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+
+    Returns:
+    --------
+    metadata : class ``MSMetadata``
+        Accessor for the metadata snapshot."""
+
+    metadata = read(MS)
+    if metadata is None:
+        logger.info('Building metadata snapshot of "{0}".'.format(MS))
+        metadata = write(MS)
+    return metadata
+
+class MSMetadata(object):
+
+    """Read-only accessor to a metadata snapshot of an MS, with methods that mirror the subset of the
+    ``casatools.msmetadata`` interface used by the pipeline, so it can be used in place of an open msmetadata tool.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    meta : dict
+        Dictionary of metadata, as returned by build()."""
+
+    def __init__(self, MS, meta):
+
+        self.MS = MS
+        self.meta = meta
+
+    def fieldnames(self):
+        return list(self.meta['fieldnames'])
+
+    def nfields(self):
+        return len(self.meta['fieldnames'])
+
+    def fieldsforname(self, name=''):
+        return np.array([i for i,field in enumerate(self.meta['fieldnames']) if field == name], dtype=int)
+
+    def namesforfields(self, fieldids=None):
+        if fieldids is None:
+            return self.fieldnames()
+        return [self.meta['fieldnames'][int(i)] for i in np.atleast_1d(fieldids)]
+
+    def intents(self):
+        return np.array(self.meta['intents'])
+
+    def fieldsforintent(self, intent):
+        return np.array(self.meta['fieldsforintent'].get(intent, []), dtype=int)
+
+    def scansforfield(self, field):
+        if not str(field).isdigit():
+            field = self.fieldsforname(field)[0]
+        return np.array(self.meta['scansforfield'][str(field)], dtype=int)
+
+    def antennasforscan(self, scan):
+        return np.array(self.meta['antennasforscan'][str(scan)], dtype=int)
+
+    def scannumbers(self):
+        return np.array(sorted([int(scan) for scan in self.meta['antennasforscan']]), dtype=int)
+
+    def ntimesforscan(self, scan):
+        #Not present in snapshots written by earlier versions
+        return self.meta.get('ntimesforscan', {}).get(str(scan))
+
+    def exposuretime(self):
+        #Integration time (s) of the first scan, not present in snapshots written by earlier versions
+        return self.meta.get('exposuretime')
+
+    def nscans(self):
+        return self.meta['nscans']
+
+    def nrows(self):
+        #Not present in snapshots written by earlier versions
+        return self.meta.get('nrows')
+
+    def nspw(self):
+        return len(self.meta['chanfreqs'])
+
+    def chanfreqs(self, spw, unit='Hz'):
+        return np.array(self.meta['chanfreqs'][spw]) / FREQ_UNITS[unit]
+
+    def unflagged(self, spw):
+        #Sampled unflagged fraction of each channel, only present if sampled and the main table hasn't changed since
+        sample = self.meta.get('unflagged')
+        if sample is None or sample['mtime'] != flags_mtime(self.MS):
+            return None
+        return np.array(sample['fractions'][spw])
+
+    def meanfreq(self, spw, unit='Hz'):
+        return np.mean(self.meta['chanfreqs'][spw]) / FREQ_UNITS[unit]
+
+    def meanchanfreq(self, unit='Hz'):
+        #Mean frequency of the channels of all SPWs (e.g. of each good channel range partitioned), not part of the msmetadata interface
+        return np.mean(np.concatenate(self.meta['chanfreqs'])) / FREQ_UNITS[unit]
+
+    def bandwidths(self, spw=-1):
+        bandwidths = np.array(self.meta['bandwidths'])
+        return bandwidths if spw == -1 else bandwidths[spw]
+
+    def ncorrforpol(self):
+        return np.array(self.meta['ncorrforpol'], dtype=int)
+
+    def nantennas(self):
+        return len(self.meta['antennanames'])
+
+    def antennanames(self):
+        return list(self.meta['antennanames'])
+
+    def antennaids(self):
+        return np.array(self.meta['antennaids'], dtype=int)
+
+    def antennastations(self, identifier=-1):
+        stations = self.meta['antennastations']
+        if identifier == -1:
+            return list(stations)
+        return [stations[int(i)] for i in np.atleast_1d(identifier)]
+
+    def antennadiameter(self):
+        return self.meta['antennadiameter']
+
+    def sourcedirs(self):
+        return self.meta['sourcedirs']
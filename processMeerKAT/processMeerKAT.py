@@ -25,8 +25,16 @@ import argparse
 import os
 import sys
 import re
+import math
 import config_parser
 import bookkeeping
+import resources
+import ms_metadata
+import step_ledger
+import flag_strategy
+import freq_ranges
+from freq_ranges import get_spw_bounds, excise_spw
+from job_graph import JobGraph, sbatch_directives
 from shutil import copyfile
 from copy import deepcopy
 import logging
@@ -41,6 +49,7 @@ TOTAL_NODES_LIMIT = 79
 CPUS_PER_NODE_LIMIT = 32
 NTASKS_PER_NODE_LIMIT = CPUS_PER_NODE_LIMIT
 MEM_PER_NODE_GB_LIMIT = 232 #237568 MB
+ARRAY_CPUS_LIMIT = 200 #Most CPUs used at once by the tasks of the partition job array
 MEM_PER_NODE_GB_LIMIT_HIGHMEM = 480 #491520 MB
 
 #Set global values for paths and file names
@@ -53,17 +62,25 @@ SELFCAL_SCRIPTS_DIR = 'selfcal_scripts'
 CONFIG = 'default_config.txt'
 TMP_CONFIG = '.config.tmp'
 MASTER_SCRIPT = 'submit_pipeline.sh'
-SPW_PREFIX = '*:'
+JOB_GRAPH = os.path.abspath(os.path.join(SCRIPT_DIR,'job_graph.py'))
+GRAPH_SCRIPT = 'jobGraph'
+TELEMETRY = os.path.abspath(os.path.join(SCRIPT_DIR,'telemetry.py'))
+SPW_PREFIX = freq_ranges.SPW_PREFIX
+MIN_SPW_WIDTH = 1 #Minimum width (MHz) of each SPW planned from the unflagged data
 
 #Set global values for field, crosscal and SLURM arguments copied to config file, and some of their default values
 FIELDS_CONFIG_KEYS = ['fluxfield','bpassfield','phasecalfield','targetfields','extrafields']
 CROSSCAL_CONFIG_KEYS = ['minbaselines','chanbin','width','timeavg','createmms','keepmms','spw','nspw','calcrefant','refant','standard','badants','badfreqranges']
+CROSSCAL_OPTIONAL_KEYS = ['rowincr','chanincr','bdatolerance','bdafov'] #Keys added since earlier versions, which scripts read with a default, so may be missing from existing config files
 SELFCAL_CONFIG_KEYS = ['nloops','loop','cell','robust','imsize','wprojplanes','niter','threshold','uvrange','nterms','gridder','deconvolver','solint','calmode','discard_nloops','gaintype','outlier_threshold','flag','outlier_radius']
 IMAGING_CONFIG_KEYS = ['cell', 'robust', 'imsize', 'wprojplanes', 'niter', 'threshold', 'multiscale', 'nterms', 'gridder', 'deconvolver', 'restoringbeam', 'stokes', 'mask', 'rmsmap','outlierfile', 'pbthreshold', 'pbband']
+FLAGGING_CONFIG_KEYS = ['round_1','round_2'] #Optional, since the defaults are used for any strategy missing from the config file
 SLURM_CONFIG_STR_KEYS = ['container','mpi_wrapper','partition','time','name','dependencies','exclude','account','reservation']
 SLURM_CONFIG_KEYS = ['nodes','ntasks_per_node','mem','plane','submit','precal_scripts','postcal_scripts','scripts','verbose','modules'] + SLURM_CONFIG_STR_KEYS
+SLURM_OPTIONAL_KEYS = ['readbandwidth'] #Aggregate read bandwidth (MB/s) of the filesystem, which defaults to resources.FS_READ_BANDWIDTH if missing
 CONTAINER = '/idia/software/containers/casa-6.5.0-modular.sif'
 MPI_WRAPPER = 'mpirun'
+LOCAL_MPI_WRAPPER = 'mpirun -n {0}' #MPI wrapper for threadsafe scripts when running pipeline locally, with total number of tasks
 PRECAL_SCRIPTS = [('calc_refant.py',False,''),('partition.py',True,'')] #Scripts run before calibration at top level directory when nspw > 1
 POSTCAL_SCRIPTS = [('concat.py',False,''),('plotcal_spw.py', False, ''),('selfcal_part1.py',True,''),('selfcal_part2.py',False,''),('science_image.py', True, '')] #Scripts run after calibration at top level directory when nspw > 1
 SCRIPTS = [ ('validate_input.py',False,''),
@@ -77,6 +94,10 @@ SCRIPTS = [ ('validate_input.py',False,''),
             ('xx_yy_apply.py',True,''),
             ('split.py',True,''),
             ('quick_tclean.py',True,'')]
+CALTABLE_SCRIPTS = ['plotcal_spw.sbatch'] #Postcal scripts that only read the caltables in SPW directories, so run once these are written
+UNGROUPED_SCRIPTS = ['selfcal_part1.sbatch','selfcal_part2.sbatch'] + CALTABLE_SCRIPTS #Scripts never packed into a step group, since they're repeated or have their own dependencies
+GROUPED_SCRIPTS = ['validate_input.sbatch','calc_refant.sbatch','setjy.sbatch','xx_yy_solve.sbatch','xy_yx_solve.sbatch','show_ant_stats.sbatch'] #Short serial scripts (reading only metadata or calibrators) packed into step groups
+GROUP_TIME_LIMIT = '1-00:00:00' #Most time requested by a step group, unless one of its steps requests more
 
 
 def check_path(path,update=False):
@@ -199,7 +220,7 @@ def parse_args():
     parser.add_argument("-A","--account", metavar="group", required=False, type=str, default='b03-idia-ag', help="SLURM accounting group to use (e.g. 'b05-pipelines-ag' - check 'sacctmgr show user $USER cluster=ilifu-slurm20 -s format=account%%30') [default: 'b03-idia-ag'].")
     parser.add_argument("-r","--reservation", metavar="name", required=False, type=str, default='', help="SLURM reservation to use. [default: ''].")
 
-    parser.add_argument("-l","--local", action="store_true", required=False, default=False, help="Build config file locally (i.e. without calling srun) [default: False].")
+    parser.add_argument("-l","--local", action="store_true", required=False, default=False, help="Build config file locally (i.e. without calling srun), or run pipeline locally (i.e. without SLURM) [default: False].")
     parser.add_argument("-s","--submit", action="store_true", required=False, default=False, help="Submit jobs immediately to SLURM queue [default: False].")
     parser.add_argument("-v","--verbose", action="store_true", required=False, default=False, help="Verbose output? [default: False].")
     parser.add_argument("-q","--quiet", action="store_true", required=False, default=False, help="Activate quiet mode, with suppressed output [default: False].")
@@ -366,7 +387,7 @@ def write_command(script,args,name='job',mpi_wrapper=MPI_WRAPPER,container=CONTA
     command : str
         Bash command to call with srun or within sbatch file."""
 
-    arrayJob = ',' in SPWs and 'partition' in script and nspw > 1
+    arrayJob = partition_array(script,SPWs,nspw)
 
     #Store parameters passed into this function as dictionary, and add to it
     params = locals()
@@ -406,8 +427,28 @@ def write_command(script,args,name='job',mpi_wrapper=MPI_WRAPPER,container=CONTA
     return command
 
 
+def partition_array(script,SPWs,nspw):
+
+    """Return whether a script is the partition job array, which partitions each SPW in a separate task, straight from the input MS.
+
+    Arguments:
+    ----------
+    script : str
+        Path to script or sbatch file.
+    SPWs : str
+        Comma-separated list of spw ranges.
+    nspw : int
+        Number of spectral windows.
+
+    Returns:
+    --------
+    array : bool
+        Is this script run as a job array?"""
+
+    return 'partition' in script and ',' in SPWs and nspw > 1
+
 def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="job",runname='',plane=1,exclude='',mpi_wrapper=MPI_WRAPPER,container=CONTAINER,
-                partition="Main",time="12:00:00",casa_script=False,SPWs='',nspw=1,account='b03-idia-ag',reservation='',modules=[],justrun=False):
+                partition="Main",time="12:00:00",casa_script=False,SPWs='',nspw=1,account='b03-idia-ag',reservation='',modules=[],justrun=False,estimated=False,nconcurrent=None,cpus=None):
 
     """Write a SLURM sbatch file calling a certain script (and args) with a particular configuration.
 
@@ -454,7 +495,13 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
     modules : list, optional
         Modules to load upon execution of sbatch script.
     justrun : bool, optionall
-        Just run the pipeline without rebuilding each job script (if it exists)."""
+        Just run the pipeline without rebuilding each job script (if it exists).
+    estimated : bool, optional
+        Were the tasks and memory estimated from the size of the data? If so, the memory isn't increased to the node limit when requesting all CPUs.
+    nconcurrent : int, optional
+        Number of partition array tasks to run at once, e.g. sized from the read throughput of the filesystem. The array never uses more than ARRAY_CPUS_LIMIT CPUs at once.
+    cpus : int, optional
+        CPUs per task estimated from the size of the data, requested if more than used by this script by default."""
 
     if not os.path.exists(LOG_DIR):
         os.mkdir(LOG_DIR)
@@ -467,6 +514,10 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
     params['cpus'] = 1
     if 'tclean' in script or 'selfcal' in script or 'partition' in script or 'image' in script:
         params['cpus'] = int(CPUS_PER_NODE_LIMIT/tasks)
+    #Use one CPU per task of the input SLURM configuration for concat, which concatenates each field / product in a separate process
+    elif 'concat' in script:
+        ntasks = config_parser.get_key(TMP_CONFIG, 'slurm', 'ntasks_per_node')
+        params['cpus'] = min(int(ntasks), CPUS_PER_NODE_LIMIT) if ntasks != '' else 1
     #hard-code for 2/4 polarisations
     if 'partition' in script:
         dopol = config_parser.get_key(TMP_CONFIG, 'run', 'dopol')
@@ -474,9 +525,11 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
             params['cpus'] = 4
         elif not dopol and params['cpus'] > 2:
             params['cpus'] = 2
+    if cpus is not None and cpus > params['cpus']:
+        params['cpus'] = cpus
 
-    #If requesting all CPUs, user may as well use all memory
-    if params['cpus'] * tasks == CPUS_PER_NODE_LIMIT:
+    #If requesting all CPUs, user may as well use all memory (unless memory was estimated from data)
+    if params['cpus'] * tasks == CPUS_PER_NODE_LIMIT and not estimated:
         if params['partition'] == 'HighMem':
             params['mem'] = MEM_PER_NODE_GB_LIMIT_HIGHMEM
         else:
@@ -491,13 +544,15 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
         casa_script = False
         casacore = False
 
-    #Limit number of concurrent jobs for partition so that no more than 200 CPUs used at once
-    nconcurrent = int(200 / (params['nodes'] * params['tasks'] * params['cpus']))
+    #Limit number of concurrent jobs for partition so that no more than 200 CPUs used at once, and fewer if the filesystem can't feed them
+    cpu_limit = max(1, int(ARRAY_CPUS_LIMIT / (params['nodes'] * params['tasks'] * params['cpus'])))
+    if nconcurrent is None or nconcurrent > cpu_limit:
+        nconcurrent = cpu_limit
     if nconcurrent > nspw:
         nconcurrent = nspw
 
     params['command'] = write_command(script,args,name=name,mpi_wrapper=mpi_wrapper,container=container,casa_script=casa_script,plot=plot,SPWs=SPWs,nspw=nspw)
-    if 'partition' in script and ',' in SPWs and nspw > 1:
+    if partition_array(script,SPWs,nspw):
         params['ID'] = '%A_%a'
         params['array'] = '\n#SBATCH --array=0-{0}%{1}'.format(nspw-1,nconcurrent)
     else:
@@ -546,9 +601,227 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
         config.close()
         logger.debug('Wrote sbatch file "{0}"'.format(sbatch))
 
+def slurm_seconds(time):
+
+    """Convert a SLURM time limit (minutes, MM:SS, HH:MM:SS, D-HH, D-HH:MM or D-HH:MM:SS) to seconds."""
+
+    days = 0
+    if '-' in time:
+        days,time = time.split('-')
+        parts = [int(part) for part in time.split(':')]
+        parts += [0] * (3 - len(parts))
+    else:
+        parts = [int(part) for part in time.split(':')]
+        parts = [0] * (3 - len(parts)) + parts if len(parts) > 1 else [0, parts[0], 0]
+    return int(days)*86400 + parts[0]*3600 + parts[1]*60 + parts[2]
+
+def slurm_time(seconds):
+
+    """Convert seconds to a SLURM time limit (D-HH:MM:SS)."""
+
+    return '{0}-{1:02d}:{2:02d}:{3:02d}'.format(seconds // 86400, seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+def write_group_sbatch(sbatches,runname='',justrun=False):
+
+    """Write a SLURM sbatch file that runs a group of (serial) sbatch files one after the other within a single job, so that short steps
+    only queue once. Each step keeps its own job name and output and error logs, and the group stops after the first step that fails.
+
+    Arguments:
+    ----------
+    sbatches : list
+        sbatch files to run, in order.
+    runname : str, optional
+        Unique name to give this pipeline run, appended to the start of all job names.
+    justrun : bool, optional
+        Just run the pipeline without rebuilding each job script (if it exists).
+
+    Returns:
+    --------
+    sbatch : str
+        Name of sbatch file of step group."""
+
+    #Name the group after its first and last steps (e.g. 'calc_refant_to_xx_yy_solve'), keeping job and file names short
+    names = [os.path.splitext(sbatch)[0] for sbatch in sbatches]
+    group = '{0}_to_{1}'.format(names[0],names[-1])
+    sbatch = '{0}.sbatch'.format(group)
+    if justrun and os.path.exists(sbatch):
+        logger.debug('sbatch file "{0}" exists. Not overwriting due to [-j --justrun] option.'.format(sbatch))
+        return sbatch
+
+    #Request the most CPUs and memory of any step and the total time of all steps (up to GROUP_TIME_LIMIT), with the rest of the SLURM configuration from the first step
+    directives = [sbatch_directives(fname) for fname in sbatches]
+    header,bodies = [],[]
+    for i,fname in enumerate(sbatches):
+        lines = open(fname).read().splitlines()
+        if i == 0:
+            header = [line for line in lines if line.startswith('#')]
+        bodies.append('\n'.join([line for line in lines if not line.startswith('#') and line.strip() != '']))
+
+    times = [slurm_seconds(d['time']) for d in directives]
+    replace = {'job-name' : runname + group,
+               'cpus-per-task' : str(max([int(d['cpus-per-task']) for d in directives])),
+               'mem' : '{0}GB'.format(max([int(d['mem'].replace('GB','')) for d in directives])),
+               'time' : slurm_time(max(min(sum(times), slurm_seconds(GROUP_TIME_LIMIT)), max(times)))}
+    for key in replace:
+        header = [re.sub(r'^#SBATCH --{0}=.*'.format(key), '#SBATCH --{0}={1}'.format(key,replace[key]), line) for line in header]
+
+    #Name the logs of each step after the group's job ID, or the process ID when run without SLURM
+    contents = '\n'.join(header) + '\n'
+    contents += 'export SLURM_JOB_ID=${SLURM_JOB_ID:-$$}\n'
+    for name,body in zip(names,bodies):
+        job = '{0}{1}'.format(runname,name)
+        contents += '\n#Run {0}.sbatch, with its own job name and logs, stopping if it fails\n'.format(name)
+        contents += 'export SLURM_JOB_NAME={0}\n'.format(job)
+        contents += '(\n{0}\n) > {1}/{2}-${{SLURM_JOB_ID}}.out 2> {1}/{2}-${{SLURM_JOB_ID}}.err || exit 1\n'.format(body,LOG_DIR,job)
+
+    config = open(sbatch,'w')
+    config.write(contents)
+    config.close()
+    logger.debug('Wrote sbatch file "{0}" for step group {1}'.format(sbatch,names))
+
+    return sbatch
+
+def group_scripts(scripts,threadsafe,runname='',justrun=False):
+
+    """Pack each run of consecutive short serial sbatch files (in GROUPED_SCRIPTS) into a step group, run within a single job.
+
+    Arguments:
+    ----------
+    scripts : list
+        sbatch files to run, in order.
+    threadsafe : list
+        Is each script threadsafe (for MPI)?
+    runname : str, optional
+        Unique name to give this pipeline run, appended to the start of all job names.
+    justrun : bool, optional
+        Just run the pipeline without rebuilding each job script (if it exists).
+
+    Returns:
+    --------
+    scripts : list
+        sbatch files to run, in order, with each step group replacing the scripts it runs."""
+
+    grouped,run = [],[]
+    for script,safe in zip(scripts + [None],threadsafe + [True]):
+        if script is not None and not safe and script in GROUPED_SCRIPTS and script not in UNGROUPED_SCRIPTS and 'array' not in sbatch_directives(script):
+            run.append(script)
+            continue
+        if len(run) > 1:
+            grouped.append(write_group_sbatch(run,runname=runname,justrun=justrun))
+        else:
+            grouped.extend(run)
+        run = []
+        if script is not None:
+            grouped.append(script)
+
+    return grouped
+
+def selfcal_scripts(config,scripts):
+
+    """Duplicate selfcal scripts to perform the correct number of selfcal loops.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+    scripts : list
+        List of sbatch scripts to call in order.
+
+    Returns:
+    --------
+    scripts : list
+        List of sbatch scripts, with selfcal scripts repeated for each loop."""
+
+    #Hack to perform correct number of selfcal loops
+    if config_parser.has_section(config,'selfcal') and 'selfcal_part1.sbatch' in scripts and 'selfcal_part2.sbatch' in scripts:
+        start_loop = config_parser.get_key(config, 'selfcal', 'loop')
+        selfcal_loops = config_parser.get_key(config, 'selfcal', 'nloops') - start_loop
+        idx = scripts.index('selfcal_part2.sbatch')
+
+        #check that we're doing nloops in order, otherwise don't duplicate scripts
+        if idx == scripts.index('selfcal_part1.sbatch') + 1:
+            init_scripts = scripts[:idx+1]
+            final_scripts = scripts[idx+1:]
+            init_scripts.extend(['selfcal_part1.sbatch','selfcal_part2.sbatch']*(selfcal_loops-1))
+            init_scripts.append('selfcal_part1.sbatch')
+            scripts = init_scripts + final_scripts
+
+    return scripts
+
+def graph_file(dir,timestamp):
+
+    """Return path to job graph file of a pipeline run."""
+
+    return '{0}/{1}_{2}.json'.format(dir,GRAPH_SCRIPT,timestamp)
+
+def submit_graph(master,graph,filename,verbose=False,slurm_kwargs={}):
+
+    """Write job graph to file, and write command to master script that submits it (or runs it locally) and assigns the job IDs to bash variables.
+    The exit status of the command is stored in the bash variable 'status', with which the master script exits after writing the ancillary job scripts.
+
+    Arguments:
+    ----------
+    master : class ``file``
+        Master script to which to write contents.
+    graph : class ``job_graph.JobGraph``
+        Job graph to submit.
+    filename : str
+        Path to write job graph.
+    verbose : bool, optional
+        Verbose output (inserted into master script)?
+    slurm_kwargs : list, optional
+        Parameters parsed from [slurm] section of config."""
+
+    graph.write(filename)
+    options = ' --verbose' if verbose else ''
+
+    #Identify this execution of the master script to each job, so steps already completed in a previous execution can be skipped
+    master.write('\nexport {0}=${{{0}:-$(date +%Y-%m-%d-%H-%M-%S-%N)}}\n'.format(step_ledger.RUN_ID))
+
+    #Run as many jobs at once as fit on this machine
+    if slurm_kwargs.get('local', False):
+        jobs = max(1, int((os.cpu_count() or 1) // (slurm_kwargs['nodes'] * slurm_kwargs['ntasks_per_node'])))
+        options += ' --local --jobs {0}'.format(jobs)
+        master.write('\n#Run each sbatch job on this machine, with dependencies on the jobs it consumes, and extract job IDs\n')
+    else:
+        master.write('\n#Submit each sbatch job, with dependencies on the jobs it consumes, and extract job IDs\n')
+    master.write('output=$({0} {1} {2}{3})\n'.format(sys.executable,JOB_GRAPH,filename,options))
+    master.write('status=$?\n')
+    master.write('eval "$output"\n')
+
+def write_spw_jobs(spw,config,local=False,partitioned=True):
+
+    """Write the sbatch files and job graph within an SPW directory, from the SPW's config file written by spw_split(),
+    by running the pipeline [-R --run] within this process. The SPW's config file is read from memory, rather than parsed again.
+
+    Arguments:
+    ----------
+    spw : str
+        SPW directory.
+    config : str
+        Path to config file (relative to SPW directory).
+    local : bool, optional
+        Run pipeline locally (i.e. without SLURM)?
+    partitioned : bool, optional
+        Is the MS partitioned (by a precal job) before the jobs in the SPW directory run?"""
+
+    if not os.path.isdir(spw):
+        logger.error("Directory '{0}' doesn't exist. Skipping writing its jobs.".format(spw))
+        return
+
+    logger.debug("Writing jobs in directory '{0}'.".format(spw))
+    cwd = os.getcwd()
+    os.chdir(spw)
+    try:
+        kwargs = format_args(config,submit=False,quiet=True,dependencies='',justrun=False,local=local)
+        write_jobs(config, partitioned=partitioned, **kwargs)
+    finally:
+        os.chdir(cwd)
+
 def write_spw_master(filename,config,SPWs,precal_scripts,postcal_scripts,submit,dir='jobScripts',pad_length=5,dependencies='',timestamp='',slurm_kwargs={}):
 
-    """Write master master script, which separately calls each of the master scripts in each SPW directory.
+    """Write master master script, which submits the job graph of all jobs - the precal jobs, the jobs in each of the SPW directories, and the postcal jobs.
+    Jobs within each SPW directory depend only on their own SPW's partition task, and postcal jobs depend only on the SPW jobs whose outputs they consume.
 
     filename : str
         Name of master pipeline submission script.
@@ -573,35 +846,65 @@ def write_spw_master(filename,config,SPWs,precal_scripts,postcal_scripts,submit,
     slurm_kwargs : list, optional
         Parameters parsed from [slurm] section of config."""
 
-    master = open(filename,'w')
-    master.write('#!/bin/bash\n')
     SPWs = SPWs.replace(SPW_PREFIX,'')
     toplevel = len(precal_scripts + postcal_scripts) > 0
 
-    scripts = precal_scripts[:]
-    if len(scripts) > 0:
-        command = 'sbatch'
-        if dependencies != '':
-            master.write('\n#Run after these dependencies\nDep={0}\n'.format(dependencies))
-            command += " -d afterok:${Dep//,/:} --kill-on-invalid-dep=yes" #can also use sed 's/,/:/g' or tr , :
-            dependencies = '' #Remove dependencies so it isn't fed into launching SPW scripts
-        master.write('\n#{0}\n'.format(scripts[0]))
-        master.write("allSPWIDs=$({0} {1} | cut -d ' ' -f4)\n".format(command,scripts[0]))
-        scripts.pop(0)
+    #[-R --run] pipeline in each SPW directory within this process, to create sbatch files and job graphs that can be edited
+    for spw in SPWs.split(','):
+        write_spw_jobs(spw,config,local=slurm_kwargs.get('local',False),partitioned=any(['partition' in script for script in precal_scripts]))
+
+    #Precal jobs run one after the other, with the first running after any input dependencies
+    graph = JobGraph()
+    precal = []
+    for script in precal_scripts:
+        precal.append(graph.add(script, after=precal[-1:], idvar='allSPWIDs', array=partition_array(script,SPWs,len(SPWs.split(',')))))
+    if len(precal) > 0 and dependencies != '':
+        graph.jobs[precal[0]].external = dependencies.split(',')
+        dependencies = '' #Remove dependencies so it isn't fed into SPW jobs
+
+    #Jobs in each SPW directory run after their own partition task, or after all precal jobs
+    partition = len(precal_scripts) > 0 and 'partition' in precal_scripts[-1]
+    finals,solves = [],[]
+    for i,spw in enumerate(SPWs.split(',')):
+        spw_graph_file = graph_file('{0}/{1}'.format(spw,dir),timestamp)
+        if not os.path.exists(spw_graph_file):
+            raise IOError("Job graph '{0}' not written for SPW directory '{1}'.".format(spw_graph_file,spw))
+        spw_graph = JobGraph.read(spw_graph_file)
+        indices = graph.merge(spw_graph, dir=spw, idvar='SPW{0}IDs'.format(i))
+
+        for root in spw_graph.roots():
+            if partition:
+                graph.depend(indices[root], precal[-1:], task=i)
+            elif len(precal) > 0:
+                graph.depend(indices[root], precal[-1:])
+            elif dependencies != '':
+                graph.jobs[indices[root]].external = dependencies.split(',')
+
+        #Caltables are complete after the last solve job of each SPW
+        leaves = [indices[leaf] for leaf in spw_graph.leaves()]
+        solve = [indices[j] for j,job in enumerate(spw_graph.jobs) if 'solve' in job.name]
+        finals.extend(leaves)
+        solves.extend(solve[-1:] if len(solve) > 0 else leaves)
+
+    #Postcal jobs run after all SPW jobs (even if some fail), then one after the other, other than those only reading caltables
+    scripts = selfcal_scripts(config, postcal_scripts[:])
+    last = []
     for script in scripts:
-        command = "sbatch -d afterok:${allSPWIDs//,/:} --kill-on-invalid-dep=yes"
-        master.write('\n#{0}\n'.format(script))
-        master.write("allSPWIDs+=,$({0} {1} | cut -d ' ' -f4)\n".format(command,script))
+        if script in CALTABLE_SCRIPTS:
+            graph.add(script, after=solves, dep_type='afterany', idvar='allSPWIDs')
+        elif len(last) == 0:
+            last = [graph.add(script, after=finals, dep_type='afterany', idvar='allSPWIDs')]
+        else:
+            last = [graph.add(script, after=last, idvar='allSPWIDs')]
+
+    master = open(filename,'w')
+    master.write('#!/bin/bash\n')
 
     if 'calc_refant.sbatch' in precal_scripts:
         master.write('echo Calculating reference antenna, and copying result to SPW directories.\n')
     if 'partition.sbatch' in precal_scripts:
         master.write('echo Running partition job array, iterating over {0} SPWs.\n'.format(len(SPWs.split(','))))
 
-    partition = len(precal_scripts) > 0 and 'partition' in precal_scripts[-1]
-    if partition:
-        master.write('\npartitionID=$(echo $allSPWIDs | cut -d , -f{0})\n'.format(len(precal_scripts)))
-
     #Add time as extn to this pipeline run, to give unique filenames
     killScript = 'killJobs'
     summaryScript = 'summary'
@@ -613,56 +916,29 @@ def write_spw_master(filename,config,SPWs,precal_scripts,postcal_scripts,submit,
     master.write('\n#Add time as extn to this pipeline run, to give unique filenames')
     master.write("\nDATE={0}\n".format(timestamp))
     master.write('mkdir -p {0}\n'.format(dir))
-    master.write('mkdir -p {0}\n\n'.format(LOG_DIR))
+    master.write('mkdir -p {0}\n'.format(LOG_DIR))
     extn = '_$DATE.sh'
 
+    master.write('\n#Copy contents of config file to {0} within each SPW directory\n'.format(TMP_CONFIG))
+    for spw in SPWs.split(','):
+        master.write('cp {0}/{1} {0}/{2}\n'.format(spw,config,TMP_CONFIG))
+
+    submit_graph(master, graph, graph_file(dir,timestamp), slurm_kwargs=slurm_kwargs)
+
     for i,spw in enumerate(SPWs.split(',')):
-        master.write('echo Running pipeline in directory "{1}" for spectral window {0}{1}\n'.format(SPW_PREFIX, spw))
+        master.write('\n#Write job scripts in directory "{1}" for spectral window {0}{1}\n'.format(SPW_PREFIX, spw))
         master.write('cd {0}\n'.format(spw))
-        master.write('output=$({0} --config ./{1} --run --submit --quiet --justrun'.format(os.path.split(THIS_PROG)[1],config))
-        if partition:
-            master.write(' --dependencies=$partitionID\_{0}'.format(i))
-        elif len(precal_scripts) > 0:
-            master.write(' --dependencies=$allSPWIDs')
-        elif dependencies != '':
-            master.write(' --dependencies={0}'.format(dependencies))
-        master.write(')\necho -e $output\n')
-        if i == 0:
-            master.write("IDs=$(echo $output | sed 's/.*IDs\:\s\(.*\)/\\1/')")
-        else:
-            master.write("IDs+=,$(echo $output | sed 's/.*IDs\:\s\(.*\)/\\1/')")
-        master.write('\ncd ..\n\n')
+        master.write('IDs=$SPW{0}IDs\n'.format(i))
+        master.write('echo Submitted sbatch jobs in directory "{0}" with following IDs: $IDs\n'.format(spw))
+        master.write('mkdir -p {0}\n'.format(dir))
+        master.write('cp {0} {1}/{2}_$DATE.txt\n'.format(config,dir,os.path.splitext(config)[0]))
+        write_all_bash_jobs_scripts(master,extn,IDs='IDs',dir=dir,echo=False,pad_length=pad_length,slurm_kwargs=slurm_kwargs)
+        master.write('cd ..\n')
+
+    master.write('\nIDs={0}\n'.format(','.join(['$SPW{0}IDs'.format(i) for i in range(len(SPWs.split(',')))])))
 
     if 'concat.sbatch' in postcal_scripts:
         master.write('echo Will concatenate MSs/MMSs and create quick-look continuum cube across all SPWs for all fields from \"{0}\".\n'.format(config))
-    scripts = postcal_scripts[:]
-
-    #Hack to perform correct number of selfcal loops
-    if config_parser.has_section(config,'selfcal') and 'selfcal_part1.sbatch' in scripts and 'selfcal_part2.sbatch' in scripts:
-        start_loop = config_parser.get_key(config, 'selfcal', 'loop')
-        selfcal_loops = config_parser.get_key(config, 'selfcal', 'nloops') - start_loop
-        idx = scripts.index('selfcal_part2.sbatch')
-
-        #check that we're doing nloops in order, otherwise don't duplicate scripts
-        if idx == scripts.index('selfcal_part1.sbatch') + 1:
-            init_scripts = scripts[:idx+1]
-            final_scripts = scripts[idx+1:]
-            init_scripts.extend(['selfcal_part1.sbatch','selfcal_part2.sbatch']*(selfcal_loops-1))
-            init_scripts.append('selfcal_part1.sbatch')
-            scripts = init_scripts + final_scripts
-
-    if len(scripts) > 0:
-        command = "sbatch -d afterany:${IDs//,/:}"
-        master.write('\n#{0}\n'.format(scripts[0]))
-        if len(precal_scripts) == 0:
-            master.write("allSPWIDs=$({0} {1} | cut -d ' ' -f4)\n".format(command,scripts[0]))
-        else:
-            master.write("allSPWIDs+=,$({0} {1} | cut -d ' ' -f4)\n".format(command,scripts[0]))
-        scripts.pop(0)
-        for script in scripts:
-            command = "sbatch -d afterok:${allSPWIDs//,/:} --kill-on-invalid-dep=yes"
-            master.write('\n#{0}\n'.format(script))
-            master.write("allSPWIDs+=,$({0} {1} | cut -d ' ' -f4)\n".format(command,script))
     master.write('\necho Submitted the following jobIDs within the {0} SPW directories: $IDs\n'.format(len(SPWs.split(','))))
 
     prefix = ''
@@ -691,20 +967,15 @@ def write_spw_master(filename,config,SPWs,precal_scripts,postcal_scripts,submit,
     header = '------------------------------------------------------------------------------------------' + '-'*pad_length
     write_bash_job_script(master, errorScript, extn, do % (SPWs,dir,errorScript,extn,'',header), 'find errors \(after pipeline has run\)', dir=dir,prefix=prefix)
     write_bash_job_script(master, timingScript, extn, do % (SPWs,dir,timingScript,extn,'',header), 'display start and end timestamps \(after pipeline has run\)', dir=dir,prefix=prefix)
+    write_telemetry_script(master, extn, graph_file(dir,timestamp), dir=dir)
+
+    #Exit with status of job graph (e.g. if a job failed when run locally), once the job scripts above are written
+    master.write('\nexit $status\n')
 
     #Close master submission script and make executable
     master.close()
     os.chmod(filename, 509)
 
-    #[-R --run] pipeline in each SPW directory to create sbatch files that can be edited
-    #TODO: fix this hackery!
-    SPW_run_file='out.tmp'
-    SPW_run_call = """for f in {%s,}; do if [ -d $f ]; then cd $f; %s --config ./%s --run --quiet; cd ..; else echo Directory $f doesn\\'t exist; fi; done""" % (','.join(SPWs.split(',')),os.path.split(THIS_PROG)[1],config)
-    with open(SPW_run_file,'w') as out:
-        out.write(SPW_run_call)
-    os.system('bash {0}'.format(SPW_run_file))
-    os.remove(SPW_run_file)
-
     #Submit script or output that it will not run
     if submit:
         logger.info('Running master script "{0}"'.format(filename))
@@ -752,42 +1023,22 @@ def write_master(filename,config,scripts=[],submit=False,dir='jobScripts',pad_le
         master.write("\necho Copying \'{0}\' to \'{1}\', and using this to run pipeline.\n".format(config,TMP_CONFIG))
     master.write('cp {0} {1}\n'.format(config, TMP_CONFIG))
 
-    #Hack to perform correct number of selfcal loops
-    if config_parser.has_section(config,'selfcal') and 'selfcal_part1.sbatch' in scripts and 'selfcal_part2.sbatch' in scripts:
-        start_loop = config_parser.get_key(config, 'selfcal', 'loop')
-        selfcal_loops = config_parser.get_key(config, 'selfcal', 'nloops') - start_loop
-        idx = scripts.index('selfcal_part2.sbatch')
-
-        #check that we're doing nloops in order, otherwise don't duplicate scripts
-        if idx == scripts.index('selfcal_part1.sbatch') + 1:
-            init_scripts = scripts[:idx+1]
-            final_scripts = scripts[idx+1:]
-            init_scripts.extend(['selfcal_part1.sbatch','selfcal_part2.sbatch']*(selfcal_loops-1))
-            init_scripts.append('selfcal_part1.sbatch')
-            scripts = init_scripts + final_scripts
-
-    command = 'sbatch'
+    scripts = selfcal_scripts(config, scripts)
 
-    if dependencies != '':
-        master.write('\n#Run after these dependencies\nDep={0}\n'.format(dependencies))
-        command += " -d afterok:${Dep//,/:} --kill-on-invalid-dep=yes"
-    master.write('\n#{0}\n'.format(scripts[0]))
-    if verbose:
-        master.write('echo Submitting {0} to SLURM queue with following command:\necho {1} {0}.\n'.format(scripts[0],command))
-    master.write("IDs=$({0} {1} | cut -d ' ' -f4)\n".format(command,scripts[0]))
-    scripts.pop(0)
-
-
-    #Submit each script with dependency on all previous scripts, and extract job IDs
+    #Each job runs after the previous job, with the first running after any input dependencies
+    graph = JobGraph()
+    jobs = []
     for script in scripts:
-        command = "sbatch -d afterok:${IDs//,/:} --kill-on-invalid-dep=yes"
-        master.write('\n#{0}\n'.format(script))
+        jobs.append(graph.add(script, after=jobs[-1:]))
+    if dependencies != '':
+        graph.jobs[jobs[0]].external = dependencies.split(',')
         if verbose:
-            master.write('echo Submitting {0} to SLURM queue with following command\necho {1} {0}.\n'.format(script,command))
-        master.write("IDs+=,$({0} {1} | cut -d ' ' -f4)\n".format(command,script))
+            master.write('\necho Running after these dependencies: {0}\n'.format(dependencies))
+
+    submit_graph(master, graph, graph_file(dir,timestamp), verbose=verbose, slurm_kwargs=slurm_kwargs)
 
     master.write('\n#Output message and create {0} directory\n'.format(dir))
-    master.write('echo Submitted sbatch jobs with following IDs: $IDs\n') #DON'T CHANGE as this output is relied on by bash sed expression in write_spw_master()
+    master.write('echo Submitted sbatch jobs with following IDs: $IDs\n')
     master.write('mkdir -p {0}\n'.format(dir))
 
     #Add time as extn to this pipeline run, to give unique filenames
@@ -801,6 +1052,10 @@ def write_master(filename,config,scripts=[],submit=False,dir='jobScripts',pad_le
 
     #Write each job script - kill script, summary script, error script, and timing script
     write_all_bash_jobs_scripts(master,extn,IDs='IDs',dir=dir,echo=echo,pad_length=pad_length,slurm_kwargs=slurm_kwargs)
+    write_telemetry_script(master, extn, graph_file(dir,timestamp), dir=dir, echo=echo)
+
+    #Exit with status of job graph (e.g. if a job failed when run locally), once the job scripts above are written
+    master.write('\nexit $status\n')
 
     #Close master submission script and make executable
     master.close()
@@ -859,6 +1114,26 @@ def write_all_bash_jobs_scripts(master,extn,IDs,dir='jobScripts',echo=True,prefi
     do = """echo "echo Removing the following: \$(ls -d *ms); %s rm -r *ms" """ % srun(cleanup_kwargs, qos=True, time=10, mem=0)
     write_bash_job_script(master, cleanupScript, extn, do, 'remove MSs/MMSs from this directory \(after pipeline has run\)', dir=dir, echo=echo)
 
+def write_telemetry_script(master,extn,graph,dir='jobScripts',echo=True):
+
+    """Write bash job script that stores the SLURM accounting of each job of this pipeline run in the telemetry database.
+
+    Arguments:
+    ----------
+    master : class ``file``
+        Master script to which to write contents.
+    extn : str
+        Extension to append to this job script (e.g. date & time).
+    graph : str
+        Path to job graph of this pipeline run, in which job_graph.py records the job IDs.
+    dir : str, optional
+        Directory to write this script into.
+    echo : bool, optional
+        Echo what this job script does for the user?"""
+
+    do = 'echo {0} {1} \$@ ingest {2}'.format(sys.executable,TELEMETRY,graph)
+    write_bash_job_script(master, 'telemetry', extn, do, 'store the resources used by each job \(during or after pipeline run\), then query them with {0} query'.format(TELEMETRY), dir=dir, echo=echo)
+
 def write_bash_job_script(master,filename,extn,do,purpose,dir='jobScripts',echo=True,prefix=''):
 
     """Write bash job script (e.g. jobs summary, kill all jobs, etc).
@@ -922,8 +1197,46 @@ def srun(arg_dict,qos=True,time=10,mem=4):
 
     return call
 
+def input_shapes(config, crosscal_kwargs):
+
+    """Return the shape of the visibilities read by the steps before partition, after partition and after split, from the metadata
+    snapshot of each MS once written (e.g. the partitioned MS of an SPW directory), otherwise predicted from the snapshot of the MS
+    they're written from, within the good channels of this SPW and averaged as configured.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+    crosscal_kwargs : dict
+        Keyword arguments from crosscal section of config file.
+
+    Returns:
+    --------
+    shapes : tuple
+        Shape of visibilities before partition, after partition and after split, each as returned by resources.vis_shape(), or None if unknown."""
+
+    vis = config_parser.get_key(config, 'data', 'vis')
+    orig_vis = config_parser.get_key(config, 'run', 'orig_vis')
+    crosscal_vis = config_parser.get_key(config, 'run', 'crosscal_vis')
+    spw = excise_spw(crosscal_kwargs['spw'], crosscal_kwargs['badfreqranges'])
+
+    #Config points to partitioned MS once partition has run (with original as 'orig_vis'), and to target MS once split has run (with partitioned as 'crosscal_vis')
+    partitioned_vis = crosscal_vis if crosscal_vis != '' else vis
+    shape = resources.vis_shape(orig_vis if orig_vis != '' else partitioned_vis, spw)
+
+    partitioned_shape = resources.vis_shape(partitioned_vis) if orig_vis != '' else None
+    if partitioned_shape is None:
+        partitioned_shape = resources.average(shape, crosscal_kwargs['chanbin'])
+
+    split_shape = resources.vis_shape(vis) if crosscal_vis != '' else None
+    if split_shape is None and partitioned_shape is not None:
+        split_shape = resources.average(partitioned_shape, crosscal_kwargs['width'], resources.time_factor(crosscal_kwargs['timeavg'], partitioned_shape['inttime']))
+
+    return shape, partitioned_shape, split_shape
+
 def write_jobs(config, scripts=[], threadsafe=[], containers=[], num_precal_scripts=0, mpi_wrapper=MPI_WRAPPER, nodes=8, ntasks_per_node=4, mem=MEM_PER_NODE_GB_LIMIT,plane=1, partition='Main',
-               time='12:00:00', submit=False, name='', verbose=False, quiet=False, dependencies='', exclude='', account='b03-idia-ag', reservation='', modules=[], timestamp='', justrun=False):
+               time='12:00:00', submit=False, name='', verbose=False, quiet=False, dependencies='', exclude='', account='b03-idia-ag', reservation='', modules=[], timestamp='', justrun=False, local=False,
+               partitioned=False, readbandwidth=resources.FS_READ_BANDWIDTH):
 
     """Write a series of sbatch job files to calibrate a CASA MeasurementSet.
 
@@ -974,28 +1287,71 @@ def write_jobs(config, scripts=[], threadsafe=[], containers=[], num_precal_scri
     timestamp : str, optional
         Timestamp to put on this run and related runs in SPW directories.
     justrun : bool, optionall
-        Just run the pipeline without rebuilding each job script (if it exists)."""
+        Just run the pipeline without rebuilding each job script (if it exists).
+    local : bool, optional
+        Run the pipeline locally (i.e. without SLURM), running threadsafe scripts with mpirun, and other scripts directly.
+    partitioned : bool, optional
+        Is the MS partitioned before these scripts run (e.g. by the partition job of the top-level directory, for jobs within SPW directories)?
+    readbandwidth : float, optional
+        Aggregate read bandwidth (MB/s) of the filesystem, shared by the partition tasks that read the input MS at once."""
 
     kwargs = locals()
-    crosscal_kwargs = get_config_kwargs(config, 'crosscal', CROSSCAL_CONFIG_KEYS)
+    crosscal_kwargs = get_config_kwargs(config, 'crosscal', CROSSCAL_CONFIG_KEYS, CROSSCAL_OPTIONAL_KEYS)
     pad_length = len(name)
 
+    #Locally, call threadsafe tasks with mpirun for all tasks, and other tasks directly (without srun), without loading modules
+    serial_wrapper = 'srun'
+    if local:
+        mpi_wrapper = LOCAL_MPI_WRAPPER
+        serial_wrapper = ''
+        modules = []
+
+    #Size jobs from the shape of the data each reads (from the MS metadata snapshots) and image parameters, where known
+    taskvals = config_parser.parse_config(config)[0]
+    shape, partitioned_shape, split_shape = input_shapes(config, crosscal_kwargs)
+    mem_limit = MEM_PER_NODE_GB_LIMIT_HIGHMEM if partition == 'HighMem' else MEM_PER_NODE_GB_LIMIT
+    if shape is None:
+        logger.debug('No metadata snapshot found for input MS, so using input memory and tasks for all jobs.')
+
+    #Partition tasks all read the input MS, so run as many at once as the filesystem can feed
+    nconcurrent = None
+    if any([partition_array(script,crosscal_kwargs['spw'],crosscal_kwargs['nspw']) for script in scripts]):
+        nconcurrent = resources.partition_concurrency(config_parser.get_key(config, 'data', 'vis'), crosscal_kwargs['nspw'], readbandwidth)
+
     #Write sbatch file for each input python script
     for i,script in enumerate(scripts):
         jobname = os.path.splitext(os.path.split(script)[1])[0]
 
         #Use input SLURM configuration for threadsafe tasks, otherwise call srun with single node and single thread
         if threadsafe[i]:
-            write_sbatch(script,'--config {0}'.format(TMP_CONFIG),nodes=nodes,tasks=ntasks_per_node,mem=mem,plane=plane,exclude=exclude,mpi_wrapper=mpi_wrapper,container=containers[i],partition=partition,
-                        time=time,name=jobname,runname=name,SPWs=crosscal_kwargs['spw'],nspw=crosscal_kwargs['nspw'],account=account,reservation=reservation,modules=modules,justrun=justrun)
+            job_nodes,job_tasks,job_plane,job_wrapper = nodes,ntasks_per_node,plane,mpi_wrapper
         else:
-            write_sbatch(script,'--config {0}'.format(TMP_CONFIG),nodes=1,tasks=1,mem=mem,plane=1,mpi_wrapper='srun',container=containers[i],partition=partition,time=time,name=jobname,
-                        runname=name,SPWs=crosscal_kwargs['spw'],nspw=crosscal_kwargs['nspw'],exclude=exclude,account=account,reservation=reservation,modules=modules,justrun=justrun)
-
-    #Replace all .py with .sbatch
+            job_nodes,job_tasks,job_plane,job_wrapper = 1,1,1,serial_wrapper
+
+        #Steps after partition read data averaged by 'chanbin', and steps after split read data averaged by 'width' and 'timeavg'
+        script_shape = shape
+        if any(['split' in os.path.basename(before) for before in scripts[:i]]):
+            script_shape = split_shape
+        elif partitioned or any(['partition' in os.path.basename(before) for before in scripts[:i]]):
+            script_shape = partitioned_shape
+
+        estimate = resources.estimate(script, job_nodes, job_tasks, mem_limit, CPUS_PER_NODE_LIMIT, script_shape, resources.image_params(script, taskvals))
+        job_mem = estimate.get('mem', mem)
+        job_tasks = estimate.get('tasks', job_tasks)
+        if job_plane > job_tasks:
+            job_plane = job_tasks
+        if local and threadsafe[i]:
+            job_wrapper = LOCAL_MPI_WRAPPER.format(job_nodes*job_tasks)
+
+        write_sbatch(script,'--config {0}'.format(TMP_CONFIG),nodes=job_nodes,tasks=job_tasks,mem=job_mem,plane=job_plane,exclude=exclude,mpi_wrapper=job_wrapper,container=containers[i],partition=partition,
+                    time=time,name=jobname,runname=name,SPWs=crosscal_kwargs['spw'],nspw=crosscal_kwargs['nspw'],account=account,reservation=reservation,modules=modules,justrun=justrun,
+                    estimated=len(estimate) > 0,nconcurrent=nconcurrent,cpus=estimate.get('cpus'))
+
+    #Replace all .py with .sbatch, and pack consecutive serial scripts into step groups, separately before and after calibration
     scripts = [os.path.split(scripts[i])[1].replace('.py','.sbatch') for i in range(len(scripts))]
-    precal_scripts = scripts[:num_precal_scripts]
-    postcal_scripts = scripts[num_precal_scripts:]
+    precal_scripts = group_scripts(scripts[:num_precal_scripts],threadsafe[:num_precal_scripts],runname=name,justrun=justrun)
+    postcal_scripts = group_scripts(scripts[num_precal_scripts:],threadsafe[num_precal_scripts:],runname=name,justrun=justrun)
+    scripts = precal_scripts + postcal_scripts
     echo = False if quiet else True
 
     if crosscal_kwargs['nspw'] > 1:
@@ -1026,31 +1382,32 @@ def default_config(arg_dict):
     for key in SLURM_CONFIG_STR_KEYS:
         if key in slurm_dict.keys(): slurm_dict[key] = "'{0}'".format(slurm_dict[key])
 
-    #Overwrite CL parameters in config under section [slurm]
-    config_parser.overwrite_config(filename, conf_dict=slurm_dict, conf_sec='slurm')
-
-    #Add MS to config file under section [data] and dopol under section [run]
-    config_parser.overwrite_config(filename, conf_dict={'vis' : "'{0}'".format(MS)}, conf_sec='data')
-    config_parser.overwrite_config(filename, conf_dict={'dopol' : arg_dict['dopol']}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-
-    if not arg_dict['do2GC'] or not arg_dict['science_image']:
-        remove_scripts = []
-        if not arg_dict['do2GC']:
-            config_parser.remove_section(filename, 'selfcal')
-            remove_scripts = ['selfcal_part1.py', 'selfcal_part2.py']
-        if not arg_dict['science_image']:
-            config_parser.remove_section(filename, 'image')
-            remove_scripts += ['science_image.py']
-
-        scripts = arg_dict['postcal_scripts']
-        i = 0
-        while i < len(scripts):
-            if scripts[i][0] in remove_scripts:
-                scripts.pop(i)
-                i -= 1
-            i += 1
-
-        config_parser.overwrite_config(filename, conf_dict={'postcal_scripts' : scripts}, conf_sec='slurm')
+    with config_parser.batch_update(filename):
+        #Overwrite CL parameters in config under section [slurm]
+        config_parser.overwrite_config(filename, conf_dict=slurm_dict, conf_sec='slurm')
+
+        #Add MS to config file under section [data] and dopol under section [run]
+        config_parser.overwrite_config(filename, conf_dict={'vis' : "'{0}'".format(MS)}, conf_sec='data')
+        config_parser.overwrite_config(filename, conf_dict={'dopol' : arg_dict['dopol']}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+
+        if not arg_dict['do2GC'] or not arg_dict['science_image']:
+            remove_scripts = []
+            if not arg_dict['do2GC']:
+                config_parser.remove_section(filename, 'selfcal')
+                remove_scripts = ['selfcal_part1.py', 'selfcal_part2.py']
+            if not arg_dict['science_image']:
+                config_parser.remove_section(filename, 'image')
+                remove_scripts += ['science_image.py']
+
+            scripts = arg_dict['postcal_scripts']
+            i = 0
+            while i < len(scripts):
+                if scripts[i][0] in remove_scripts:
+                    scripts.pop(i)
+                    i -= 1
+                i += 1
+
+            config_parser.overwrite_config(filename, conf_dict={'postcal_scripts' : scripts}, conf_sec='slurm')
 
     if not arg_dict['nofields']:
         #Don't call srun if option --local used
@@ -1137,7 +1494,7 @@ def pop_script(kwargs,script):
         popped = True
     return popped
 
-def format_args(config,submit,quiet,dependencies,justrun):
+def format_args(config,submit,quiet,dependencies,justrun,local=False):
 
     """Format (and validate) arguments from config file, to be passed into write_jobs() function.
 
@@ -1153,165 +1510,174 @@ def format_args(config,submit,quiet,dependencies,justrun):
         Comma-separated list of SLURM job dependencies.
     justrun : bool
         Just run the pipeline without rebuilding each job script (if it exists).
-
+    local : bool, optional
+        Run the pipeline locally (i.e. without SLURM)?
 
     Returns:
     --------
     kwargs : dict
         Keyword arguments extracted from [slurm] section of config file, to be passed into write_jobs() function."""
 
-    #Ensure all keys exist in these sections
-    kwargs = get_config_kwargs(config,'slurm',SLURM_CONFIG_KEYS)
-    data_kwargs = get_config_kwargs(config,'data',['vis'])
-    field_kwargs = get_config_kwargs(config, 'fields', FIELDS_CONFIG_KEYS)
-    crosscal_kwargs = get_config_kwargs(config, 'crosscal', CROSSCAL_CONFIG_KEYS)
-
-    #Force submit=True if user has requested it during [-R --run]
-    if submit:
-        kwargs['submit'] = True
-
-    #Ensure nspw is integer
-    if type(crosscal_kwargs['nspw']) is not int:
-        logger.warning("Argument 'nspw'={0} in '{1}' is not an integer. Will set to integer ({2}).".format(crosscal_kwargs['nspw']),config,int(crosscal_kwargs['nspw']))
-        crosscal_kwargs['nspw'] = int(crosscal_kwargs['nspw'])
-
-    spw = crosscal_kwargs['spw']
-    nspw = crosscal_kwargs['nspw']
-    mem = int(kwargs['mem'])
-
-    if nspw > 1 and len(kwargs['scripts']) == 0:
-        logger.warning('Setting nspw=1, since no "scripts" parameter in "{0}" is empty, so there\'s nothing run inside SPW directories.'.format(config))
-        config_parser.overwrite_config(config, conf_dict={'nspw' : 1}, conf_sec='crosscal')
-        nspw = 1
-
-    #Check selfcal params
-    if config_parser.has_section(config,'selfcal') and ('selfcal_part1.py' in [i[0] for i in kwargs['postcal_scripts']] or 'selfcal_part1.py' in [i[0] for i in kwargs['scripts']]):
-        selfcal_kwargs = get_config_kwargs(config, 'selfcal', SELFCAL_CONFIG_KEYS)
-        params = bookkeeping.get_selfcal_params()
-        if selfcal_kwargs['loop'] > 0:
-            logger.warning("Starting with loop={0}, which is only valid if previous loops were successfully run in this directory.".format(selfcal_kwargs['loop']))
-        #Find RACS outliers
-        elif selfcal_kwargs['outlier_threshold'] != 0 and selfcal_kwargs['outlier_threshold'] != '':
-            outlierfile = 'outliers.txt'
-            outliers_loop0 = 'outliers_loop0.txt'
-            CWD = os.path.split(os.getcwd())[1]
-            if os.path.exists(outlierfile) and os.path.exists(outliers_loop0):
-                logger.warning("Using existing outlier files '{0}' and '{1}' from '{2}'. Remove one of these files to derive outliers again.".format(outlierfile,outliers_loop0,CWD))
-            elif os.path.exists('../{0}'.format(outlierfile)) and os.path.exists('../{0}'.format(outliers_loop0)):
-                logger.warning("Assuming you're runnnig outlier imaging separately over several SPWs, so using one set of outliers by copying outlier file from '../{0}' and '../{1}' to '{2}'.".format(outlierfile,outliers_loop0,CWD))
-                logger.warning("If these outlier files are irrelevant, please rename/remove one of them and run this step again.")
-                copyfile('../{0}'.format(outlierfile), outlierfile)
-                copyfile('../{0}'.format(outliers_loop0), outliers_loop0)
-            else:
-                if selfcal_kwargs['outlier_radius'] != '' and selfcal_kwargs['outlier_radius'] != 0.0:
-                    txt = 'within {0} degrees'.format(selfcal_kwargs['outlier_radius'])
+    #Defer writing updates to config until the end, other than before calling scripts that read it
+    with config_parser.batch_update(config):
+        #Ensure all keys exist in these sections
+        kwargs = get_config_kwargs(config,'slurm',SLURM_CONFIG_KEYS,SLURM_OPTIONAL_KEYS)
+        data_kwargs = get_config_kwargs(config,'data',['vis'])
+        field_kwargs = get_config_kwargs(config, 'fields', FIELDS_CONFIG_KEYS)
+        crosscal_kwargs = get_config_kwargs(config, 'crosscal', CROSSCAL_CONFIG_KEYS, CROSSCAL_OPTIONAL_KEYS)
+
+        #Force submit=True if user has requested it during [-R --run]
+        if submit:
+            kwargs['submit'] = True
+
+        #Ensure nspw is integer
+        if type(crosscal_kwargs['nspw']) is not int:
+            logger.warning("Argument 'nspw'={0} in '{1}' is not an integer. Will set to integer ({2}).".format(crosscal_kwargs['nspw']),config,int(crosscal_kwargs['nspw']))
+            crosscal_kwargs['nspw'] = int(crosscal_kwargs['nspw'])
+
+        spw = crosscal_kwargs['spw']
+        nspw = crosscal_kwargs['nspw']
+        mem = int(kwargs['mem'])
+
+        if nspw > 1 and len(kwargs['scripts']) == 0:
+            logger.warning('Setting nspw=1, since no "scripts" parameter in "{0}" is empty, so there\'s nothing run inside SPW directories.'.format(config))
+            config_parser.overwrite_config(config, conf_dict={'nspw' : 1}, conf_sec='crosscal')
+            nspw = 1
+
+        #Check selfcal params
+        if config_parser.has_section(config,'selfcal') and ('selfcal_part1.py' in [i[0] for i in kwargs['postcal_scripts']] or 'selfcal_part1.py' in [i[0] for i in kwargs['scripts']]):
+            selfcal_kwargs = get_config_kwargs(config, 'selfcal', SELFCAL_CONFIG_KEYS)
+            params = bookkeeping.get_selfcal_params()
+            if selfcal_kwargs['loop'] > 0:
+                logger.warning("Starting with loop={0}, which is only valid if previous loops were successfully run in this directory.".format(selfcal_kwargs['loop']))
+            #Find RACS outliers
+            elif selfcal_kwargs['outlier_threshold'] != 0 and selfcal_kwargs['outlier_threshold'] != '':
+                outlierfile = 'outliers.txt'
+                outliers_loop0 = 'outliers_loop0.txt'
+                CWD = os.path.split(os.getcwd())[1]
+                if os.path.exists(outlierfile) and os.path.exists(outliers_loop0):
+                    logger.warning("Using existing outlier files '{0}' and '{1}' from '{2}'. Remove one of these files to derive outliers again.".format(outlierfile,outliers_loop0,CWD))
+                elif os.path.exists('../{0}'.format(outlierfile)) and os.path.exists('../{0}'.format(outliers_loop0)):
+                    logger.warning("Assuming you're runnnig outlier imaging separately over several SPWs, so using one set of outliers by copying outlier file from '../{0}' and '../{1}' to '{2}'.".format(outlierfile,outliers_loop0,CWD))
+                    logger.warning("If these outlier files are irrelevant, please rename/remove one of them and run this step again.")
+                    copyfile('../{0}'.format(outlierfile), outlierfile)
+                    copyfile('../{0}'.format(outliers_loop0), outliers_loop0)
                 else:
-                    txt = 'within calculated search radius'
-                logger.info('Populating sky model for selfcal using outlier_threshold={0}'.format(selfcal_kwargs['outlier_threshold']))
-                logger.info('Querying Rapid ASAKP Continuum Survey (RACS) catalog around the target phase centre to identify outliers {0}. Please allow a moment for this.'.format(txt))
-                sky_model_kwargs = deepcopy(kwargs)
-                sky_model_kwargs['partition'] = 'Devel'
-                mpi_wrapper = srun(sky_model_kwargs, qos=True, time=2, mem=0)
-                command = write_command('set_sky_model.py', '-C {0}'.format(config), mpi_wrapper=mpi_wrapper, container=kwargs['container'],logfile=False)
-                logger.debug('Running following command:\n\t{0}'.format(command))
-                os.system(command)
-
-    if config_parser.has_section(config,'image'):
-        imaging_kwargs = get_config_kwargs(config, 'image', IMAGING_CONFIG_KEYS)
-
-        valid_pbbands = ['LBand', 'SBand', 'UHF']
-        if not any([pb.lower() in imaging_kwargs['pbband'].lower() for pb in valid_pbbands]):
-            logger.warning('Invalid pbband found. Must be one of {}. If not fixed, will default to LBand.'.format(valid_pbbands))
-
-    #If nspw = 1 and precal or postcal scripts present, overwrite config and reload
-    if nspw == 1:
-        if len(kwargs['precal_scripts']) > 0 or len(kwargs['postcal_scripts']) > 0:
-            logger.warning('Appending "precal_scripts" to beginning of "scripts", and "postcal_scripts" to end of "scripts", since nspw=1. Overwritting this in "{0}".'.format(config))
-
-            #Drop first instance of calc_refant.py from precal scripts in preference for one in scripts (after flag_round_1.py)
-            if 'calc_refant.py' in [i[0] for i in kwargs['precal_scripts']] and 'calc_refant.py' in [i[0] for i in kwargs['scripts']]:
-                kwargs['precal_scripts'].pop([i[0] for i in kwargs['precal_scripts']].index('calc_refant.py'))
-
-            scripts = kwargs['precal_scripts'] + kwargs['scripts'] + kwargs['postcal_scripts']
-            config_parser.overwrite_config(config, conf_dict={'scripts' : scripts}, conf_sec='slurm')
-            config_parser.overwrite_config(config, conf_dict={'precal_scripts' : []}, conf_sec='slurm')
-            config_parser.overwrite_config(config, conf_dict={'postcal_scripts' : []}, conf_sec='slurm')
-            kwargs = get_config_kwargs(config,'slurm',SLURM_CONFIG_KEYS)
+                    if selfcal_kwargs['outlier_radius'] != '' and selfcal_kwargs['outlier_radius'] != 0.0:
+                        txt = 'within {0} degrees'.format(selfcal_kwargs['outlier_radius'])
+                    else:
+                        txt = 'within calculated search radius'
+                    logger.info('Populating sky model for selfcal using outlier_threshold={0}'.format(selfcal_kwargs['outlier_threshold']))
+                    logger.info('Querying Rapid ASAKP Continuum Survey (RACS) catalog around the target phase centre to identify outliers {0}. Please allow a moment for this.'.format(txt))
+                    sky_model_kwargs = deepcopy(kwargs)
+                    sky_model_kwargs['partition'] = 'Devel'
+                    mpi_wrapper = '' if local else srun(sky_model_kwargs, qos=True, time=2, mem=0)
+                    command = write_command('set_sky_model.py', '-C {0}'.format(config), mpi_wrapper=mpi_wrapper, container=kwargs['container'],logfile=False)
+                    logger.debug('Running following command:\n\t{0}'.format(command))
+                    config_parser.flush(config)
+                    os.system(command)
+
+        #Check flagging strategies (otherwise defaults are used)
+        if config_parser.has_section(config,'flagging'):
+            flagging_kwargs = get_config_kwargs(config, 'flagging', [], FLAGGING_CONFIG_KEYS)
+            for name in flagging_kwargs:
+                flag_strategy.get_strategy({'flagging' : flagging_kwargs}, name)
+
+        if config_parser.has_section(config,'image'):
+            imaging_kwargs = get_config_kwargs(config, 'image', IMAGING_CONFIG_KEYS)
+
+            valid_pbbands = ['LBand', 'SBand', 'UHF']
+            if not any([pb.lower() in imaging_kwargs['pbband'].lower() for pb in valid_pbbands]):
+                logger.warning('Invalid pbband found. Must be one of {}. If not fixed, will default to LBand.'.format(valid_pbbands))
+
+        #If nspw = 1 and precal or postcal scripts present, overwrite config and reload
+        if nspw == 1:
+            if len(kwargs['precal_scripts']) > 0 or len(kwargs['postcal_scripts']) > 0:
+                logger.warning('Appending "precal_scripts" to beginning of "scripts", and "postcal_scripts" to end of "scripts", since nspw=1. Overwritting this in "{0}".'.format(config))
+
+                #Drop first instance of calc_refant.py from precal scripts in preference for one in scripts (after flag_round_1.py)
+                if 'calc_refant.py' in [i[0] for i in kwargs['precal_scripts']] and 'calc_refant.py' in [i[0] for i in kwargs['scripts']]:
+                    kwargs['precal_scripts'].pop([i[0] for i in kwargs['precal_scripts']].index('calc_refant.py'))
+
+                scripts = kwargs['precal_scripts'] + kwargs['scripts'] + kwargs['postcal_scripts']
+                config_parser.overwrite_config(config, conf_dict={'scripts' : scripts, 'precal_scripts' : [], 'postcal_scripts' : []}, conf_sec='slurm')
+                kwargs = get_config_kwargs(config,'slurm',SLURM_CONFIG_KEYS,SLURM_OPTIONAL_KEYS)
+            else:
+                scripts = kwargs['scripts']
         else:
-            scripts = kwargs['scripts']
-    else:
-        scripts = kwargs['precal_scripts'] + kwargs['postcal_scripts']
-
-    kwargs['num_precal_scripts'] = len(kwargs['precal_scripts'])
-
-    # Validate kwargs along with MS
-    kwargs['MS'] = data_kwargs['vis']
-    validate_args(kwargs,config)
-
-    #Reformat scripts tuple/list, to extract scripts, threadsafe, and containers as parallel lists
-    #Check that path to each script and container exists or is ''
-    kwargs['scripts'] = [check_path(i[0]) for i in scripts]
-    kwargs['threadsafe'] = [i[1] for i in scripts]
-    kwargs['containers'] = [check_path(i[2]) for i in scripts]
-
-    if not crosscal_kwargs['createmms']:
-        logger.info("You've set 'createmms = False' in '{0}', so forcing 'keepmms = False'. Will use single CPU for every job other than 'partition.py', 'quick_tclean.py' and 'selfcal_*.py', if present.".format(config))
-        config_parser.overwrite_config(config, conf_dict={'keepmms' : False}, conf_sec='crosscal')
-        kwargs['threadsafe'] = [False]*len(scripts)
-
-    elif not crosscal_kwargs['keepmms']:
-        #Set threadsafe=False for split and postcal scripts (since working with MS not MMS).
-        if 'split.py' in kwargs['scripts']:
-            kwargs['threadsafe'][kwargs['scripts'].index('split.py')] = False
-        if nspw != 1:
-            kwargs['threadsafe'][kwargs['num_precal_scripts']:] = [False]*len(kwargs['postcal_scripts'])
-
-    #Set threadsafe=True for quick-tclean, selfcal_part1 or science_image as tclean uses MPI even for an MS (TODO: ensure it doesn't crash for flagging step)
-    for threadsafe_script in ['quick_tclean.py','selfcal_part1.py','science_image.py']:
-        if threadsafe_script in kwargs['scripts']:
-            kwargs['threadsafe'][kwargs['scripts'].index(threadsafe_script)] = True
-
-    #Only reduce the memory footprint if we're not using all CPUs on each node
-    if kwargs['ntasks_per_node'] < NTASKS_PER_NODE_LIMIT and nspw > 1:
-        mem = int(mem // (nspw/2))
-
-    dopol = config_parser.get_key(config, 'run', 'dopol')
-    if not dopol and ('xy_yx_solve.py' in kwargs['scripts'] or 'xy_yx_apply.py' in kwargs['scripts']):
-        logger.warning("Cross-hand calibration scripts 'xy_yx_*' found in scripts. Forcing dopol=True in '[run]' section of '{0}'.".format(config))
-        config_parser.overwrite_config(config, conf_dict={'dopol' : True}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-
-    includes_partition = any('partition' in script for script in kwargs['scripts'])
-    #If single correctly formatted spw, split into nspw directories, and process each spw independently
-    if nspw > 1:
-        #Write timestamp to this pipeline run
-        kwargs['timestamp'] = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        config_parser.overwrite_config(config, conf_dict={'timestamp' : "'{0}'".format(kwargs['timestamp'])}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-        nspw = spw_split(spw, nspw, config, mem, crosscal_kwargs['badfreqranges'],kwargs['MS'],includes_partition, createmms = crosscal_kwargs['createmms'], fields=field_kwargs)
-        config_parser.overwrite_config(config, conf_dict={'nspw' : "{0}".format(nspw)}, conf_sec='crosscal')
-
-    #Pop script to calculate reference antenna if calcrefant=False. Assume it won't be in postcal scripts
-    if not crosscal_kwargs['calcrefant']:
-        if pop_script(kwargs,'calc_refant.py'):
-            kwargs['num_precal_scripts'] -= 1
-
-    #Replace empty containers with default container and remove unwanted kwargs
-    for i in range(len(kwargs['containers'])):
-        if kwargs['containers'][i] == '':
-            kwargs['containers'][i] = kwargs['container']
-    kwargs.pop('container')
-    kwargs.pop('MS')
-    kwargs.pop('precal_scripts')
-    kwargs.pop('postcal_scripts')
-    kwargs['quiet'] = quiet
-    kwargs['justrun'] = justrun
-
-    #Force overwrite of dependencies
-    if dependencies != '':
-        kwargs['dependencies'] = dependencies
+            scripts = kwargs['precal_scripts'] + kwargs['postcal_scripts']
+
+        kwargs['num_precal_scripts'] = len(kwargs['precal_scripts'])
+
+        # Validate kwargs along with MS
+        kwargs['MS'] = data_kwargs['vis']
+        validate_args(kwargs,config)
+
+        #Reformat scripts tuple/list, to extract scripts, threadsafe, and containers as parallel lists
+        #Check that path to each script and container exists or is ''
+        kwargs['scripts'] = [check_path(i[0]) for i in scripts]
+        kwargs['threadsafe'] = [i[1] for i in scripts]
+        kwargs['containers'] = [check_path(i[2]) for i in scripts]
+
+        if not crosscal_kwargs['createmms']:
+            logger.info("You've set 'createmms = False' in '{0}', so forcing 'keepmms = False'. Will use single CPU for every job other than 'partition.py', 'quick_tclean.py' and 'selfcal_*.py', if present.".format(config))
+            config_parser.overwrite_config(config, conf_dict={'keepmms' : False}, conf_sec='crosscal')
+            kwargs['threadsafe'] = [False]*len(scripts)
+
+        elif not crosscal_kwargs['keepmms']:
+            #Set threadsafe=False for split and postcal scripts (since working with MS not MMS).
+            if 'split.py' in kwargs['scripts']:
+                kwargs['threadsafe'][kwargs['scripts'].index('split.py')] = False
+            if nspw != 1:
+                kwargs['threadsafe'][kwargs['num_precal_scripts']:] = [False]*len(kwargs['postcal_scripts'])
+
+        #Set threadsafe=True for quick-tclean, selfcal_part1 or science_image as tclean uses MPI even for an MS (TODO: ensure it doesn't crash for flagging step)
+        for threadsafe_script in ['quick_tclean.py','selfcal_part1.py','science_image.py']:
+            if threadsafe_script in kwargs['scripts']:
+                kwargs['threadsafe'][kwargs['scripts'].index(threadsafe_script)] = True
+
+        #Only reduce the memory footprint if we're not using all CPUs on each node
+        if kwargs['ntasks_per_node'] < NTASKS_PER_NODE_LIMIT and nspw > 1:
+            mem = int(mem // (nspw/2))
+
+        dopol = config_parser.get_key(config, 'run', 'dopol')
+        if not dopol and ('xy_yx_solve.py' in kwargs['scripts'] or 'xy_yx_apply.py' in kwargs['scripts']):
+            logger.warning("Cross-hand calibration scripts 'xy_yx_*' found in scripts. Forcing dopol=True in '[run]' section of '{0}'.".format(config))
+            config_parser.overwrite_config(config, conf_dict={'dopol' : True}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+
+        includes_partition = any('partition' in script for script in kwargs['scripts'])
+        #If single correctly formatted spw, split into nspw directories, and process each spw independently
+        if nspw > 1:
+            #Write timestamp to this pipeline run
+            kwargs['timestamp'] = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+            config_parser.overwrite_config(config, conf_dict={'timestamp' : "'{0}'".format(kwargs['timestamp'])}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+            nspw = spw_split(spw, nspw, config, mem, crosscal_kwargs['badfreqranges'],kwargs['MS'],includes_partition, createmms = crosscal_kwargs['createmms'], fields=field_kwargs)
+            config_parser.overwrite_config(config, conf_dict={'nspw' : "{0}".format(nspw)}, conf_sec='crosscal')
+
+        #Pop script to calculate reference antenna if calcrefant=False. Assume it won't be in postcal scripts
+        if not crosscal_kwargs['calcrefant']:
+            if pop_script(kwargs,'calc_refant.py'):
+                kwargs['num_precal_scripts'] -= 1
+
+        #Replace empty containers with default container and remove unwanted kwargs
+        for i in range(len(kwargs['containers'])):
+            if kwargs['containers'][i] == '':
+                kwargs['containers'][i] = kwargs['container']
+        kwargs.pop('container')
+        kwargs.pop('MS')
+        kwargs.pop('precal_scripts')
+        kwargs.pop('postcal_scripts')
+        kwargs['quiet'] = quiet
+        kwargs['justrun'] = justrun
+        kwargs['local'] = local
+
+        #Force overwrite of dependencies
+        if dependencies != '':
+            kwargs['dependencies'] = dependencies
 
-    if len(kwargs['scripts']) == 0 and nspw == 1:
-        logger.error('Nothing to do. Please insert scripts into "scripts" parameter in "{0}".'.format(config))
-        #sys.exit(1)
+        if len(kwargs['scripts']) == 0 and nspw == 1:
+            logger.error('Nothing to do. Please insert scripts into "scripts" parameter in "{0}".'.format(config))
+            #sys.exit(1)
 
     #If everything up until here has passed, we can copy config file to TMP_CONFIG (in case user runs sbatch manually) and inform user
     logger.debug("Copying '{0}' to '{1}', and using this to run pipeline.".format(config,TMP_CONFIG))
@@ -1327,45 +1693,135 @@ def linspace(lower,upper,length):
 
     return [lower + x*(upper-lower)/float(length-1) for x in range(length)]
 
-def get_spw_bounds(spw):
+def channel_weights(MS,badfreqranges):
 
-    """Get upper and lower bounds of spw.
+    """Return the frequency and weight of each channel of an MS, from its metadata snapshot. The weight is the unflagged fraction
+    of the channel (sampled from the FLAG column by read_ms.py when nspw > 1, if the flags haven't changed since, otherwise 1),
+    or 0 within a bad frequency range.
 
     Arguments:
     ----------
-    spw : str
-        CASA spectral window in MHz.
+    MS : str
+        Path to CASA MeasurementSet.
+    badfreqranges : list
+        List of bad frequency ranges in MHz.
 
     Returns:
     --------
-    low : float
-        Lower bound of spw.
-    high : float
-        Higher bound of spw.
-    unit : str
-        Unit of spw.
-    func : function
-        Function to apply to spectral window (i.e. int for SPW channel range, otherwise float)."""
-
-    bounds = spw.split(':')[-1].split('~')
-    if ',' not in spw and ':' in spw and '~' in spw and len(bounds) == 2 and bounds[1] != '':
-        high,unit=re.search(r'(\d+\.*\d*)(\w*)',bounds[1]).groups()
-        func = int if unit == '' or '.' not in bounds[0] else float
-        low = func(bounds[0])
-        func = int if unit == '' or '.' not in high else float
-        high = func(high)
-
-        if unit != 'MHz':
-            logger.warning('Please use SPW unit "MHz", to ensure the best performance (e.g. not processing entirely flagged frequency ranges).')
+    channels : list
+        Tuples of frequency (MHz) and weight of each channel, sorted by frequency, or None if there's no metadata snapshot."""
 
-    else:
+    msmd = ms_metadata.read(MS) if os.path.exists(MS) else None
+    if msmd is None:
         return None
 
-    return low,high,unit,func
+    bad = [bounds for bounds in [freq_ranges.range_mhz(freq) for freq in badfreqranges] if bounds is not None]
+    channels = []
+    for spw in range(msmd.nspw()):
+        unflagged = msmd.unflagged(spw)
+        for i,freq in enumerate(msmd.chanfreqs(spw,'MHz')):
+            weight = 1.0 if unflagged is None else float(unflagged[i])
+            if any([low <= freq <= high for low,high in bad]):
+                weight = 0.0
+            channels.append((float(freq),weight))
+    return sorted(channels)
+
+def interior_gaps(channels):
+
+    """Return the frequency ranges between which there are only channels with zero weight (e.g. bad frequency ranges), with
+    weighted channels either side.
+
+    Arguments:
+    ----------
+    channels : list
+        Tuples of frequency (MHz) and weight of each channel, sorted by frequency.
+
+    Returns:
+    --------
+    gaps : list
+        Tuples of the frequencies (MHz) of the weighted channels either side of each gap."""
+
+    weighted = [i for i,(freq,weight) in enumerate(channels) if weight > 0]
+    return [(channels[i][0],channels[j][0]) for i,j in zip(weighted[:-1],weighted[1:]) if j > i + 1]
+
+def plan_spw_bounds(low,high,nspw,channels):
+
+    """Plan the bounds of SPWs within a frequency range, so that each holds the same unflagged data (i.e. total channel weight), and
+    the SPW jobs take roughly the same time. Where an SPW would span a whole gap of channels with zero weight (e.g. a bad frequency range),
+    its nearest bound is moved into the gap, so that bad frequency ranges fall between SPWs. Channels with zero weight are then clipped
+    from the edges of each SPW. Bounds are rounded to whole MHz, so they're written in the same format as the input range.
+
+    Arguments:
+    ----------
+    low : float
+        Lower bound of frequency range in MHz.
+    high : float
+        Upper bound of frequency range in MHz.
+    nspw : int
+        Number of spectral windows to split into.
+    channels : list
+        Tuples of frequency (MHz) and weight of each channel, as returned by channel_weights().
+
+    Returns:
+    --------
+    lo : list
+        Lower bound of each SPW.
+    hi : list
+        Upper bound of each SPW, or None for both if the range has too little unflagged data, or the bounds aren't at least
+        MIN_SPW_WIDTH MHz apart."""
+
+    inband = [(freq,weight) for freq,weight in channels if low <= freq <= high]
+    total = sum([weight for freq,weight in inband])
+    if len(inband) < nspw or total == 0:
+        return None, None
+
+    #Place each boundary halfway between the channel that reaches the next equal share of the total weight, and the channel after it
+    bounds = [low]
+    cumulative = 0
+    for i,(freq,weight) in enumerate(inband[:-1]):
+        cumulative += weight
+        while len(bounds) < nspw and cumulative >= total * len(bounds) / float(nspw):
+            bounds.append(int(round((freq + inband[i+1][0]) / 2.0)))
+    bounds += [bounds[-1]] * (nspw - len(bounds)) + [high]
+
+    #Move the nearest inner bound of an SPW into each gap it spans, unless already moved into another gap
+    moved = []
+    for below,above in interior_gaps(inband):
+        within = [b for b in range(int(math.floor(below)) + 1, int(math.ceil(above)))]
+        spans = [i for i in range(nspw) if bounds[i] <= below and above <= bounds[i+1]]
+        if len(within) == 0 or len(spans) == 0:
+            continue
+        i = spans[0]
+        candidates = [j for j in [i,i+1] if 0 < j < nspw and j not in moved]
+        if len(candidates) > 0:
+            j = min(candidates, key=lambda j: abs(bounds[j] - (below + above) / 2.0))
+            bounds[j] = within[len(within) // 2]
+            moved.append(j)
+
+    #Reject plans with SPWs narrower than the minimum width, or without unflagged data
+    for i in range(nspw):
+        if bounds[i+1] - bounds[i] < MIN_SPW_WIDTH or not any([weight > 0 for freq,weight in inband if bounds[i] <= freq <= bounds[i+1]]):
+            logger.debug('Planned SPW bounds {0} within {1}~{2}MHz have an SPW narrower than {3} MHz or without unflagged data.'.format(bounds,low,high,MIN_SPW_WIDTH))
+            return None, None
+
+    #Clip channels with zero weight from edges, rounding inwards
+    lo,hi = list(bounds[:-1]),list(bounds[1:])
+    for i in range(nspw):
+        spw = [(freq,weight) for freq,weight in inband if bounds[i] <= freq <= bounds[i+1]]
+        weighted = [freq for freq,weight in spw if weight > 0]
+        if spw[0][1] == 0:
+            lo[i] = max(bounds[i], int(math.ceil(weighted[0])))
+        if spw[-1][1] == 0:
+            hi[i] = min(bounds[i+1], int(math.floor(weighted[-1])))
+        if hi[i] - lo[i] < MIN_SPW_WIDTH:
+            lo[i],hi[i] = bounds[i],bounds[i+1]
+    return lo, hi
 
 def spw_split(spw,nspw,config,mem,badfreqranges,MS,partition,createmms=True,remove=True,fields={}):
 
-    """Split into N SPWs, placing an instance of the pipeline into N directories, each with 1 Nth of the bandwidth.
+    """Split into N SPWs, placing an instance of the pipeline into N directories. When splitting a frequency range in MHz of an MS
+    with a metadata snapshot, each SPW has an equal share of the unflagged data, with bad channels clipped from its edges (see
+    plan_spw_bounds()), otherwise each SPW has 1 Nth of the bandwidth.
 
     Arguments:
     ----------
@@ -1398,9 +1854,14 @@ def spw_split(spw,nspw,config,mem,badfreqranges,MS,partition,createmms=True,remo
     if get_spw_bounds(spw) != None:
         #Write nspw frequency ranges
         low,high,unit,func = get_spw_bounds(spw)
-        interval=func((high-low)/float(nspw))
-        lo=linspace(low,high-interval,nspw)
-        hi=linspace(low+interval,high,nspw)
+        channels = channel_weights(MS,badfreqranges) if unit == 'MHz' else None
+        lo,hi = plan_spw_bounds(low,high,nspw,channels) if channels is not None else (None,None)
+        if lo is None:
+            interval=func((high-low)/float(nspw))
+            lo=linspace(low,high-interval,nspw)
+            hi=linspace(low+interval,high,nspw)
+        else:
+            logger.info("Planned {0} SPW bounds within '{1}' to equalise unflagged data (sampled in metadata snapshot of '{2}').".format(nspw,spw,MS))
         SPWs=[]
 
         #Remove SPWs entirely encompassed by bad frequency ranges (only for MHz unit)
@@ -1444,36 +1905,35 @@ def spw_split(spw,nspw,config,mem,badfreqranges,MS,partition,createmms=True,remo
         spw_config = '{0}/{1}'.format(spw.replace(SPW_PREFIX,''),config)
         if not os.path.exists(spw.replace(SPW_PREFIX,'')):
             os.mkdir(spw.replace(SPW_PREFIX,''))
-        copyfile(config, spw_config)
-        config_parser.overwrite_config(spw_config, conf_dict={'spw' : "'{0}'".format(spw)}, conf_sec='crosscal')
-        config_parser.overwrite_config(spw_config, conf_dict={'nspw' : 1}, conf_sec='crosscal')
-        config_parser.overwrite_config(spw_config, conf_dict={'mem' : mem}, conf_sec='slurm')
-        config_parser.overwrite_config(spw_config, conf_dict={'calcrefant' : False}, conf_sec='crosscal')
-        config_parser.overwrite_config(spw_config, conf_dict={'precal_scripts' : []}, conf_sec='slurm')
-        config_parser.overwrite_config(spw_config, conf_dict={'postcal_scripts' : []}, conf_sec='slurm')
-        #Look 1 directory up when using relative path
-        if MS[0] != '/':
-            config_parser.overwrite_config(spw_config, conf_dict={'vis' : "'../{0}'".format(MS)}, conf_sec='data')
-        if not partition:
-            basename, ext = os.path.splitext(MS.rstrip('/ '))
-            filebase = os.path.split(basename)[1]
-            extn = 'mms' if createmms else 'ms'
-
-            #Hack to rename vis if setting as specific field (e.g. as target field when running selfcal)
-            prefix,suffix = os.path.splitext(filebase)
-            if suffix[1:] != '' and suffix[1:] in fields.values():
-                extn = '{0}.{1}'.format(suffix[1:],extn)
-                filebase = prefix
-
-            vis = '{0}.{1}.{2}'.format(filebase,spw.replace(SPW_PREFIX,''),extn)
-            logger.warning("Since script with 'partition' in its name isn't present in '{0}', assuming partition has already been done, and setting vis='{1}' in '{2}'. If '{1}' doesn't exist, please update '{2}', as the pipeline will not launch successfully.".format(config,vis,spw_config))
-            orig_vis = config_parser.get_key(spw_config, 'data', 'vis')
-            config_parser.overwrite_config(spw_config, conf_dict={'orig_vis' : "'{0}'".format(orig_vis)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-            config_parser.overwrite_config(spw_config, conf_dict={'vis' : "'{0}'".format(vis)}, conf_sec='data')
+
+        #Copy from parsed config and write all SPW-specific values at once
+        with config_parser.batch_update(spw_config):
+            config_parser.copy_config(config, spw_config)
+            config_parser.overwrite_config(spw_config, conf_dict={'spw' : "'{0}'".format(spw), 'nspw' : 1, 'calcrefant' : False}, conf_sec='crosscal')
+            config_parser.overwrite_config(spw_config, conf_dict={'mem' : mem, 'precal_scripts' : [], 'postcal_scripts' : []}, conf_sec='slurm')
+            #Look 1 directory up when using relative path
+            if MS[0] != '/':
+                config_parser.overwrite_config(spw_config, conf_dict={'vis' : "'../{0}'".format(MS)}, conf_sec='data')
+            if not partition:
+                basename, ext = os.path.splitext(MS.rstrip('/ '))
+                filebase = os.path.split(basename)[1]
+                extn = 'mms' if createmms else 'ms'
+
+                #Hack to rename vis if setting as specific field (e.g. as target field when running selfcal)
+                prefix,suffix = os.path.splitext(filebase)
+                if suffix[1:] != '' and suffix[1:] in fields.values():
+                    extn = '{0}.{1}'.format(suffix[1:],extn)
+                    filebase = prefix
+
+                vis = '{0}.{1}.{2}'.format(filebase,spw.replace(SPW_PREFIX,''),extn)
+                logger.warning("Since script with 'partition' in its name isn't present in '{0}', assuming partition has already been done, and setting vis='{1}' in '{2}'. If '{1}' doesn't exist, please update '{2}', as the pipeline will not launch successfully.".format(config,vis,spw_config))
+                orig_vis = config_parser.get_key(spw_config, 'data', 'vis')
+                config_parser.overwrite_config(spw_config, conf_dict={'orig_vis' : "'{0}'".format(orig_vis)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+                config_parser.overwrite_config(spw_config, conf_dict={'vis' : "'{0}'".format(vis)}, conf_sec='data')
 
     return nspw
 
-def get_config_kwargs(config,section,expected_keys):
+def get_config_kwargs(config,section,expected_keys,optional_keys=[]):
 
     """Return kwargs from config section. Check section exists, and that all expected keys are present, otherwise raise KeyError.
 
@@ -1485,6 +1945,8 @@ def get_config_kwargs(config,section,expected_keys):
         Config section from which to extract kwargs.
     expected_keys : list
         List of expected keys.
+    optional_keys : list, optional
+        List of keys that are known but may be missing.
 
     Returns:
     --------
@@ -1500,7 +1962,7 @@ def get_config_kwargs(config,section,expected_keys):
     kwargs = config_dict[section]
 
     #Check for any unknown keys and display warning
-    unknown_keys = list(set(kwargs) - set(expected_keys))
+    unknown_keys = list(set(kwargs) - set(expected_keys) - set(optional_keys))
     if len(unknown_keys) > 0:
         logger.warning("Unknown keys {0} present in section [{1}] in '{2}'.".format(unknown_keys,section,config))
 
@@ -1545,7 +2007,7 @@ def main():
     if args.build:
         default_config(vars(args))
     if args.run:
-        kwargs = format_args(args.config,args.submit,args.quiet,args.dependencies,args.justrun)
+        kwargs = format_args(args.config,args.submit,args.quiet,args.dependencies,args.justrun,args.local)
         write_jobs(args.config, **kwargs)
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ import numpy as np
 
 import processMeerKAT
 import config_parser
+import ms_metadata
+import resources
 
 from casatasks import *
 from casatools import msmetadata,table,measures,quanta
@@ -163,11 +165,11 @@ def check_refant(MS,refant,config,warn=True):
     except ValueError: # It's not an int, but a str
         pass
 
-    msmd.open(MS)
+    metadata = ms_metadata.get(MS)
     if type(refant) is str:
-        ants = msmd.antennanames()
+        ants = metadata.antennanames()
     else:
-        ants = msmd.antennaids()
+        ants = metadata.antennaids()
 
     if refant not in ants:
         err = "Reference antenna '{0}' isn't present in input dataset '{1}'. Antennas present are: {2}. Try 'm052' or 'm005' if present, or ensure 'calcrefant=True' and 'calc_refant.py' script present in '{3}'.".format(refant,MS,ants,config)
@@ -183,8 +185,10 @@ def check_refant(MS,refant,config,warn=True):
 
 def check_scans(MS,nodes,tasks,dopol):
 
-    """Check if the user has set the number of threads to a number larger than the number of scans.
-    If so, display a warning and return the number of thread to be replaced in their config file.
+    """Check the number of threads suits the layout of the MMS that partition will write. The layout is planned from the rows
+    of each scan and the number of threads, so the MMS is separated by scan or by baseline to keep all threads busy.
+    If it can't be planned (i.e. the rows of each scan aren't known), check if the user has set the number of threads
+    to a number larger than the number of scans, and if so, display a warning and return the number of threads to be replaced.
 
     Arguments:
     ----------
@@ -200,12 +204,18 @@ def check_scans(MS,nodes,tasks,dopol):
     Returns:
     --------
     threads : dict
-        A dictionary with updated values for nodes and tasks per node to match the number of scans."""
+        A dictionary with updated values for nodes and tasks per node to match the MMS layout or number of scans."""
 
     nscans = msmd.nscans()
     limit = int(nscans/2)
+    layout = resources.mms_layout(resources.vis_shape(MS), nodes*tasks - 1)
 
-    if abs(nodes * tasks - limit) > 0.1*limit:
+    if layout is not None:
+        if layout['numsubms'] + 1 < nodes * tasks:
+            logger.warning('The number of threads ({0} node(s) x {1} task(s) = {2}) is more than the {3} sub-MSs (separated by {4}) that can be written for "{5}", so some will be idle.'.format(nodes,tasks,nodes*tasks,layout['numsubms'],layout['separationaxis'],MS))
+        else:
+            logger.info('Partition will separate "{0}" by {1} into {2} sub-MSs, for {3} node(s) x {4} task(s).'.format(MS,layout['separationaxis'],layout['numsubms'],nodes,tasks))
+    elif abs(nodes * tasks - limit) > 0.1*limit:
         logger.warning('The number of threads ({0} node(s) x {1} task(s) = {2}) is not ideal compared to the number of scans ({3}) for "{4}".'.format(nodes,tasks,nodes*tasks,nscans,MS))
 
         #Start with 8/16 tasks on one node, and increase count of nodes (and then tasks per node) until limit reached
@@ -365,9 +375,7 @@ def get_xy_field(visname, fields):
     secondaryfield (nominally dpolfield)
     """
 
-    msmd.open(visname)
-    fieldnames = msmd.fieldnames()
-    msmd.done()
+    fieldnames = ms_metadata.get(visname).fieldnames()
 
     # Use 3C286 or 3C138 if present in the data
     calibrator_3C286 = set(["3C286", "1328+307", "1331+305", "J1331+3030"]).intersection(set(fieldnames))
@@ -388,6 +396,10 @@ def main():
     processMeerKAT.setup_logger(args.config,args.verbose)
     msmd.open(args.MS)
 
+    #Write metadata snapshot for later jobs, which read this rather than opening the MS again, sampling the flags only to plan several SPWs
+    nspw = config_parser.get_key(args.config, 'crosscal', 'nspw')
+    ms_metadata.write(args.MS, msmd, flags=nspw != '' and nspw > 1)
+
     dopol = args.dopol
     refant = config_parser.parse_config(args.config)[0]['crosscal']['refant']
     fields = get_fields(args.MS)
@@ -410,10 +422,11 @@ def main():
     threads = check_scans(args.MS,args.nodes,args.ntasks_per_node,dopol)
     SPW = check_spw(args.config,msmd)
 
-    config_parser.overwrite_config(args.config, conf_dict={'dopol' : dopol}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-    config_parser.overwrite_config(args.config, conf_dict=threads, conf_sec='slurm')
-    config_parser.overwrite_config(args.config, conf_dict=fields, conf_sec='fields')
-    config_parser.overwrite_config(args.config, conf_dict={'spw' : "'{0}'".format(SPW)}, conf_sec='crosscal')
+    with config_parser.batch_update(args.config):
+        config_parser.overwrite_config(args.config, conf_dict={'dopol' : dopol}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+        config_parser.overwrite_config(args.config, conf_dict=threads, conf_sec='slurm')
+        config_parser.overwrite_config(args.config, conf_dict=fields, conf_sec='fields')
+        config_parser.overwrite_config(args.config, conf_dict={'spw' : "'{0}'".format(SPW)}, conf_sec='crosscal')
 
     msmd.done()
 
@@ -0,0 +1,379 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+import time
+
+import ms_metadata
+
+import logging
+logger = logging.getLogger(__name__)
+
+#Bytes held in memory per visibility, for data (complex64), flag (bool) and weight (float32)
+BYTES_PER_VIS = 13
+#Memory (GB) used by each CASA process, regardless of data size
+PROCESS_OVERHEAD_GB = 1.5
+#Factor by which memory estimates are padded
+HEADROOM = 1.5
+#Minimum memory (GB) requested per node
+MIN_MEM_GB = 4
+
+#Seconds per unit of time intervals (e.g. 'timeavg')
+SECONDS_PER_UNIT = {'s' : 1, 'sec' : 1, 'min' : 60, 'h' : 3600}
+
+#Type of step that each script performs
+STEP_TYPES = {'validate_input' : 'solve', 'calc_refant' : 'solve', 'setjy' : 'solve', 'xx_yy_solve' : 'solve', 'xy_yx_solve' : 'solve',
+              'flag_round_1' : 'flag', 'flag_round_2' : 'flag', 'xx_yy_apply' : 'apply', 'xy_yx_apply' : 'apply',
+              'partition' : 'partition', 'split' : 'split', 'quick_tclean' : 'image', 'selfcal_part1' : 'image', 'science_image' : 'image',
+              'selfcal_part2' : 'bdsf'}
+
+#Types of step whose processes are multi-threaded, so share all CPUs of each node
+THREADED_STEPS = ['image', 'bdsf']
+
+#Number of copies of one scan of visibilities held in memory by each process (which processes one sub-MS at a time), for each type of step
+SCAN_COPIES = {'solve' : 1, 'flag' : 2, 'apply' : 1, 'partition' : 1, 'split' : 1}
+
+#Number of image planes held in memory by each imaging process per Taylor term (e.g. psf, residual, model, image, pb, weight, sumwt
+#and padded complex grids), and bytes per plane pixel (float32)
+IMAGE_PLANES = 12
+BYTES_PER_PIXEL = 4
+#Bytes of the w-projection convolution function cache per w-plane
+BYTES_PER_WPLANE = 8 * 2**20
+
+#Image parameters of each imaging script - quick_tclean.py uses fixed parameters, otherwise they're read from config section
+QUICK_TCLEAN_IMAGE = {'imsize' : [2048,2048], 'nterms' : 2, 'wprojplanes' : 1}
+IMAGE_SECTIONS = {'selfcal_part1' : 'selfcal', 'selfcal_part2' : 'selfcal', 'science_image' : 'image'}
+
+#Minimum parallel efficiency (i.e. fraction of the time the MPI processes are busy) of an MMS separated by scan, below which it's separated by baseline
+MIN_SCAN_EFFICIENCY = 0.8
+#Minimum size (MB) of each sub-MS separated by baseline, below which the overhead of each sub-MS outweighs running more processes
+MIN_SUBMS_MB = 256
+
+#Default aggregate read bandwidth (MB/s) of the shared filesystem, which the concurrent partition tasks reading the same MS share (set 'readbandwidth' in [slurm] section of config to override)
+FS_READ_BANDWIDTH = 4000
+#Number of MB read from the input MS to measure the read throughput of one partition task
+CALIBRATION_READ_MB = 256
+CALIBRATION_CHUNK_MB = 8
+
+def step_type(script):
+
+    """Return the type of step a script performs (e.g. 'flag'), or None if unknown."""
+
+    return STEP_TYPES.get(os.path.splitext(os.path.basename(script))[0])
+
+def spw_ranges(spw):
+
+    """Return the frequency ranges (MHz) of a comma-separated list of SPWs (e.g. '*:880~933MHz,*:960~1010MHz'), or [] if not in MHz."""
+
+    ranges = []
+    for match in re.finditer(r'([\d.]+)~([\d.]+)MHz', spw):
+        ranges.append((float(match.group(1)), float(match.group(2))))
+    return ranges
+
+def vis_shape(MS, spw=''):
+
+    """Return the shape of the visibilities of an MS, from its metadata snapshot, without opening the MS.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    spw : str, optional
+        Comma-separated list of SPWs processed separately, in which case the number of channels is the most within one SPW
+        (summed over its ';'-separated channel ranges, e.g. the good channel ranges left by freq_ranges.excise_spw()).
+
+    Returns:
+    --------
+    shape : dict
+        Number of rows ('nrows'), channels ('nchan'), correlations ('ncorr') and scans ('nscans'), cross-correlation rows in each
+        scan ('scanrows', or None if not in the snapshot), fewest baselines in a scan ('nbaselines') and integration time in seconds
+        ('inttime', or None if not in the snapshot), or None if there's no up-to-date metadata snapshot."""
+
+    if not os.path.exists(MS):
+        return None
+
+    msmd = ms_metadata.read(MS)
+    if msmd is None or msmd.nrows() is None:
+        return None
+
+    freqs = [freq for spwid in range(msmd.nspw()) for freq in msmd.chanfreqs(spwid, 'MHz')]
+    ranges = [spw_ranges(SPW) for SPW in spw.split(',')]
+    if all([len(SPW) > 0 for SPW in ranges]):
+        nchan = max([sum([len([freq for freq in freqs if low <= freq <= high]) for low,high in SPW]) for SPW in ranges])
+    else:
+        nchan = len(freqs)
+
+    #Rows of each scan, excluding autocorrelations (i.e. as partitioned), from its integrations and antennas
+    scanrows = []
+    nbaselines = []
+    for scan in msmd.scannumbers():
+        nants = len(msmd.antennasforscan(scan))
+        nbaselines.append(nants * (nants - 1) // 2)
+        ntimes = msmd.ntimesforscan(scan)
+        scanrows = None if ntimes is None or scanrows is None else scanrows + [ntimes * nbaselines[-1]]
+
+    return {'nrows' : msmd.nrows(), 'nchan' : nchan, 'ncorr' : int(max(msmd.ncorrforpol())), 'nscans' : msmd.nscans(),
+            'scanrows' : scanrows, 'nbaselines' : min(nbaselines) if len(nbaselines) > 0 else 0, 'inttime' : msmd.exposuretime()}
+
+def time_factor(timeavg, inttime):
+
+    """Return the number of integrations averaged into one by a time interval (e.g. '8s'), or 1 if either is unknown."""
+
+    match = re.match(r'^\s*([\d.]+)\s*([a-z]*)\s*$', str(timeavg))
+    if match is None or match.group(2) not in list(SECONDS_PER_UNIT) + [''] or not inttime:
+        return 1
+    return max(1, float(match.group(1)) * SECONDS_PER_UNIT.get(match.group(2), 1) / inttime)
+
+def average(shape, chanbin=1, timebin=1):
+
+    """Return the shape of visibilities after averaging, e.g. channels by 'chanbin' during partition, or channels by 'width'
+    and integrations by 'timeavg' during split.
+
+    Arguments:
+    ----------
+    shape : dict
+        Shape of visibilities, as returned by vis_shape().
+    chanbin : int, optional
+        Number of channels averaged into one.
+    timebin : float, optional
+        Number of integrations averaged into one, as returned by time_factor().
+
+    Returns:
+    --------
+    shape : dict
+        Shape of averaged visibilities, or None if the shape is None."""
+
+    if shape is None:
+        return None
+
+    shape = dict(shape)
+    shape['nchan'] = int(math.ceil(shape['nchan'] / float(max(1, chanbin))))
+    if timebin > 1:
+        shape['nrows'] = int(math.ceil(shape['nrows'] / timebin))
+        if shape['scanrows'] is not None:
+            shape['scanrows'] = [int(math.ceil(rows / timebin)) for rows in shape['scanrows']]
+    return shape
+
+def efficiency(sizes, nworkers):
+
+    """Return the parallel efficiency of processing sub-MSs of these sizes with a number of processes, each of which takes the
+    largest remaining sub-MS when free (i.e. the total size over the number of processes times the size processed by the busiest)."""
+
+    loads = [0] * max(1, nworkers)
+    for size in sorted(sizes, reverse=True):
+        loads[loads.index(min(loads))] += size
+    return sum(sizes) / float(len(loads) * max(loads)) if max(loads) > 0 else 0.0
+
+def mms_layout(shape, nworkers, nchan=None):
+
+    """Plan the layout of an MMS, so that the MPI processes of each job that reads it are kept evenly busy. Separating by scan
+    keeps each scan in one sub-MS, so is used unless the scans are too few or too uneven for the processes, in which case the MMS
+    is separated by baseline into (up to) one evenly sized sub-MS per process, each no smaller than MIN_SUBMS_MB. Each partitioned
+    MS has one SPW per good channel range (see freq_ranges.excise_spw()), none of which is split across sub-MSs by channel.
+
+    Arguments:
+    ----------
+    shape : dict
+        Shape of visibilities, as returned by vis_shape().
+    nworkers : int
+        Number of MPI processes that work on sub-MSs (i.e. excluding the MPI client).
+    nchan : int, optional
+        Number of channels partitioned, if different from the shape (e.g. after averaging).
+
+    Returns:
+    --------
+    layout : dict
+        Separation axis ('separationaxis'), number of sub-MSs ('numsubms') and parallel efficiency ('efficiency') passed into
+        mstransform, or None if the rows of each scan aren't known."""
+
+    if shape is None or shape.get('scanrows') is None or len(shape['scanrows']) == 0:
+        return None
+
+    nworkers = max(1, nworkers)
+    scan = {'separationaxis' : 'scan', 'numsubms' : len(shape['scanrows']), 'efficiency' : efficiency(shape['scanrows'], nworkers)}
+    if scan['efficiency'] >= MIN_SCAN_EFFICIENCY:
+        return scan
+
+    nchan = shape['nchan'] if nchan is None else nchan
+    total_MB = sum(shape['scanrows']) * nchan * shape['ncorr'] * BYTES_PER_VIS / 2.0**20
+    numsubms = int(max(1, min(nworkers, shape['nbaselines'], total_MB // MIN_SUBMS_MB)))
+    baseline = {'separationaxis' : 'baseline', 'numsubms' : numsubms, 'efficiency' : efficiency([1]*numsubms, nworkers)}
+    return baseline if baseline['efficiency'] > scan['efficiency'] else scan
+
+def image_params(script, taskvals):
+
+    """Return the image parameters used by an imaging script.
+
+    Arguments:
+    ----------
+    script : str
+        Path to script.
+    taskvals : dict
+        Parsed config file.
+
+    Returns:
+    --------
+    params : dict
+        Image size ('imsize'), Taylor terms ('nterms') and w-projection planes ('wprojplanes'), or None if unknown."""
+
+    name = os.path.splitext(os.path.basename(script))[0]
+    if name == 'quick_tclean':
+        return QUICK_TCLEAN_IMAGE
+    elif name in IMAGE_SECTIONS and IMAGE_SECTIONS[name] in taskvals:
+        section = taskvals[IMAGE_SECTIONS[name]]
+        if all([key in section for key in QUICK_TCLEAN_IMAGE]):
+            return {key : section[key] for key in QUICK_TCLEAN_IMAGE}
+    return None
+
+def estimate(script, nodes, tasks, mem_limit, cpu_limit, shape=None, image=None):
+
+    """Estimate the memory per node, tasks per node and CPUs per task needed by a script, from the shape of the visibilities (for
+    calibration, flagging and splitting steps) or the image parameters (for imaging steps). Each MPI process works on one scan of
+    one sub-MS at a time, so visibility steps need memory in proportion to the visibilities in the largest scan (or the part of it
+    in each sub-MS of an MMS separated by baseline), and an MMS with N sub-MSs only has work for N+1 processes (including the MPI
+    client). If the memory needed exceeds the limit, the number of tasks per node is reduced. Imaging processes are multi-threaded,
+    so share all CPUs of the node, while each other process is given the CPUs whose share of the node's memory covers its own, so
+    that the CPUs left for other jobs have memory to use. The shape should be that of the data the script reads (e.g. from the
+    snapshot of the partitioned MS, or averaged by average() after partition or split). Time limits aren't estimated.
+
+    Arguments:
+    ----------
+    script : str
+        Path to script.
+    nodes : int
+        Number of nodes for this job.
+    tasks : int
+        Number of tasks per node for this job.
+    mem_limit : int
+        Maximum memory (GB) per node.
+    cpu_limit : int
+        Number of CPUs per node.
+    shape : dict, optional
+        Shape of visibilities, as returned by vis_shape().
+    image : dict, optional
+        Image parameters, as returned by image_params().
+
+    Returns:
+    --------
+    resources : dict
+        Memory in GB per node ('mem'), tasks per node ('tasks') and CPUs per task ('cpus'), or {} if no estimate can be made."""
+
+    kind = step_type(script)
+
+    if kind in SCAN_COPIES and shape is not None:
+        layout = mms_layout(shape, nodes * tasks - 1)
+        if layout is None:
+            layout = {'separationaxis' : 'scan', 'numsubms' : shape['nscans']}
+        if shape['scanrows'] is not None and len(shape['scanrows']) > 0:
+            rows_per_scan = float(max(shape['scanrows']))
+        else:
+            rows_per_scan = shape['nrows'] / float(max(shape['nscans'], 1))
+        if layout['separationaxis'] == 'baseline':
+            rows_per_scan /= layout['numsubms']
+        process_bytes = rows_per_scan * shape['nchan'] * shape['ncorr'] * BYTES_PER_VIS * SCAN_COPIES[kind]
+        tasks = min(tasks, max(1, int(math.ceil((layout['numsubms'] + 1) / float(nodes)))))
+    elif kind in ['image','bdsf'] and image is not None:
+        imsize = image['imsize'] if type(image['imsize']) is list else [image['imsize']]*2
+        npix = imsize[0] * imsize[-1]
+        nterms = image['nterms'] if kind == 'image' else 1
+        process_bytes = npix * BYTES_PER_PIXEL * IMAGE_PLANES * nterms
+        if kind == 'image':
+            process_bytes += image['wprojplanes'] * BYTES_PER_WPLANE
+    else:
+        return {}
+
+    process_GB = (process_bytes / 1024.0**3 + PROCESS_OVERHEAD_GB) * HEADROOM
+
+    #Reduce tasks per node until processes fit into memory limit
+    if process_GB * tasks > mem_limit:
+        fit = max(1, int(mem_limit // process_GB))
+        logger.warning("Estimated {0:.1f} GB per process for '{1}', so reducing tasks per node from {2} to {3} to fit within {4} GB.".format(process_GB,os.path.basename(script),tasks,fit,mem_limit))
+        tasks = fit
+
+    mem = int(min(mem_limit, max(MIN_MEM_GB, math.ceil(process_GB * tasks))))
+    if kind in THREADED_STEPS:
+        cpus = cpu_limit // tasks
+    else:
+        cpus = int(math.ceil(process_GB * cpu_limit / float(mem_limit)))
+    return {'mem' : mem, 'tasks' : tasks, 'cpus' : int(max(1, min(cpus, cpu_limit // tasks)))}
+
+def read_throughput(MS, nMB=CALIBRATION_READ_MB):
+
+    """Measure the read throughput of one stream from an MS, by reading the start of its largest file (i.e. the visibilities),
+    after asking the kernel to drop that file from the page cache so the filesystem is measured rather than memory.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    nMB : int, optional
+        Number of MB to read.
+
+    Returns:
+    --------
+    throughput : float
+        Read throughput in MB/s, or None if it can't be measured."""
+
+    if not os.path.isdir(MS):
+        return None
+
+    sizes = [(os.path.getsize(os.path.join(root,fname)), os.path.join(root,fname)) for root,dirs,files in os.walk(MS) for fname in files]
+    if len(sizes) == 0:
+        return None
+
+    size,fname = max(sizes)
+    nbytes = min(size, nMB * 2**20)
+    chunk = CALIBRATION_CHUNK_MB * 2**20
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_DONTNEED)
+            start = time.time()
+            nread = 0
+            while nread < nbytes:
+                data = os.read(fd, min(chunk, nbytes - nread))
+                if len(data) == 0:
+                    break
+                nread += len(data)
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+    except OSError as err:
+        logger.warning("Couldn't measure read throughput of '{0}': {1}".format(fname,err))
+        return None
+
+    if nread < chunk or elapsed <= 0:
+        return None
+    return nread / 2**20 / elapsed
+
+def partition_concurrency(MS, nspw, bandwidth=FS_READ_BANDWIDTH):
+
+    """Return the number of partition tasks to run at once, so that the tasks reading the same MS together use the
+    read bandwidth of the filesystem without exceeding it, given the read throughput of one task measured from the MS.
+
+    Arguments:
+    ----------
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    nspw : int
+        Number of partition tasks (i.e. SPWs).
+    bandwidth : float, optional
+        Aggregate read bandwidth (MB/s) of the filesystem.
+
+    Returns:
+    --------
+    nconcurrent : int
+        Number of tasks to run at once, or None if the read throughput can't be measured."""
+
+    throughput = read_throughput(MS)
+    if throughput is None:
+        return None
+
+    nconcurrent = int(max(1, min(nspw, bandwidth // throughput)))
+    logger.info("Measured read throughput of {0:.0f} MB/s from '{1}', so running {2} of {3} partition tasks at once (to share {4} MB/s).".format(throughput,MS,nconcurrent,nspw,bandwidth))
+    return nconcurrent
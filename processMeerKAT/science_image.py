@@ -18,21 +18,28 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s")
 
-import shutil
 from katbeam import JimBeam
 from casatools import image
 ia = image()
 
 
-def do_pb_corr(inpimage, pbthreshold=0, pbband='LBand'):
+#Number of pixels (across all planes) read and written at once during PB correction
+PBCOR_TILE_PIXELS = 2**22
+
+def do_pb_corr(inpimage, pbthreshold=0, pbband='LBand', tile_pixels=PBCOR_TILE_PIXELS):
     """
     Given the input CASA image, outputs a katbeam corrected image, optionally
     cutoff at a specified threshold.
 
+    The image is processed in tiles of complete rows (spanning all Stokes and
+    channel planes), so that only a few tiles are held in memory at once. The
+    PB of each tile is evaluated once and applied to all planes.
+
     Inputs:
     inpimage        Input CASA image name, str
     pbthreshold     Cutoff threshold to mask the PB, float
     pbband          Band at which to generate the PB
+    tile_pixels     Approximate number of pixels per tile, int
 
     Outputs:
     None
@@ -43,19 +50,20 @@ def do_pb_corr(inpimage, pbthreshold=0, pbband='LBand'):
 
     ia.open(inpimage)
     csys = ia.coordsys().torecord()
-    imgdata = ia.getchunk()
     shape = ia.shape()
-    ia.close()
+    unit = ia.brightnessunit()
+    miscinfo = ia.miscinfo()
+    hasbeam = len(ia.restoringbeam()) > 0
 
     cx, cy = shape[0]//2, shape[1]//2
 
     # Size of each pixel
     cdelt = np.abs(csys['direction0']['cdelt'][0])
-    unit = csys['direction0']['units'][0]
+    units = csys['direction0']['units'][0]
 
-    if unit == 'rad':
+    if units == 'rad':
         cdelt = np.rad2deg(cdelt)
-    elif unit == "'": #arcmin
+    elif units == "'": #arcmin
         cdelt /= 60.
 
     # Frequency of image, convert from Hz to MHz
@@ -74,38 +82,49 @@ def do_pb_corr(inpimage, pbthreshold=0, pbband='LBand'):
         logger.error('Input pbband not recognized. Must be one of LBand, SBand or UHF. Defaulting to LBand.')
         PBeam = JimBeam('MKAT-AA-L-JIM-2020')
 
-    x = np.linspace(-cx, cx+1, shape[0])
-    y = np.linspace(-cy, cy+1, shape[1])
-
-    xx, yy = np.meshgrid(x, y)
-
-    # Convert pixels into separation in degrees
-    xx *= cdelt
-    yy *= cdelt
-
-    # Generate the 2D PB image
-    beam_I = PBeam.I(xx, yy, freq)
-
-    # Match shape with image data for PB correction
-    if len(shape) == 4:
-        beam_I = beam_I[:, :, None, None]
-
-    pbcor_imgdata = imgdata/beam_I
-
-    # Mask below the threshold
-    if pbthreshold > 0:
-        pbcor_imgdata[beam_I < pbthreshold] = np.nan
-        #beam_I[beam_I < pbthreshold] = np.nan
-
-    shutil.copytree(inpimage, pbimage)
-    ia.open(pbimage)
-    ia.putchunk(beam_I)
-    ia.close()
+    # Separation in degrees of the pixels along each axis
+    x = np.linspace(-cx, cx+1, shape[0]) * cdelt
+    y = np.linspace(-cy, cy+1, shape[1]) * cdelt
+
+    # Create empty outputs with the same coordinates, units and beam as the input image
+    outputs = []
+    for outfile in [pbimage, pbcorimage]:
+        out = image()
+        out.fromshape(outfile=outfile, shape=shape, csys=csys, overwrite=True)
+        out.setbrightnessunit(unit)
+        out.setmiscinfo(miscinfo)
+        if hasbeam:
+            out.setrestoringbeam(imagename=inpimage)
+        outputs.append(out)
+    pb, pbcor = outputs
+
+    # Number of complete rows (of all planes) per tile
+    nplanes = int(np.prod(shape[2:]))
+    nrows = max(1, tile_pixels // (shape[0] * nplanes))
+    extra_axes = (None,) * (len(shape) - 2)
+
+    for start in range(0, shape[1], nrows):
+        end = min(start + nrows, shape[1])
+        blc = [0, start] + [0] * (len(shape) - 2)
+        trc = [shape[0]-1, end-1] + [n-1 for n in shape[2:]]
+
+        # Generate the PB for this tile, matching the shape of the image data
+        xx, yy = np.meshgrid(y[start:end], x)
+        beam_I = PBeam.I(xx, yy, freq)[(Ellipsis,) + extra_axes]
+
+        imgdata = ia.getchunk(blc=blc, trc=trc)
+        pbcor_imgdata = imgdata/beam_I
+
+        # Mask below the threshold
+        if pbthreshold > 0:
+            pbcor_imgdata[np.broadcast_to(beam_I < pbthreshold, pbcor_imgdata.shape)] = np.nan
+
+        pb.putchunk(np.broadcast_to(beam_I, imgdata.shape), blc=blc)
+        pbcor.putchunk(pbcor_imgdata, blc=blc)
 
-    shutil.copytree(inpimage, pbcorimage)
-    ia.open(pbcorimage)
-    ia.putchunk(pbcor_imgdata)
     ia.close()
+    pb.close()
+    pbcor.close()
 
 
 def science_image(vis, cell, robust, imsize, wprojplanes, niter, threshold, multiscale, nterms, gridder, deconvolver, restoringbeam, stokes, mask, rmsmap, outlierfile, keepmms, pbthreshold, pbband):
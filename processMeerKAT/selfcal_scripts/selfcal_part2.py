@@ -7,24 +7,25 @@ import shutil
 import os
 import re
 import numpy as np
+from multiprocessing import Pool
 
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
 import processMeerKAT
+import ms_metadata
+import catalog_index
 
 from astropy.coordinates import SkyCoord
 from astropy.io import fits
 from astropy.wcs import WCS
-from astropy.units import Quantity
 
 from casatasks import *
-from casatools import image,quanta,msmetadata
+from casatools import image,quanta
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
 ia=image()
 qa=quanta()
-msmd=msmetadata()
 
 import bdsf
 import logging
@@ -64,7 +65,7 @@ def selfcal_part2(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
     else:
         logger.warning("Skipping selfcal loop {0} since calmode == ''.".format(loop))
 
-def pybdsf(imbase,rmsfile,imagename,outimage,thresh,maskfile,cat,trim_box=None,write_all=True):
+def pybdsf(imbase,rmsfile,imagename,outimage,thresh,maskfile,cat,trim_box=None,write_all=True,ncores=None):
 
     fitsname = outimage
 
@@ -78,7 +79,7 @@ def pybdsf(imbase,rmsfile,imagename,outimage,thresh,maskfile,cat,trim_box=None,w
         rms_box_bright=(40,5), advanced_opts=True, fittedimage_clip=3.0,
         group_tol=0.5, group_by_isl=False, mean_map='map',
         rms_box=(100,30), rms_map=True, thresh='hard', thresh_isl=thresh, thresh_pix=thresh,
-        blank_limit=1e-10, trim_box=trim_box)
+        blank_limit=1e-10, trim_box=trim_box, ncores=ncores)
 
     # Write out island mask and FITS catalog
     img.export_image(outfile=maskfile, img_type='island_mask', img_format='casa', clobber=True)
@@ -121,20 +122,12 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
             #from astroquery.utils.tap.core import TapPlus
             #from astropy.table import vstack
 
-            #Open MS and extract first target centre; use first sub-MS for speed if MMS
-            if os.path.exists('{0}/SUBMSS'.format(vis)):
-                tmpvis = glob.glob('{0}/SUBMSS/*'.format(vis))[0]
-            else:
-                tmpvis = vis
-
-            msmd.open(tmpvis)
-            dir=msmd.sourcedirs()[str(targetfield)]
+            #Extract first target centre from metadata snapshot of MS
+            dir=ms_metadata.get(vis).sourcedirs()[str(targetfield)]
             ra=qa.convert(dir['m0'],'deg')['value']
             dec=qa.convert(dir['m1'],'deg')['value']
             if ra < 0:
                 ra += 360
-            phasecenter=SkyCoord(ra=ra,dec=dec,unit='deg,deg')
-            msmd.done()
 
             cat = 'RACS_local.fits'
             fluxcol = 'total_flux_source'
@@ -154,13 +147,10 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
             #     RACS = vstack([galcut,galregion],join_type='exact')
             #     RACS.write(cat,overwrite=True)
             # except:
+            #Cone search using spatial index stored next to catalogue (built on first use)
             RACS = '{0}/RACS.fits.gz'.format(processMeerKAT.SCRIPT_DIR)
-            tmp = fits.open(RACS)
-            all_positions = SkyCoord(ra=tmp[1].data[racol],dec=tmp[1].data[deccol],unit='deg,deg')
-            tmp[1].data = tmp[1].data[phasecenter.separation(all_positions) < Quantity(sky_model_radius,'deg')]
-            tmp.writeto(cat,overwrite=True)
-            tmp.close()
-            del all_positions #Don't store millions of positions beyond here
+            nsources = catalog_index.write_cone(RACS, cat, ra, dec, sky_model_radius, racol=racol, deccol=deccol)
+            logger.info("Found {0} RACS sources within {1:.2f} degrees of target.".format(nsources,sky_model_radius))
 
             index = loop
 
@@ -185,10 +175,10 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
             outliers=data[metric > outlier_threshold]
             out = open(outlierfile_all,'w')
             mask = 'mask={0}'.format(pixmask)# if pixmask != '' else ''
+            SkyPos = SkyCoord(ra=outliers[racol],dec=outliers[deccol],unit='deg,deg').to_string('hmsdms')
 
-            for i,row in enumerate(outliers):
-                SkyPos = SkyCoord(ra=row[racol],dec=row[deccol],unit='deg,deg')
-                position = 'J2000 {0}'.format(SkyPos.to_string('hmsdms'))
+            for i in range(len(outliers)):
+                position = 'J2000 {0}'.format(SkyPos[i])
                 out.write("""
                 imagename={0}_outlier{1}
                 imsize=[{2},{2}]
@@ -264,45 +254,31 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
         outlier_bases = re.findall(r'imagename=(.*)\n',outliers)
         num_outliers = 0
 
+        #Test all positions against imaging area at once
+        if len(positions) > 0:
+            coords = SkyCoord(ra=[position['ra'] for position in positions],dec=[position['dec'] for position in positions])
+            inside = np.atleast_1d(w.footprint_contains(coords))
+            hmsdms = coords.to_string('hmsdms')
+        else:
+            inside = np.array([],dtype=bool)
+            hmsdms = []
+
+        #Run PyBDSF on all outliers outside imaging area in parallel
+        if step == 'bdsf':
+            outlier_masks = process_outliers(local, imbase, rmsfile, imagename, outimage, outlier_bases, hmsdms, np.flatnonzero(~inside),
+                                             index, deconvolver[loop], imsize, outlier_snr, outlier_imsize)
+
         #Only write positions for this loop outside imaging area
         for i,position in enumerate(positions):
-            pos=SkyCoord(**position)
-            if not w.footprint_contains(pos):
+            if not inside[i]:
                 num_outliers += 1
                 mask = 'mask={0}'.format(pixmask)
-                phasecenter = 'J2000 {0}'.format(pos.to_string('hmsdms'))
+                phasecenter = 'J2000 {0}'.format(hmsdms[i])
 
                 if step == 'bdsf':
-                    base = outlier_bases[i].replace('im_0','im_{0}'.format(index-1))
-                    im = base + '.image'
-                    outlier_cat = base + ".catalog.fits"
-                    outlier_mask = '{0}.islmask'.format(base)
-
-                    if deconvolver[loop] == 'mtmfs':
-                        im += '.tt0'
-
-                    if os.path.exists(im):
-                        #Run PyBDSF on outlier and update mask
-                        pybdsf(imbase,rmsfile,base,im,outlier_snr,outlier_mask,outlier_cat,write_all=False)
-                        outlier_pixmask = mask_image(**local,outlier_base=base,outlier_image=im)
-                    else:
-                        #Use main image, run PyBDSF on box around outlier, and update mask
-                        ia.open(outimage)
-                        pix = ia.topixel(pos.to_string('hmsdms'))['numeric']
-                        x,y = pix[0],pix[1]
-                        delta = outlier_imsize/2
-                        trim_box = (x-delta,x+delta,y-delta,y+delta)
-                        ia.close()
-
-                        if x < 0 or x > imsize[0] or y < 0 or y > imsize[1]:
-                            logger.warning("Image '{0}' doesn't exist. Position is outside main image so assuming outlier was dropped and skipping again.".format(im))
-                            continue
-                        else:
-                            logger.warning("Image '{0}' doesn't exist. Assuming source exists inside main image, so running PyBDSF on '{1}' using {2}x{2} pixel trim box.".format(im,outimage,outlier_imsize))
-
-                        pybdsf(imbase,rmsfile,imagename,outimage,outlier_snr,outlier_mask,outlier_cat,trim_box=trim_box,write_all=False)
-                        outlier_pixmask = mask_image(**local,outlier_base=base)
-
+                    if outlier_masks[i] is None:
+                        continue
+                    outlier_pixmask,outlier_cat = outlier_masks[i]
                     mask = 'mask={0}'.format(outlier_pixmask)
 
                     #If catalog written, take new PyBDSF position as brightest Gaussian component, or otherwise, closest to previous position
@@ -318,7 +294,7 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
                         if brightest:
                             row = np.where(data['Total_flux'] == np.max(data['Total_flux']))[0][0]
                         else:
-                            row,_,_ = pos.match_to_catalog_sky(cat_positions)
+                            row,_,_ = coords[i].match_to_catalog_sky(cat_positions)
                         phasecenter = 'J2000 {0}'.format(cat_positions[row].to_string('hmsdms'))
                     else:
                         logger.warning("PyBDSF catalogue '{0}' not created. Excluding outlier.".format(outlier_cat))
@@ -354,8 +330,105 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
 
     return rmsfile,outlierfile
 
+def process_outliers(params, imbase, rmsfile, imagename, outimage, outlier_bases, positions, outlier_indices, index, deconvolver, imsize, thresh, outlier_imsize):
+
+    """Run PyBDSF and make a pixel mask for each outlier, each in a separate worker process.
+
+    Arguments:
+    ----------
+    params : dict
+        Selfcal parameters, passed into mask_image().
+    imbase : str
+        Base name of selfcal images.
+    rmsfile : str
+        RMS image of main image.
+    imagename : str
+        Name of main image.
+    outimage : str
+        Main image, used for outliers without their own image.
+    outlier_bases : list
+        Base names of outlier images (from previous loop).
+    positions : list
+        Positions of outliers (in hmsdms).
+    outlier_indices : list
+        Indices of outliers outside imaging area, to process.
+    index : int
+        Loop index of outlier images.
+    deconvolver : str
+        Deconvolver used for this loop.
+    imsize : list
+        Size of main image.
+    thresh : float
+        PyBDSF threshold.
+    outlier_imsize : int
+        Size of outlier images.
+
+    Returns:
+    --------
+    outlier_masks : dict
+        Pixel mask and catalogue of each outlier, or None if outlier was skipped."""
+
+    jobs = []
+    outlier_masks = {}
+
+    for i in outlier_indices:
+        base = outlier_bases[i].replace('im_0','im_{0}'.format(index-1))
+        im = base + '.image'
+        outlier_cat = base + ".catalog.fits"
+
+        if deconvolver == 'mtmfs':
+            im += '.tt0'
+
+        if os.path.exists(im):
+            #Run PyBDSF on outlier and update mask
+            jobs.append((i, params, imbase, rmsfile, base, im, im, thresh, None))
+        else:
+            #Use main image, run PyBDSF on box around outlier, and update mask
+            ia.open(outimage)
+            pix = ia.topixel(positions[i])['numeric']
+            x,y = pix[0],pix[1]
+            delta = outlier_imsize/2
+            trim_box = (x-delta,x+delta,y-delta,y+delta)
+            ia.close()
+
+            if x < 0 or x > imsize[0] or y < 0 or y > imsize[1]:
+                logger.warning("Image '{0}' doesn't exist. Position is outside main image so assuming outlier was dropped and skipping again.".format(im))
+                outlier_masks[i] = None
+                continue
+            else:
+                logger.warning("Image '{0}' doesn't exist. Assuming source exists inside main image, so running PyBDSF on '{1}' using {2}x{2} pixel trim box.".format(im,outimage,outlier_imsize))
+
+            jobs.append((i, params, imbase, rmsfile, base, outimage, '', thresh, trim_box))
+
+    #Share CPUs of this job between worker processes, and the cores each one uses for fitting
+    ncpus = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    nprocs = max(1, min(ncpus, len(jobs)))
+    ncores = max(1, ncpus // nprocs)
+
+    if nprocs > 1:
+        logger.info('Running PyBDSF on {0} outliers using {1} processes.'.format(len(jobs),nprocs))
+        with Pool(nprocs) as pool:
+            results = pool.starmap(process_outlier, [job + (ncores,) for job in jobs])
+    else:
+        results = [process_outlier(*job, ncores=ncores) for job in jobs]
+
+    for job,result in zip(jobs,results):
+        outlier_masks[job[0]] = (result, job[4] + ".catalog.fits")
+
+    return outlier_masks
+
+def process_outlier(i, params, imbase, rmsfile, base, image, outlier_image, thresh, trim_box, ncores=None):
+
+    """Run PyBDSF on an outlier (or a box around it within the main image) and make its pixel mask, returning the pixel mask."""
+
+    outlier_cat = base + ".catalog.fits"
+    outlier_mask = '{0}.islmask'.format(base)
+
+    pybdsf(imbase,rmsfile,base,image,thresh,outlier_mask,outlier_cat,trim_box=trim_box,write_all=False,ncores=ncores)
+    return mask_image(**params,outlier_base=base,outlier_image=outlier_image,tmpbase='tmp{0}'.format(i))
+
 def mask_image(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojplanes, niter, threshold, uvrange, nterms, gridder,
-                  deconvolver, solint, calmode, discard_nloops, gaintype, outlier_threshold, outlier_radius, flag, outlier_base='', outlier_image=''):
+                  deconvolver, solint, calmode, discard_nloops, gaintype, outlier_threshold, outlier_radius, flag, outlier_base='', outlier_image='', tmpbase='tmp'):
 
     imbase,imagename,outimage,pixmask,rmsfile,caltable,prev_caltables,threshold,outlierfile,cfcache,thresh,maskfile,_,_ = bookkeeping.get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,outlier_threshold,outlier_radius,threshold,step='mask')
 
@@ -370,9 +443,10 @@ def mask_image(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojplan
         # export mask to its own image. Adapted from Brad's bdsf masking script.
 
         # Using a complicated name clashes with makemask internal logic, so copy over into a temp name
-        tmpisl = 'tmp.isl'
-        tmpim = 'tmp.im'
-        tmpmask = 'tmp.mask'
+        # (unique to each outlier, which may be masked concurrently)
+        tmpisl = '{0}.isl'.format(tmpbase)
+        tmpim = '{0}.im'.format(tmpbase)
+        tmpmask = '{0}.mask'.format(tmpbase)
         for im in [tmpisl, tmpim, tmpmask]:
             if os.path.exists(im):
                 shutil.rmtree(im)
@@ -410,10 +484,9 @@ if __name__ == '__main__':
 
     loop += 1
 
-    if config_parser.has_section(args['config'], 'image'):
-        config_parser.overwrite_config(args['config'], conf_dict={'mask' : "'{0}'".format(pixmask)}, conf_sec='image')
-        config_parser.overwrite_config(args['config'], conf_dict={'rmsmap' : "'{0}'".format(rmsmap)}, conf_sec='image')
-        config_parser.overwrite_config(args['config'], conf_dict={'outlierfile' : "'{0}'".format(outlierfile)}, conf_sec='image')
-    config_parser.overwrite_config(args['config'], conf_dict={'loop' : loop},  conf_sec='selfcal')
+    with config_parser.batch_update(args['config']):
+        if config_parser.has_section(args['config'], 'image'):
+            config_parser.overwrite_config(args['config'], conf_dict={'mask' : "'{0}'".format(pixmask), 'rmsmap' : "'{0}'".format(rmsmap), 'outlierfile' : "'{0}'".format(outlierfile)}, conf_sec='image')
+        config_parser.overwrite_config(args['config'], conf_dict={'loop' : loop},  conf_sec='selfcal')
 
     bookkeeping.rename_logs(logfile)
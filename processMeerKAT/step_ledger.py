@@ -0,0 +1,277 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import fcntl
+import fnmatch
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import config_parser
+
+import logging
+logger = logging.getLogger(__name__)
+
+#Ledger of completed steps, written in the working directory of each step (unless 'skipcompleted = False' in [run] section of config)
+LEDGER = '.step_ledger.json'
+
+#Environment variable identifying one execution of the master script, exported by the master script to all its jobs
+RUN_ID = 'PIPELINE_RUN_ID'
+
+#Config sections and keys that don't change the result of any step
+IGNORE_SECTIONS = ['slurm']
+IGNORE_KEYS = {'run' : ['continue', 'timestamp', 'instrument', 'skipcompleted']}
+#Config sections only read by the imaging steps
+IMAGING_SECTIONS = ['selfcal', 'image']
+IMAGING_STEPS = ['selfcal_part1', 'selfcal_part2', 'set_sky_model', 'science_image']
+
+#Steps that are always run, since they write files that aren't tracked (e.g. the config files of SPW directories)
+UNCACHED_STEPS = ['calc_refant']
+
+#Directories written by steps, which are tracked in addition to the input MS and anything named after it
+TRACKED_DIRS = ['caltables', 'images']
+#Files within tracked paths that are modified without changing the data (e.g. by reading it)
+IGNORE_FILES = ['table.lock', '*.npz', '*.metadata.json']
+#Files of each table (e.g. an MS, its subtables, the sub-MSs of an MMS, a caltable or an image) rewritten whenever the table changes
+TABLE_FILES = ['table.dat', 'table.info']
+
+def config_hash(config, step):
+
+    """Return a hash of the config values that a step reads, using the raw strings in the config file.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+    step : str
+        Name of step (i.e. script without extension).
+
+    Returns:
+    --------
+    hash : str
+        Hex digest of config values."""
+
+    values = raw_config(config)
+    for section in list(values):
+        if section in IGNORE_SECTIONS or (section in IMAGING_SECTIONS and step not in IMAGING_STEPS):
+            del values[section]
+        else:
+            for key in IGNORE_KEYS.get(section, []):
+                values[section].pop(key, None)
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+def raw_config(config):
+
+    """Return the raw (unevaluated) values of each section of a config file, without comments."""
+
+    conf = config_parser.get_config(config).config
+    return {section : {key : value for key,value in conf.items(section, raw=True) if not key.startswith('#')} for section in conf.sections()}
+
+def tracked_paths(config):
+
+    """Return the paths whose content identifies the input and output data of a step - the input MS, the caltables
+    and images directories, and anything in the working directory named after the input MS (e.g. MMSs, split MSs and images).
+    Steps run over several SPW directories (e.g. concat) also track the ledger of each SPW directory, which changes whenever a step completes there.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+
+    Returns:
+    --------
+    paths : list
+        Normalised paths, relative to the working directory."""
+
+    vis = config_parser.get_key(config, 'data', 'vis')
+    paths = [os.path.normpath(vis)] if vis != '' else []
+    paths += TRACKED_DIRS
+    if vis != '':
+        stem = os.path.basename(vis).split('.')[0]
+        paths += [path for path in glob.glob('{0}*'.format(glob.escape(stem))) if not any([fnmatch.fnmatch(path, pattern) for pattern in IGNORE_FILES])]
+    if ',' in config_parser.get_key(config, 'crosscal', 'spw'):
+        paths += [os.path.join(SPW, LEDGER) for SPW in config_parser.parse_spw(config)[3]]
+    return sorted(set([os.path.normpath(path) for path in paths]))
+
+def fingerprint(path):
+
+    """Return a hash of the name, size and modification time of every file within a path, or None if the path doesn't exist.
+    Within each table (i.e. directory with a 'table.dat' file), only the TABLE_FILES are included, rather than every data file."""
+
+    if not os.path.exists(path):
+        return None
+
+    sha = hashlib.sha1()
+    if os.path.isfile(path):
+        st = os.stat(path)
+        sha.update('{0}:{1}'.format(st.st_size,st.st_mtime_ns).encode())
+        return sha.hexdigest()
+
+    for root,dirs,files in os.walk(path):
+        dirs.sort()
+        if 'table.dat' in files:
+            files = [fname for fname in files if fname in TABLE_FILES]
+        for fname in sorted(files):
+            if any([fnmatch.fnmatch(fname, pattern) for pattern in IGNORE_FILES]):
+                continue
+            fpath = os.path.join(root,fname)
+            try:
+                st = os.stat(fpath)
+            except OSError: #e.g. broken symlink
+                continue
+            sha.update('{0}:{1}:{2}\n'.format(os.path.relpath(fpath,path),st.st_size,st.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+def skip(config, steps):
+
+    """Return whether all of a job's steps already completed with the same config and data, applying the config changes made
+    by each that did, as when it's skipped within the job, so that the steps of the jobs that follow are checked against them.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+    steps : list
+        Name of each step run by the job (i.e. script without extension), in order.
+
+    Returns:
+    --------
+    skip : bool
+        Did all steps complete?"""
+
+    if len(steps) == 0 or config_parser.get_key(config, 'run', 'skipcompleted') is False:
+        return False
+
+    for name in steps:
+        step = Step(config, name)
+        entry = step.completed()
+        if entry is None:
+            return False
+        step.restore(entry)
+    return True
+
+@contextmanager
+def locked(ledger=LEDGER):
+
+    """Context within which the ledger is locked (against steps running at the same time in the same directory), yielding its entries."""
+
+    with open('{0}.lock'.format(ledger), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield read(ledger)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def read(ledger=LEDGER):
+
+    """Return the entries of the ledger, in the order the steps completed."""
+
+    if not os.path.exists(ledger):
+        return []
+    try:
+        with open(ledger) as f:
+            return json.load(f)['steps']
+    except (ValueError, KeyError):
+        logger.warning("Ignoring corrupt step ledger '{0}'.".format(ledger))
+        return []
+
+def write(entries, ledger=LEDGER):
+
+    """Atomically write the entries of the ledger."""
+
+    fd, tmp = tempfile.mkstemp(prefix='{0}.'.format(ledger), dir=os.path.dirname(os.path.abspath(ledger)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'steps' : entries}, f, indent=1)
+    os.replace(tmp, ledger)
+
+class Step(object):
+
+    """A step of the pipeline (i.e. one script), which is skipped if it already completed with the same config values
+    and input data, and its outputs haven't changed since, other than by the steps that followed it in a previous run.
+
+    Arguments:
+    ----------
+    config : str
+        Path to config file.
+    name : str
+        Name of step (i.e. script without extension)."""
+
+    def __init__(self, config, name):
+
+        self.config = config
+        self.step = name
+        self.name = name
+        if os.environ.get('SLURM_ARRAY_TASK_ID', '') != '':
+            self.name += '_{0}'.format(os.environ['SLURM_ARRAY_TASK_ID'])
+        self.run = os.environ.get(RUN_ID)
+        self.hash = config_hash(config, name)
+        self.before = raw_config(config)
+        self.input = {path : fingerprint(path) for path in tracked_paths(config)}
+
+    def reaches(self, path, start, current, later):
+
+        """Return whether the content of a path went from start to current via the steps that completed after this step,
+        none of which were run in this execution of the pipeline (otherwise an earlier step was rerun and changed its input)."""
+
+        state = start
+        for entry in later:
+            if path in entry['input'] and entry['input'][path] == state and entry['output'].get(path) != state:
+                if self.run is not None and entry['run'] == self.run:
+                    return False
+                state = entry['output'].get(path)
+        return state == current
+
+    def completed(self):
+
+        """Return the ledger entry of this step if it is up to date, otherwise None."""
+
+        if self.step in UNCACHED_STEPS:
+            return None
+
+        entries = read()
+        matches = [i for i,entry in enumerate(entries) if entry['step'] == self.name and entry['config'] == self.hash]
+        if len(matches) == 0:
+            return None
+
+        entry = entries[matches[-1]]
+        later = entries[matches[-1]+1:]
+        for path in set(list(entry['output']) + list(self.input)):
+            current = self.input[path] if path in self.input else fingerprint(path)
+            start = entry['output'].get(path, entry['input'].get(path))
+            if not self.reaches(path, start, current, later):
+                logger.debug("Data '{0}' changed since step '{1}' last completed.".format(path,self.name))
+                return None
+
+        return entry
+
+    def restore(self, entry):
+
+        """Apply the config changes made by this step when it completed, so the steps that follow read the same config values."""
+
+        with config_parser.batch_update(self.config):
+            for section,changes in entry['changes'].items():
+                config_parser.overwrite_config(self.config, conf_dict=changes, conf_sec=section)
+
+    def record(self):
+
+        """Record that this step completed, with its config values, input and output data, and config changes."""
+
+        after = raw_config(self.config)
+        changes = {}
+        for section in after:
+            changed = {key : value for key,value in after[section].items() if value is not None and self.before.get(section, {}).get(key) != value}
+            if len(changed) > 0:
+                changes[section] = changed
+
+        paths = sorted(set(tracked_paths(self.config) + list(self.input)))
+        entry = {'step' : self.name, 'config' : self.hash, 'run' : self.run, 'changes' : changes,
+                 'input' : {path : self.input.get(path) for path in paths}, 'output' : {path : fingerprint(path) for path in paths}}
+
+        with locked() as entries:
+            entries.append(entry)
+            write(entries)
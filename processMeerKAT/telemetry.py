@@ -0,0 +1,315 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import glob
+import sqlite3
+import argparse
+import subprocess
+
+import config_parser
+import resources
+from job_graph import JobGraph
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Database shared by all pipeline runs of this user, so that steps can be compared across observations
+DEFAULT_DB = os.path.join(os.path.expanduser('~'),'.processMeerKAT','telemetry.db')
+
+#Config file used by each job, within the directory it was submitted from
+TMP_CONFIG = '.config.tmp'
+
+#sacct fields stored for each job (or job array task)
+SACCT_FIELDS = ['JobID','State','Elapsed','TotalCPU','NCPUS','NNodes','MaxRSS','MaxDiskRead','MaxDiskWrite','Start','End']
+
+#Timestamp of pipeline run, taken from job graph filename (e.g. 'jobGraph_2022-01-01-12-00-00.json')
+GRAPH_TIMESTAMP = re.compile(r'_(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})\.json$')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+    timestamp TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    script TEXT NOT NULL,
+    task INTEGER NOT NULL,
+    jobid TEXT,
+    state TEXT,
+    elapsed REAL,
+    totalcpu REAL,
+    ncpus INTEGER,
+    nnodes INTEGER,
+    maxrss REAL,
+    maxdiskread REAL,
+    maxdiskwrite REAL,
+    start TEXT,
+    end TEXT,
+    vis TEXT,
+    nvis INTEGER,
+    PRIMARY KEY (timestamp, dir, script, task))"""
+
+#Columns output by query, with SQL aggregate of each (time in hours, memory and disk in GB)
+QUERY_COLUMNS = [('runs', 'COUNT(DISTINCT timestamp)'),
+                 ('jobs', 'COUNT(*)'),
+                 ('failed', "SUM(state NOT IN ('COMPLETED','RUNNING','PENDING'))"),
+                 ('elapsed_h', 'AVG(elapsed) / 3600'),
+                 ('core_h', 'SUM(elapsed * ncpus) / 3600'),
+                 ('cpu_h', 'SUM(totalcpu) / 3600'),
+                 ('efficiency', 'SUM(totalcpu) / SUM(elapsed * ncpus)'),
+                 ('maxrss_GB', 'MAX(maxrss) / 1e9'),
+                 ('read_GB', 'AVG(maxdiskread) / 1e9'),
+                 ('write_GB', 'AVG(maxdiskwrite) / 1e9'),
+                 ('Gvis', 'AVG(nvis) / 1e9'),
+                 ('core_s_per_Mvis', 'SUM(elapsed * ncpus) / (SUM(nvis) / 1e6)')]
+
+def parse_args():
+
+    """Parse arguments into this script.
+
+    Returns:
+    --------
+    args : class ``argparse.ArgumentParser``
+        Known and validated arguments."""
+
+    parser = argparse.ArgumentParser(prog=sys.argv[0],description='Store the SLURM accounting (sacct) of each pipeline job in a database, and query the resources used by each step across pipeline runs.')
+    parser.add_argument("-d","--db", metavar="path", required=False, type=str, default=DEFAULT_DB, help="SQLite database [default: '{0}'].".format(DEFAULT_DB))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser('ingest', help='Store sacct output of the jobs in pipeline runs (finished or running).')
+    ingest.add_argument("graphs", nargs='*', default=['jobScripts/jobGraph_*.json'], help="Job graphs (JSON files) written by processMeerKAT.py [default: 'jobScripts/jobGraph_*.json'].")
+
+    query = subparsers.add_parser('query', help='Output resources used by each step, across all stored pipeline runs.')
+    query.add_argument("-b","--by", metavar="column", nargs='+', required=False, default=['script'], choices=['script','timestamp','dir','state'], help="Group jobs by these columns [default: script].")
+    query.add_argument("-s","--script", metavar="name", required=False, type=str, default='', help="Only output this step (e.g. 'flag_round_1').")
+    query.add_argument("-t","--since", metavar="timestamp", required=False, type=str, default='', help="Only output pipeline runs since this timestamp (e.g. '2022-01-01').")
+    query.add_argument("-o","--order", metavar="column", required=False, type=str, default='core_h', choices=[col for col,agg in QUERY_COLUMNS], help="Sort by this column, descending [default: core_h].")
+
+    args, unknown = parser.parse_known_args()
+
+    if len(unknown) > 0:
+        parser.error('Unknown input argument(s) present - {0}'.format(unknown))
+
+    return args
+
+def connect(db):
+
+    """Connect to telemetry database, creating it if it doesn't exist."""
+
+    if os.path.dirname(db) != '' and not os.path.exists(os.path.dirname(db)):
+        os.makedirs(os.path.dirname(db))
+    conn = sqlite3.connect(db)
+    conn.execute(SCHEMA)
+    return conn
+
+def seconds(duration):
+
+    """Convert sacct duration ([D-][HH:]MM:SS[.sss]) to seconds, or None if empty."""
+
+    if duration in ['', 'INVALID', 'UNLIMITED']:
+        return None
+    days = 0
+    if '-' in duration:
+        days,duration = duration.split('-')
+    parts = [float(part) for part in duration.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return int(days)*86400 + parts[0]*3600 + parts[1]*60 + parts[2]
+
+def nbytes(size):
+
+    """Convert sacct size (e.g. '1024K' or '2.5G') to bytes, or None if empty."""
+
+    if size == '':
+        return None
+    units = {'K' : 2**10, 'M' : 2**20, 'G' : 2**30, 'T' : 2**40}
+    if size[-1] in units:
+        return float(size[:-1]) * units[size[-1]]
+    return float(size)
+
+def sacct(IDs):
+
+    """Return the sacct fields of a list of jobs, with each job (or job array task) combined with its steps.
+
+    Arguments:
+    ----------
+    IDs : list
+        SLURM job IDs.
+
+    Returns:
+    --------
+    jobs : dict
+        Dictionary of sacct fields, keyed by job ID (e.g. '1234' or '1234_5' for an array task)."""
+
+    cmd = ['sacct','-j',','.join(IDs),'--noheader','--parsable2','--noconvert','-o',','.join(SACCT_FIELDS)]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout
+
+    jobs = {}
+    for line in out.splitlines():
+        row = dict(zip(SACCT_FIELDS, line.split('|')))
+        ID,step = (row['JobID'].split('.') + [None])[:2]
+
+        #Allocation gives state, time and CPUs, and steps (e.g. 'batch' or '0') give the peak memory and disk usage
+        if step is None:
+            jobs.setdefault(ID, {}).update({'state' : row['State'].split(' ')[0], 'elapsed' : seconds(row['Elapsed']), 'totalcpu' : seconds(row['TotalCPU']),
+                                            'ncpus' : int(row['NCPUS'] or 0), 'nnodes' : int(row['NNodes'] or 0), 'start' : row['Start'], 'end' : row['End']})
+        else:
+            job = jobs.setdefault(ID, {})
+            for key in ['MaxRSS','MaxDiskRead','MaxDiskWrite']:
+                value = nbytes(row[key])
+                if value is not None and value > (job.get(key.lower()) or 0):
+                    job[key.lower()] = value
+
+    return jobs
+
+def vis_size(dir):
+
+    """Return the input MS and number of visibilities (rows x channels x correlations) of the jobs run in a directory, or (None, None) if unknown.
+    The visibilities are counted from the snapshot of the original MS (before partition), within the channels of the directory's SPW and
+    averaged by 'chanbin' if partitioned, since the MSs written by the pipeline (e.g. partitioned MMSs) change as the jobs run."""
+
+    config = os.path.join(dir, TMP_CONFIG)
+    if not os.path.exists(config):
+        return None, None
+
+    vis = config_parser.get_key(config, 'data', 'vis')
+    orig_vis = config_parser.get_key(config, 'run', 'orig_vis')
+    spw = config_parser.get_key(config, 'crosscal', 'spw')
+    if vis == '':
+        return None, None
+
+    shape = resources.vis_shape(os.path.join(dir, orig_vis if orig_vis != '' else vis), spw)
+    if shape is not None and orig_vis != '':
+        chanbin = config_parser.get_key(config, 'crosscal', 'chanbin')
+        shape = resources.average(shape, chanbin if chanbin != '' else 1)
+    if shape is None:
+        return vis, None
+    return vis, shape['nrows'] * shape['nchan'] * shape['ncorr']
+
+def ingest(conn, filename):
+
+    """Store the sacct fields of all jobs of a pipeline run in the database, replacing any stored for the same run.
+
+    Arguments:
+    ----------
+    conn : class ``sqlite3.Connection``
+        Connection to telemetry database.
+    filename : str
+        Job graph (JSON file) written by processMeerKAT.py and submitted by job_graph.py.
+
+    Returns:
+    --------
+    njobs : int
+        Number of jobs (or job array tasks) stored."""
+
+    match = GRAPH_TIMESTAMP.search(filename)
+    graph = JobGraph.read(filename)
+    if match is None or len(graph.IDs) != len(graph):
+        logger.warning("Job graph '{0}' has no timestamp or submitted job IDs. Skipping.".format(filename))
+        return 0
+
+    #Jobs are submitted from directories relative to where the graph is submitted, which is the parent of the graph's directory
+    timestamp = match.group(1)
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(filename)))
+    try:
+        jobs = sacct(graph.IDs)
+    except (OSError, subprocess.CalledProcessError) as err:
+        logger.error("Can't read SLURM accounting for '{0}' (jobs run without SLURM aren't recorded): {1}".format(filename,err))
+        return 0
+
+    rows = []
+    sizes = {}
+    for job,ID in zip(graph.jobs,graph.IDs):
+        if job.dir not in sizes:
+            sizes[job.dir] = vis_size(os.path.join(topdir, job.dir))
+        vis,nvis = sizes[job.dir]
+        for jobid in sorted(jobs):
+            if jobid == ID or jobid.startswith(ID + '_'):
+                task = int(jobid.split('_')[1]) if '_' in jobid and jobid.split('_')[1].isdigit() else -1
+                fields = jobs[jobid]
+                rows.append((timestamp, job.dir, job.name, task, jobid, fields.get('state'), fields.get('elapsed'), fields.get('totalcpu'), fields.get('ncpus'), fields.get('nnodes'),
+                             fields.get('maxrss'), fields.get('maxdiskread'), fields.get('maxdiskwrite'), fields.get('start'), fields.get('end'), vis, nvis))
+
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO jobs VALUES ({0})'.format(','.join(['?']*17)), rows)
+
+    logger.info("Stored {0} jobs from pipeline run '{1}' in '{2}'.".format(len(rows),timestamp,filename))
+    return len(rows)
+
+def query(conn, by=['script'], script='', since='', order='core_h'):
+
+    """Return the resources used by each step (or other grouping), aggregated over all stored pipeline runs.
+
+    Arguments:
+    ----------
+    conn : class ``sqlite3.Connection``
+        Connection to telemetry database.
+    by : list, optional
+        Columns to group jobs by.
+    script : str, optional
+        Only include this step.
+    since : str, optional
+        Only include pipeline runs with timestamps since this one.
+    order : str, optional
+        Column to sort by, descending.
+
+    Returns:
+    --------
+    columns : list
+        Column names.
+    rows : list
+        Rows of aggregated resources."""
+
+    where,params = [],[]
+    if script != '':
+        where.append('script = ?')
+        params.append(os.path.splitext(script)[0])
+    if since != '':
+        where.append('timestamp >= ?')
+        params.append(since)
+
+    columns = by + [col for col,agg in QUERY_COLUMNS]
+    sql = 'SELECT {0}, {1} FROM jobs'.format(', '.join(by), ', '.join(['{0} AS {1}'.format(agg,col) for col,agg in QUERY_COLUMNS]))
+    if len(where) > 0:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' GROUP BY {0} ORDER BY {1} DESC'.format(', '.join(by), order)
+
+    return columns, conn.execute(sql, params).fetchall()
+
+def format_table(columns, rows):
+
+    """Return query output as a table of aligned columns."""
+
+    def fmt(value):
+        if value is None:
+            return '-'
+        if type(value) is float:
+            return '{0:.3g}'.format(value)
+        return str(value)
+
+    cells = [columns] + [[fmt(value) for value in row] for row in rows]
+    widths = [max([len(row[i]) for row in cells]) for i in range(len(columns))]
+    return '\n'.join(['  '.join([cell.ljust(width) for cell,width in zip(row,widths)]) for row in cells])
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    conn = connect(args.db)
+
+    if args.command == 'ingest':
+        filenames = sorted(set([fname for pattern in args.graphs for fname in glob.glob(pattern)]))
+        if len(filenames) == 0:
+            logger.error("No job graphs found with {0}.".format(args.graphs))
+            sys.exit(1)
+        for filename in filenames:
+            ingest(conn, filename)
+    else:
+        columns,rows = query(conn, args.by, args.script, args.since, args.order)
+        print(format_table(columns, rows))
+
+    conn.close()
@@ -6,13 +6,11 @@ import os
 
 from config_parser import validate_args as va
 import processMeerKAT
-import read_ms, bookkeeping
+import read_ms, bookkeeping, ms_metadata
 
-from casatools import msmetadata
 from casatasks import casalog
 logfile=casalog.logfile()
 casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
-msmd = msmetadata()
 
 import logging
 from time import gmtime
@@ -43,15 +41,16 @@ def main(args,taskvals):
     nspw = va(taskvals, 'crosscal', 'nspw', int)
     fields = bookkeeping.get_field_ids(taskvals['fields'])
 
+    if not os.path.exists(visname):
+        raise IOError("Path to MS %s not found" % (visname))
+
+    # Write metadata snapshot, which later scripts read rather than opening the MS again
+    ms_metadata.write(visname)
+
     # Check if the reference antenna exists, and complain and quit if it doesn't
     if not calcrefant:
         refant = va(taskvals, 'crosscal', 'refant', str)
-        msmd.open(visname)
         read_ms.check_refant(MS=visname, refant=refant, config=args['config'], warn=False)
-        msmd.done()
-
-    if not os.path.exists(visname):
-        raise IOError("Path to MS %s not found" % (visname))
 
 
 if __name__ == '__main__':
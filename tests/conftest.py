@@ -0,0 +1,38 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+#Pipeline modules and scripts import each other by name, as when run by the pipeline
+PIPELINE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'processMeerKAT')
+for path in [PIPELINE_DIR, os.path.join(PIPELINE_DIR, 'crosscal_scripts')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+@pytest.fixture
+def casa(monkeypatch):
+
+    """Replace the CASA modules imported by pipeline scripts with mocks, so a script's main() can be run without CASA
+    or a MeasurementSet, and return the mocked casatasks module."""
+
+    casatasks = types.ModuleType('casatasks')
+    for task in ['casalog', 'mstransform', 'split', 'flagdata']:
+        setattr(casatasks, task, mock.MagicMock(name=task))
+    casatools = types.ModuleType('casatools')
+    for tool in ['msmetadata', 'table', 'measures', 'quanta', 'image']:
+        setattr(casatools, tool, mock.MagicMock(name=tool))
+
+    for name,module in [('casatasks', casatasks), ('casatools', casatools), ('casampi', types.ModuleType('casampi'))]:
+        monkeypatch.setitem(sys.modules, name, module)
+    for env in ['SLURM_JOB_NAME', 'SLURM_JOB_ID', 'SLURM_ARRAY_JOB_ID', 'SLURM_ARRAY_TASK_ID']:
+        monkeypatch.setenv(env, '0')
+
+    #Import scripts again with each set of mocks
+    for script in ['partition', 'split']:
+        monkeypatch.delitem(sys.modules, script, raising=False)
+    return casatasks
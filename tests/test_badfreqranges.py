@@ -0,0 +1,83 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+import importlib
+
+import pytest
+
+import config_parser
+
+CONFIG = """[data]
+vis = 'input.ms'
+
+[fields]
+bpassfield = 'bpass'
+fluxfield = 'bpass'
+phasecalfield = 'phase'
+targetfields = 'target'
+extrafields = ''
+
+[slurm]
+nodes = 1
+ntasks_per_node = 4
+
+[crosscal]
+spw = '*:880~1680MHz'
+nspw = 1
+chanbin = 1
+width = 1
+timeavg = '8s'
+createmms = True
+keepmms = True
+badants = []
+
+[run]
+dopol = False
+"""
+
+class Metadata(object):
+
+    """Stand-in for the metadata snapshot of the input MS."""
+
+    def ncorrforpol(self):
+        return [4]
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+
+    """Config file without 'badfreqranges' in its [crosscal] section, in a temporary working directory."""
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'logs').mkdir()
+    path = tmp_path / 'config.txt'
+    path.write_text(CONFIG)
+    return str(path)
+
+def run_main(script, config):
+    taskvals = config_parser.parse_config(config)[0]
+    assert 'badfreqranges' not in taskvals['crosscal']
+    script.main({'config' : config}, taskvals)
+    return config_parser.parse_config(config)[0]
+
+def test_partition_without_badfreqranges(casa, config, monkeypatch):
+    partition = importlib.import_module('partition')
+    calls = []
+    monkeypatch.setattr(partition.ms_metadata, 'get', lambda MS: Metadata())
+    monkeypatch.setattr(partition.ms_metadata, 'write', lambda MS: None)
+    monkeypatch.setattr(partition, 'do_partition', lambda visname, spw, *args: calls.append(spw) or 'input.880~1680MHz.mms')
+
+    taskvals = run_main(partition, config)
+    assert calls == ['*:880~1680MHz']
+    assert taskvals['data']['vis'] == 'input.880~1680MHz.mms'
+    assert taskvals['run']['orig_vis'] == 'input.ms'
+
+def test_split_without_badfreqranges(casa, config, monkeypatch):
+    split = importlib.import_module('split')
+    calls = []
+    monkeypatch.setattr(split.bookkeeping, 'bookkeeping', lambda visname: ([], 'caltables'))
+    monkeypatch.setattr(split.ms_metadata, 'write', lambda MS: None)
+    monkeypatch.setattr(split, 'split_vis', lambda visname, spw, *args: calls.append(spw) or 'input.target.mms')
+
+    taskvals = run_main(split, config)
+    assert calls == ['*:880~1680MHz']
+    assert taskvals['data']['vis'] == 'input.target.mms'
@@ -0,0 +1,25 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+import os
+
+import ms_metadata
+
+def test_unflagged_stale_after_flagging(tmp_path):
+
+    MS = str(tmp_path / 'input.ms')
+    os.makedirs(MS)
+    for fname in ['table.dat', 'table.f0']:
+        with open(os.path.join(MS, fname), 'w') as f:
+            f.write(fname)
+
+    meta = {'chanfreqs' : [[1e9, 1.1e9]], 'unflagged' : {'fractions' : [[0.5, 1.0]], 'mtime' : ms_metadata.flags_mtime(MS)}}
+    msmd = ms_metadata.MSMetadata(MS, meta)
+    assert list(msmd.unflagged(0)) == [0.5, 1.0]
+
+    #Rewriting the data of the main table (e.g. FLAG) leaves the MS directory unchanged, but makes the sample stale
+    mtime = os.stat(MS).st_mtime_ns
+    stat = os.stat(os.path.join(MS, 'table.f0'))
+    os.utime(os.path.join(MS, 'table.f0'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert os.stat(MS).st_mtime_ns == mtime
+    assert msmd.unflagged(0) is None
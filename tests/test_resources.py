@@ -0,0 +1,22 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+import resources
+
+SHAPE = {'nrows' : 200000, 'nchan' : 4096, 'ncorr' : 4, 'nscans' : 10, 'scanrows' : [20000]*10, 'nbaselines' : 2016, 'inttime' : 8.0}
+IMAGE = {'imsize' : [6144,6144], 'nterms' : 2, 'wprojplanes' : 128}
+
+def test_estimate_cpus_cover_memory():
+
+    #Each process needs ~8 GB, so with 16 GB per CPU (512 GB over 32 CPUs) it's given one CPU, and with 2 GB per CPU five
+    assert resources.estimate('xx_yy_solve.py', 1, 4, 512, 32, SHAPE)['cpus'] == 1
+    estimate = resources.estimate('xx_yy_solve.py', 1, 4, 64, 32, SHAPE)
+    assert estimate['cpus'] == 5
+    assert estimate['cpus'] * estimate['tasks'] <= 32
+
+def test_estimate_cpus_threaded_imaging():
+
+    #Imaging processes share all CPUs of the node between the tasks left after fitting into memory
+    estimate = resources.estimate('science_image.py', 1, 8, 64, 32, image=IMAGE)
+    assert estimate['tasks'] < 8
+    assert estimate['cpus'] == 32 // estimate['tasks']
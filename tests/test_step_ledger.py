@@ -0,0 +1,64 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+import os
+
+import step_ledger
+from job_graph import JobGraph
+
+CONFIG = """[data]
+vis = 'input.ms'
+
+[crosscal]
+spw = '*:880~1680MHz'
+"""
+
+SBATCH = """#!/bin/bash
+#SBATCH --job-name={0}
+srun singularity exec casa.simg python /path/to/crosscal_scripts/{0}.py --config .config.tmp
+"""
+
+def write_table(path):
+    os.makedirs(path)
+    for fname in ['table.dat', 'table.info', 'table.f0']:
+        with open(os.path.join(path, fname), 'w') as f:
+            f.write(fname)
+
+def test_fingerprint_only_table_files(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    write_table('input.ms')
+    write_table(os.path.join('input.ms', 'ANTENNA'))
+    before = step_ledger.fingerprint('input.ms')
+
+    #Data files of a table aren't fingerprinted, but the table files of its subtables are
+    with open(os.path.join('input.ms', 'table.f0'), 'a') as f:
+        f.write('more data')
+    assert step_ledger.fingerprint('input.ms') == before
+    with open(os.path.join('input.ms', 'ANTENNA', 'table.dat'), 'a') as f:
+        f.write('new row')
+    assert step_ledger.fingerprint('input.ms') != before
+
+def test_skip_completed_jobs(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(step_ledger.RUN_ID, raising=False)
+    write_table('input.ms')
+    with open('.config.tmp', 'w') as f:
+        f.write(CONFIG)
+    for step in ['setjy', 'xx_yy_solve']:
+        with open('{0}.sbatch'.format(step), 'w') as f:
+            f.write(SBATCH.format(step))
+
+    step_ledger.Step('.config.tmp', 'setjy').record()
+
+    graph = JobGraph()
+    first = graph.add('setjy.sbatch')
+    graph.add('xx_yy_solve.sbatch', after=[first])
+    graph.jobs[first].external = ['123']
+
+    #Only the completed step is removed, and the next job runs after the jobs the removed job depended on
+    assert graph.skip_completed() == ['setjy']
+    assert [job.name for job in graph.jobs] == ['xx_yy_solve']
+    assert graph.jobs[0].deps == []
+    assert graph.jobs[0].external == ['123']